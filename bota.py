@@ -1,9 +1,35 @@
 import os
 import json
 import logging
+import logging.handlers
+import queue
+import atexit
 import io
 import uuid
-from datetime import datetime
+import re
+import time
+import signal
+import asyncio
+import sys
+import functools
+import sqlite3
+import hashlib
+import threading
+import random
+import html
+import base64
+import gzip
+import csv
+import pickle
+import shutil
+import mimetypes
+import contextlib
+import contextvars
+import abc
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import difflib 
 
@@ -13,24 +39,484 @@ from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import gspread
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import Request, AuthorizedSession
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+from PIL import Image
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, ReplyKeyboardMarkup
-from telegram.ext import Application, MessageHandler, filters, ContextTypes, CallbackQueryHandler, CommandHandler
+from telegram.ext import (Application, MessageHandler, filters, ContextTypes, CallbackQueryHandler, CommandHandler,
+                          PicklePersistence, PersistenceInput, BaseUpdateProcessor, TypeHandler)
 
 # --- 1. Konfiguracja Logowania ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Handlery (kod bota, wątki Google, pętla lustra) tylko wrzucają rekord do kolejki; formatowanie JSON
+# i zapis na stderr robi osobny wątek QueueListener, więc logowanie nie blokuje pętli zdarzeń.
+FORMAT_LOGOW = os.getenv('FORMAT_LOGOW', 'json')  # 'json' albo 'tekst'
+POZIOM_LOGOW = os.getenv('POZIOM_LOGOW', 'INFO').upper()
+# Z komunikatów DEBUG z tego samego miejsca w kodzie przepuszczany jest co N-ty (1 = wszystkie)
+PROBKOWANIE_DEBUG = max(int(os.getenv('PROBKOWANIE_DEBUG', 20)), 1)
+
+# Ślad aktualizacji Telegrama i ślad odbioru (odbiur_id) - dołączane do każdego rekordu.
+# Zmienne kontekstowe przechodzą do asyncio.to_thread i zadań tworzonych w handlerze.
+_slad_aktualizacji = contextvars.ContextVar('slad_aktualizacji', default=None)
+_slad_odbioru = contextvars.ContextVar('slad_odbioru', default=None)
+
+
+@contextlib.contextmanager
+def slad(aktualizacja=None, odbior=None):
+    """Ustawia ślady dla bloku kodu (np. zadania odtwarzanego po restarcie, pętli w tle)."""
+    tokeny = [(zmienna, zmienna.set(wartosc)) for zmienna, wartosc in
+              ((_slad_aktualizacji, aktualizacja), (_slad_odbioru, odbior)) if wartosc is not None]
+    try:
+        yield
+    finally:
+        for zmienna, token in reversed(tokeny):
+            zmienna.reset(token)
+
+
+class FiltrSladu(logging.Filter):
+    """Dopisuje ślady do rekordu w wątku, który loguje (w wątku zapisu kontekstu już nie ma)."""
+
+    def filter(self, record):
+        record.slad_aktualizacji = _slad_aktualizacji.get()
+        record.slad_odbioru = _slad_odbioru.get()
+        return True
+
+
+class ProbkowanieDebug(logging.Filter):
+    """Przepuszcza pierwszy i co PROBKOWANIE_DEBUG-ty rekord DEBUG z każdego miejsca w kodzie."""
+
+    def __init__(self, co_ktory):
+        super().__init__()
+        self.co_ktory = co_ktory
+        self.liczniki = Counter()
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.co_ktory == 1:
+            return True
+        miejsce = (record.pathname, record.lineno)
+        self.liczniki[miejsce] += 1  # wyścig między wątkami może najwyżej przesunąć próbkę
+        record.probka = self.co_ktory
+        return self.liczniki[miejsce] % self.co_ktory == 1
+
+
+class FormaterJSON(logging.Formatter):
+    """Jeden obiekt JSON na linię - czytelny dla Cloud Logging / jq."""
+
+    def format(self, record):
+        wpis = {
+            'czas': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'poziom': record.levelname,
+            'logger': record.name,
+            'wiadomosc': record.getMessage(),
+            'watek': record.threadName,
+        }
+        for pole in ('slad_aktualizacji', 'slad_odbioru', 'probka'):
+            wartosc = getattr(record, pole, None)
+            if wartosc is not None:
+                wpis[pole] = wartosc
+        if record.exc_info:
+            wpis['wyjatek'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            wpis['wyjatek'] = record.exc_text
+        return json.dumps(wpis, ensure_ascii=False, default=str)
+
+
+class KolejkaLogow(logging.handlers.QueueHandler):
+    """
+    QueueHandler bez formatowania w wątku wywołującym: %-argumenty są składane dopiero w wątku zapisu.
+    Argumenty nie-proste (mogą się zmienić, zanim rekord zostanie zapisany) są zamieniane na tekst od razu.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        proste = isinstance(record.args, tuple) and all(
+            isinstance(a, (str, int, float, bool, type(None))) for a in record.args)
+        if record.args and not proste:
+            record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class FormaterTekstowy(logging.Formatter):
+    """Dotychczasowy format tekstowy (FORMAT_LOGOW=tekst), ze śladami na końcu linii."""
+
+    def format(self, record):
+        tekst = super().format(record)
+        if getattr(record, 'slad_odbioru', None) or getattr(record, 'slad_aktualizacji', None):
+            tekst += f" [akt={record.slad_aktualizacji} odb={record.slad_odbioru}]"
+        return tekst
+
+
+def _wyjscie_logow():
+    wyjscie = logging.StreamHandler(sys.stderr)
+    wyjscie.setFormatter(FormaterJSON() if FORMAT_LOGOW == 'json' else
+                         FormaterTekstowy('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return wyjscie
+
+
+def skonfiguruj_logowanie():
+    """Podpina kolejkę logów pod root logger i uruchamia wątek zapisu. Zwraca QueueListener."""
+    wyjscie = _wyjscie_logow()
+    kolejka = queue.SimpleQueue()
+    handler = KolejkaLogow(kolejka)
+    handler.addFilter(ProbkowanieDebug(PROBKOWANIE_DEBUG))
+    handler.addFilter(FiltrSladu())
+
+    logging.basicConfig(level=POZIOM_LOGOW, handlers=[handler], force=True)
+    # httpx loguje każde zapytanie do Bot API (z tokenem w adresie) na poziomie INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    sluchacz = logging.handlers.QueueListener(kolejka, wyjscie, respect_handler_level=True)
+    sluchacz.start()
+    atexit.register(sluchacz.stop)  # dopisuje zaległe rekordy przy wyjściu
+    return sluchacz
+
+
+sluchacz_logow = skonfiguruj_logowanie()
 logger = logging.getLogger(__name__)
 
+
+# --- 1b. Profilowanie na żądanie (/profil lub SIGUSR1) ---
+KATALOG_PROFILI = os.getenv('KATALOG_PROFILI', 'profile')
+INTERWAL_PROBKOWANIA = float(os.getenv('INTERWAL_PROBKOWANIA', 0.005))
+# Callback blokujący pętlę zdarzeń dłużej niż tyle sekund jest logowany (tylko podczas profilowania)
+PROG_BLOKADY_PETLI = float(os.getenv('PROG_BLOKADY_PETLI', 0.1))
+
+
+class Profiler:
+    """
+    Próbkujący profiler: osobny wątek co INTERWAL_PROBKOWANIA zbiera stosy wszystkich wątków
+    (pętla zdarzeń + wątki z wywołaniami Google) i zlicza je w formacie "folded" (flamegraph.pl, speedscope).
+    Dodatkowo mierzy czasy funkcji oznaczonych @profilowane. Gdy wyłączony, koszt to jedno sprawdzenie flagi.
+    """
+
+    def __init__(self):
+        self.aktywny = False
+        self.blokada = threading.Lock()
+        self.stop_probkowania = threading.Event()
+        self.koniec = None  # asyncio.Event - ustawiany po limicie aktualizacji lub /profil stop
+        self.wyczysc()
+
+    def wyczysc(self):
+        self.probki = Counter()
+        self.czasy = {}  # nazwa funkcji -> [liczba wywołań, suma, maks]
+        self.blokady_petli = []
+        self.liczba_aktualizacji = 0
+        self.limit_aktualizacji = None
+        self.start_czas = None
+
+    def start(self, limit_aktualizacji=None):
+        self.wyczysc()
+        self.limit_aktualizacji = limit_aktualizacji
+        self.start_czas = time.monotonic()
+        self.koniec = asyncio.Event()
+        self.stop_probkowania.clear()
+        threading.Thread(target=self._probkuj, name='profiler', daemon=True).start()
+        self.aktywny = True
+
+    def stop(self):
+        self.aktywny = False
+        self.stop_probkowania.set()
+
+    def _probkuj(self):
+        wlasny = threading.get_ident()
+        while not self.stop_probkowania.wait(INTERWAL_PROBKOWANIA):
+            nazwy_watkow = {watek.ident: watek.name for watek in threading.enumerate()}
+            for ident, ramka in sys._current_frames().items():
+                if ident == wlasny:
+                    continue
+                stos = []
+                while ramka is not None:
+                    kod = ramka.f_code
+                    stos.append(f"{kod.co_name} ({os.path.basename(kod.co_filename)}:{kod.co_firstlineno})")
+                    ramka = ramka.f_back
+                stos.append(nazwy_watkow.get(ident, str(ident)))
+                self.probki[';'.join(reversed(stos))] += 1
+
+    def zapisz_czas(self, nazwa, czas, aktualizacja=False):
+        with self.blokada:
+            wpis = self.czasy.setdefault(nazwa, [0, 0.0, 0.0])
+            wpis[0] += 1
+            wpis[1] += czas
+            wpis[2] = max(wpis[2], czas)
+            if aktualizacja:
+                self.liczba_aktualizacji += 1
+                # Handlery działają w pętli zdarzeń, więc Event można ustawić bezpośrednio
+                if self.limit_aktualizacji and self.liczba_aktualizacji >= self.limit_aktualizacji:
+                    self.koniec.set()
+
+    def zapisz_wynik(self):
+        """Zapisuje stosy do pliku .folded i zwraca (ścieżka, podsumowanie tekstowe)."""
+        os.makedirs(KATALOG_PROFILI, exist_ok=True)
+        sciezka = os.path.join(KATALOG_PROFILI, f"profil_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded")
+        with open(sciezka, 'w', encoding='utf-8') as f:
+            for stos, liczba in self.probki.most_common():
+                f.write(f"{stos} {liczba}\n")
+
+        czas_trwania = time.monotonic() - self.start_czas
+        linie = [f"Profil: {czas_trwania:.1f} s, {sum(self.probki.values())} próbek, "
+                 f"{self.liczba_aktualizacji} aktualizacji."]
+        for nazwa, (liczba, suma, maks) in sorted(self.czasy.items(), key=lambda x: -x[1][1])[:12]:
+            linie.append(f"{nazwa}: {liczba}x, śr. {suma / liczba * 1000:.0f} ms, maks {maks * 1000:.0f} ms")
+        if self.blokady_petli:
+            linie.append(f"Blokady pętli > {PROG_BLOKADY_PETLI * 1000:.0f} ms: {len(self.blokady_petli)}, "
+                         f"najdłuższa {max(self.blokady_petli) * 1000:.0f} ms")
+        return sciezka, "\n".join(linie)
+
+
+profiler = Profiler()
+
+
+def profilowane(funkcja, aktualizacja=False):
+    """Dekorator mierzący czas funkcji (sync lub async) - tylko gdy profiler jest włączony."""
+    nazwa = funkcja.__name__
+
+    if asyncio.iscoroutinefunction(funkcja):
+        @functools.wraps(funkcja)
+        async def opakowanie_async(*args, **kwargs):
+            if not profiler.aktywny:
+                return await funkcja(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await funkcja(*args, **kwargs)
+            finally:
+                profiler.zapisz_czas(nazwa, time.perf_counter() - start, aktualizacja)
+        return opakowanie_async
+
+    @functools.wraps(funkcja)
+    def opakowanie(*args, **kwargs):
+        if not profiler.aktywny:
+            return funkcja(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return funkcja(*args, **kwargs)
+        finally:
+            profiler.zapisz_czas(nazwa, time.perf_counter() - start, aktualizacja)
+    return opakowanie
+
+
+async def _monitor_petli():
+    """Mierzy opóźnienie pętli zdarzeń: uśpienie na 50 ms, które trwa dłużej, oznacza zablokowany callback."""
+    loop = asyncio.get_running_loop()
+    while True:
+        przed = loop.time()
+        await asyncio.sleep(0.05)
+        opoznienie = loop.time() - przed - 0.05
+        if opoznienie > PROG_BLOKADY_PETLI:
+            profiler.blokady_petli.append(opoznienie)
+            logger.warning("Pętla zdarzeń zablokowana na %.0f ms", opoznienie * 1000)
+
+
+async def profiluj(bot, odbiorcy: list, sekundy: float, limit_aktualizacji=None):
+    """Włącza profiler na podany czas (lub do limitu aktualizacji) i wysyła wynik odbiorcom."""
+    loop = asyncio.get_running_loop()
+    profiler.start(limit_aktualizacji)
+    # Tryb debug asyncio loguje każdy callback dłuższy niż slow_callback_duration (z nazwą callbacku)
+    poprzedni_debug = loop.get_debug()
+    loop.slow_callback_duration = PROG_BLOKADY_PETLI
+    loop.set_debug(True)
+    monitor = asyncio.ensure_future(_monitor_petli())
+    logger.info("Profilowanie włączone na %.0f s (limit aktualizacji: %s)", sekundy, limit_aktualizacji)
+
+    try:
+        await asyncio.wait_for(profiler.koniec.wait(), timeout=sekundy)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        monitor.cancel()
+        loop.set_debug(poprzedni_debug)
+        profiler.stop()
+
+    sciezka, podsumowanie = profiler.zapisz_wynik()
+    logger.info("%s\nZapisano: %s", podsumowanie, sciezka)
+    for chat_id in odbiorcy:
+        try:
+            with open(sciezka, 'rb') as f:
+                await bot.send_document(chat_id, f, caption=podsumowanie[:1000])
+        except Exception as e:
+            logger.error("Nie można wysłać profilu do %s: %s", chat_id, e)
+
+# --- 1c. Harmonogram wywołań Google (limity na minutę per API i klasa metod) ---
+# (api, klasa) -> zapytań na minutę; nadpisanie np. LIMIT_SHEETS_ZAPIS=300
+LIMITY_GOOGLE = {
+    ('sheets', 'odczyt'): 60,
+    ('sheets', 'zapis'): 60,
+    ('drive', 'odczyt'): 600,
+    ('drive', 'zapis'): 180,
+    ('gemini', 'generowanie'): 60,
+}
+for (_api, _klasa) in LIMITY_GOOGLE:
+    LIMITY_GOOGLE[(_api, _klasa)] = int(os.getenv(f"LIMIT_{_api}_{_klasa}".upper(), LIMITY_GOOGLE[(_api, _klasa)]))
+# Tej części kubełka zadania w tle (zapis odbioru, lustro, odtwarzanie) nie ruszają - zostaje dla użytkownika
+REZERWA_INTERAKTYWNA = 0.25
+MAKS_PONOWIEN_GOOGLE = int(os.getenv('MAKS_PONOWIEN_GOOGLE', 5))
+
+# Priorytet bieżącego wywołania; asyncio.to_thread kopiuje kontekst, więc ustawienie w handlerze działa w wątku
+_priorytet_google = contextvars.ContextVar('priorytet_google', default='interaktywny')
+
+
+@contextlib.contextmanager
+def w_tle():
+    """Wywołania Google w tym bloku (i w wątkach z niego uruchomionych) mają niski priorytet."""
+    token = _priorytet_google.set('w_tle')
+    try:
+        yield
+    finally:
+        _priorytet_google.reset(token)
+
+
+def status_bledu_google(e):
+    """Kod HTTP z wyjątku googleapiclient (resp.status), gspread (response.status_code) lub Gemini (code)."""
+    for atrybut in ('resp', 'response'):
+        odpowiedz = getattr(e, atrybut, None)
+        status = getattr(odpowiedz, 'status', None) or getattr(odpowiedz, 'status_code', None)
+        if status:
+            return int(status)
+    kod = getattr(e, 'code', None)
+    return int(kod) if isinstance(kod, int) else None
+
+
+def czy_ponowic_google(e) -> bool:
+    """429 (limit) i 5xx (chwilowa awaria) mają sens ponowić; reszta to błąd wywołania."""
+    status = status_bledu_google(e)
+    return status is not None and (status == 429 or status >= 500)
+
+
+class HarmonogramGoogle:
+    """
+    Kubełek żetonów na każdą parę (api, klasa): pojemność = 10 s limitu, uzupełnianie w tempie limitu na minutę.
+    Wywołania interaktywne (zdjęcie, dopasowanie firmy) mają pierwszeństwo - zadania w tle czekają, gdy ktoś
+    interaktywny czeka, i nie schodzą poniżej REZERWA_INTERAKTYWNA. 429 i 5xx są ponawiane z losowym
+    opóźnieniem (full jitter); 429 dodatkowo opróżnia kubełek, żeby zwolnili wszyscy, a nie tylko ten wątek.
+    """
+
+    def __init__(self, limity: dict):
+        self.warunek = threading.Condition()
+        self.kubelki = {}
+        for klucz, na_minute in limity.items():
+            pojemnosc = max(na_minute / 6, 1.0)
+            self.kubelki[klucz] = {'pojemnosc': pojemnosc, 'tempo': na_minute / 60, 'tokeny': pojemnosc,
+                                   'czas': time.monotonic(), 'limit': na_minute}
+        self.czekajacy_interaktywni = Counter()
+        self.statystyki = Counter()  # (api, klasa, zdarzenie)
+        self._watek = threading.local()
+
+    def _uzupelnij(self, kubelek, teraz):
+        kubelek['tokeny'] = min(kubelek['pojemnosc'], kubelek['tokeny'] + (teraz - kubelek['czas']) * kubelek['tempo'])
+        kubelek['czas'] = teraz
+
+    def pobierz(self, api, klasa, koszt=1):
+        """Blokuje wątek do czasu, aż będzie żeton (koszt > pojemności: bierze przy pełnym kubełku, na kredyt)."""
+        klucz = (api, klasa)
+        kubelek = self.kubelki[klucz]
+        interaktywny = _priorytet_google.get() == 'interaktywny'
+        start = time.monotonic()
+
+        with self.warunek:
+            if interaktywny:
+                self.czekajacy_interaktywni[klucz] += 1
+            try:
+                while True:
+                    self._uzupelnij(kubelek, time.monotonic())
+                    potrzebne = koszt if interaktywny else koszt + kubelek['pojemnosc'] * REZERWA_INTERAKTYWNA
+                    potrzebne = min(potrzebne, kubelek['pojemnosc'])
+                    if kubelek['tokeny'] >= potrzebne and (interaktywny or not self.czekajacy_interaktywni[klucz]):
+                        kubelek['tokeny'] -= koszt
+                        break
+                    brak = max(potrzebne - kubelek['tokeny'], 0.05)
+                    self.warunek.wait(brak / kubelek['tempo'])
+            finally:
+                if interaktywny:
+                    self.czekajacy_interaktywni[klucz] -= 1
+                    self.warunek.notify_all()
+
+        self.statystyki[(api, klasa, 'wywolania')] += 1
+        czekano = time.monotonic() - start
+        if czekano > 0.05:
+            self.statystyki[(api, klasa, 'oczekiwania')] += 1
+            logger.debug("Harmonogram: %s/%s czekało %.2fs (%s)", api, klasa, czekano, _priorytet_google.get())
+
+    def wywolaj(self, api, klasa, funkcja, *args, koszt=1, ponawiaj=True, idempotentne=True, **kwargs):
+        """
+        Wywołuje funkcję Google po pobraniu żetonu; 429/5xx ponawia (chyba że ponawiaj=False).
+        idempotentne=False (tworzenie plików i folderów): ponawia tylko 429 - po 5xx obiekt mógł już powstać.
+        """
+        for proba in range(MAKS_PONOWIEN_GOOGLE + 1):
+            self.pobierz(api, klasa, koszt)
+            try:
+                return funkcja(*args, **kwargs)
+            except Exception as e:
+                if not czy_ponowic_google(e):
+                    raise
+                status = status_bledu_google(e)
+                if status == 429:
+                    self.statystyki[(api, klasa, '429')] += 1
+                    with self.warunek:
+                        self.kubelki[(api, klasa)]['tokeny'] = min(self.kubelki[(api, klasa)]['tokeny'], 0)
+                if (not ponawiaj or getattr(self._watek, 'bez_ponowien', False) or proba == MAKS_PONOWIEN_GOOGLE
+                        or (not idempotentne and status != 429)):
+                    raise
+                self.statystyki[(api, klasa, 'ponowienia')] += 1
+                przerwa = random.uniform(0, min(60, 2 ** (proba + 1)))
+                logger.warning("Google %s/%s: HTTP %s, ponowienie %s/%s za %.1fs",
+                               api, klasa, status, proba + 1, MAKS_PONOWIEN_GOOGLE, przerwa)
+                time.sleep(przerwa)
+
+    @contextlib.contextmanager
+    def bez_ponowien(self):
+        """Wywołania z tego wątku w bloku nie ponawiają - całość powtarza pod_blokada, już bez blokady."""
+        poprzednio = getattr(self._watek, 'bez_ponowien', False)
+        self._watek.bez_ponowien = True
+        try:
+            yield
+        finally:
+            self._watek.bez_ponowien = poprzednio
+
+    def pod_blokada(self, blokada, funkcja, *args, **kwargs):
+        """
+        Wywołuje funkcję pod blokadą, ale bez ponowień w środku: po 429/5xx zwalnia blokadę, odczekuje i powtarza
+        całość. Przerwa jednego wątku nie zatrzymuje pozostałych, a stan (np. wolny wiersz) liczymy od nowa.
+        """
+        for proba in range(MAKS_PONOWIEN_GOOGLE + 1):
+            try:
+                with blokada, self.bez_ponowien():
+                    return funkcja(*args, **kwargs)
+            except Exception as e:
+                if not czy_ponowic_google(e) or proba == MAKS_PONOWIEN_GOOGLE:
+                    raise
+                przerwa = random.uniform(0, min(60, 2 ** (proba + 1)))
+                logger.warning("Google: HTTP %s pod blokadą %s - ponowienie %s/%s za %.1fs, blokada zwolniona",
+                               status_bledu_google(e), getattr(funkcja, '__name__', funkcja),
+                               proba + 1, MAKS_PONOWIEN_GOOGLE, przerwa)
+                time.sleep(przerwa)
+
+    def zapas(self) -> dict:
+        """Aktualny zapas: {(api, klasa): {'tokeny', 'pojemnosc', 'limit', 'wywolania', 'oczekiwania', 'ponowienia', '429'}}."""
+        teraz = time.monotonic()
+        wynik = {}
+        with self.warunek:
+            for (api, klasa), kubelek in self.kubelki.items():
+                self._uzupelnij(kubelek, teraz)
+                wynik[(api, klasa)] = {
+                    'tokeny': kubelek['tokeny'], 'pojemnosc': kubelek['pojemnosc'], 'limit': kubelek['limit'],
+                    **{zdarzenie: self.statystyki[(api, klasa, zdarzenie)]
+                       for zdarzenie in ('wywolania', 'oczekiwania', 'ponowienia', '429')}
+                }
+        return wynik
+
+
+harmonogram = HarmonogramGoogle(LIMITY_GOOGLE)
+
+
 # --- 2. Ładowanie Kluczy API ---
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# ID użytkowników Telegrama z dostępem do komend administracyjnych (np. /profil), po przecinku
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}
 
 if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
     logger.critical("BŁĄD: Nie znaleziono tokenów (TELEGRAM_TOKEN lub GEMINI_API_KEY) w pliku .env")
@@ -45,6 +531,13 @@ WORKSHEET_NAME = 'Arkusz1'
 G_DRIVE_MAIN_FOLDER_NAME = 'Lokale'
 G_DRIVE_SZEREGI_FOLDER_NAME = 'Szeregi'
 
+# Gdzie trafiają zdjęcia i usterki:
+#   'google'         - Drive + Arkusz (jak dotąd)
+#   'lokalny'        - tylko dysk lokalny + SQLite (serwer na budowie, testy wydajności bez Google)
+#   'lokalny+google' - lokalny magazyn jako główny, Google jako asynchroniczne lustro
+MAGAZYN_BACKEND = os.getenv('MAGAZYN_BACKEND', 'google')
+KATALOG_MAGAZYNU = os.getenv('KATALOG_MAGAZYNU', 'magazyn')
+
 # --- 3b. Lista Firm Wykonawczych (Oficjalna) ---
 LISTA_FIRM_WYKONAWCZYCH = [
     "ANETA NIEWIADOMSKA ANER",
@@ -80,11 +573,28 @@ DANE_SZEREGOW = {
     "Szereg 11": {"zakres": "15-19", "lokale": ["15/1", "15/2", "16/1", "16/2", "17/1", "17/2", "18/1", "18/2", "19/1", "19/2"]}
 }
 
+# --- 3d. Indeks lokali (adresowanie usterek tekstem, np. "49/1 pęknięty tynk") ---
+# Budowany raz przy starcie: numer lokalu -> nazwa szeregu.
+INDEKS_LOKALI = {
+    lokal: szereg_name
+    for szereg_name, dane in DANE_SZEREGOW.items()
+    for lokal in dane['lokale']
+}
+
+# Numer lokalu na początku wpisu: "49/1", "49 / 1", "lok. 49/1"; z kropką tylko po "lok"/"lokal" ("lok 49.1"),
+# bo "1.2 m rysa" to wymiar, nie lokal. Liczba, po której stoi jednostka ("1/2 m", "2/5 cm"), też nie jest lokalem.
+WZORZEC_LOKALU = re.compile(
+    r'^\s*(lok(?:al)?\.?\s*)?(\d{1,3})\s*(?(1)[/.]|/)\s*(\d{1,2})'
+    r'(?![\d/]|[.,]\d)(?!\s*(?:mm|cm|dm|mb|m2|m²|m|%|°)(?!\w))[\s:,;\-–]*',
+    re.IGNORECASE
+)
+
 START_KEYBOARD = ReplyKeyboardMarkup(
     [["NOWY ODBIÓR"]], resize_keyboard=True
 )
 
 gc = None
+spreadsheet = None
 worksheet = None
 drive_service = None
 g_drive_main_folder_id = None
@@ -101,9 +611,9 @@ def get_google_creds():
         try:
             with open(GOOGLE_CREDENTIALS_FILE, 'w') as f:
                 f.write(creds_json_string)
-            logger.info(f"Pomyślnie zapisano credentials w {GOOGLE_CREDENTIALS_FILE}")
+            logger.info("Pomyślnie zapisano credentials w %s", GOOGLE_CREDENTIALS_FILE)
         except Exception as e:
-            logger.error(f"Nie można zapisać credentials ze zmiennej: {e}")
+            logger.error("Nie można zapisać credentials ze zmiennej: %s", e)
     
     token_json_string = os.getenv('GOOGLE_TOKEN_JSON')
     if token_json_string:
@@ -111,9 +621,9 @@ def get_google_creds():
         try:
             with open(GOOGLE_TOKEN_FILE, 'w') as token:
                 token.write(token_json_string)
-            logger.info(f"Pomyślnie zapisano token w {GOOGLE_TOKEN_FILE}")
+            logger.info("Pomyślnie zapisano token w %s", GOOGLE_TOKEN_FILE)
         except Exception as e:
-            logger.error(f"Nie można zapisać tokenu ze zmiennej: {e}")
+            logger.error("Nie można zapisać tokenu ze zmiennej: %s", e)
     # --- KONIEC SEKCJI ---
             
     if os.path.exists(GOOGLE_TOKEN_FILE):
@@ -129,54 +639,55 @@ def get_google_creds():
                 flow = InstalledAppFlow.from_client_secrets_file(GOOGLE_CREDENTIALS_FILE, SCOPES)
                 creds = flow.run_local_server(port=0)
             except Exception as e:
-                logger.critical(f"BŁĄD KRYTYCZNY PRZY AUTORYZACJI: {e}")
+                logger.critical("BŁĄD KRYTYCZNY PRZY AUTORYZACJI: %s", e)
                 exit()
 
         with open(GOOGLE_TOKEN_FILE, 'w') as token:
             token.write(creds.to_json())
-        logger.info(f"Pomyślnie zapisano/zaktualizowano token w {GOOGLE_TOKEN_FILE}")
+        logger.info("Pomyślnie zapisano/zaktualizowano token w %s", GOOGLE_TOKEN_FILE)
     
     return creds
 
-try:
-    creds = get_google_creds()
-    logger.info("Pomyślnie uzyskano dane logowania Google (OAuth 2.0)")
+if MAGAZYN_BACKEND in ('google', 'lokalny+google'):
+    try:
+        creds = get_google_creds()
+        logger.info("Pomyślnie uzyskano dane logowania Google (OAuth 2.0)")
     
-    gc = gspread.authorize(creds)
-    spreadsheet = gc.open(GOOGLE_SHEET_NAME)
-    worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
-    logger.info(f"Pomyślnie połączono z Arkuszem Google: {GOOGLE_SHEET_NAME}")
-
-    drive_service = build('drive', 'v3', credentials=creds)
-    logger.info("Pomyślnie połączono z Google Drive")
-
-    def find_folder(folder_name):
-        logger.info(f"Szukanie folderu: '{folder_name}'...")
-        response_folder = drive_service.files().list(
-            q=f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and 'root' in parents and trashed=False",
-            spaces='drive',
-            fields='files(id, name)',
-        ).execute()
+        gc = gspread.authorize(creds)
+        spreadsheet = gc.open(GOOGLE_SHEET_NAME)
+        worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
+        logger.info("Pomyślnie połączono z Arkuszem Google: %s", GOOGLE_SHEET_NAME)
+
+        drive_service = build('drive', 'v3', credentials=creds)
+        logger.info("Pomyślnie połączono z Google Drive")
+
+        def find_folder(folder_name):
+            logger.info("Szukanie folderu: '%s'...", folder_name)
+            response_folder = drive_service.files().list(
+                q=f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and 'root' in parents and trashed=False",
+                spaces='drive',
+                fields='files(id, name)',
+            ).execute()
         
-        files = response_folder.get('files', [])
-        if not files:
-            logger.critical(f"BŁĄD KRYTYCZNY: Nie znaleziono folderu '{folder_name}' na Twoim 'Mój Dysk'!")
-            return None
+            files = response_folder.get('files', [])
+            if not files:
+                logger.critical("BŁĄD KRYTYCZNY: Nie znaleziono folderu '%s' na Twoim 'Mój Dysk'!", folder_name)
+                return None
         
-        folder_id = files[0].get('id')
-        logger.info(f"Pomyślnie znaleziono folder '{folder_name}' (ID: {folder_id})")
-        return folder_id
+            folder_id = files[0].get('id')
+            logger.info("Pomyślnie znaleziono folder '%s' (ID: %s)", folder_name, folder_id)
+            return folder_id
 
-    g_drive_main_folder_id = find_folder(G_DRIVE_MAIN_FOLDER_NAME)
-    g_drive_szeregi_folder_id = find_folder(G_DRIVE_SZEREGI_FOLDER_NAME)
+        g_drive_main_folder_id = find_folder(G_DRIVE_MAIN_FOLDER_NAME)
+        g_drive_szeregi_folder_id = find_folder(G_DRIVE_SZEREGI_FOLDER_NAME)
 
-    if not g_drive_main_folder_id:
-        logger.critical(f"Nie udało się znaleźć głównego folderu '{G_DRIVE_MAIN_FOLDER_NAME}'. Zamykanie.")
-        exit()
+        if not g_drive_main_folder_id:
+            logger.critical("Nie udało się znaleźć głównego folderu '%s'. Zamykanie.", G_DRIVE_MAIN_FOLDER_NAME)
+            exit()
 
-except Exception as e:
-    logger.critical(f"BŁĄD KRYTYCZNY: Nie można połączyć z Google: {e}")
-    exit()
+    except Exception as e:
+        logger.critical("BŁĄD KRYTYCZNY: Nie można połączyć z Google: %s", e)
+        exit()
 
 
 # ----------------------------------------------------
@@ -193,6 +704,13 @@ Jeśli nic nie pasuje, zwróć -1.
 Nie pisz żadnych słów, tylko cyfrę.
 """
 
+ustawienia_bezpieczenstwa = [
+    {"category": HarmCategory.HARM_CATEGORY_HARASSMENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
+    {"category": HarmCategory.HARM_CATEGORY_HATE_SPEECH, "threshold": HarmBlockThreshold.BLOCK_NONE},
+    {"category": HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, "threshold": HarmBlockThreshold.BLOCK_NONE},
+    {"category": HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
+]
+
 model = genai.GenerativeModel(
     model_name="gemini-2.5-flash",
     generation_config={
@@ -200,15 +718,11 @@ model = genai.GenerativeModel(
         "max_output_tokens": 10,
         "response_mime_type": "text/plain",
     },
-    safety_settings=[
-        {"category": HarmCategory.HARM_CATEGORY_HARASSMENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
-        {"category": HarmCategory.HARM_CATEGORY_HATE_SPEECH, "threshold": HarmBlockThreshold.BLOCK_NONE},
-        {"category": HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT, "threshold": HarmBlockThreshold.BLOCK_NONE},
-        {"category": HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT, "threshold": HarmBlockThreshold.BLOCK_NONE},
-    ],
+    safety_settings=ustawienia_bezpieczenstwa,
     system_instruction=system_instruction_text
 )
 
+@profilowane
 def dopasuj_firme_ai(tekst_uzytkownika: str) -> str:
     """
     Hybryda AI + Python.
@@ -233,7 +747,7 @@ def dopasuj_firme_ai(tekst_uzytkownika: str) -> str:
 
     # --- PRÓBA AI ---
     try:
-        response = model.generate_content(prompt)
+        response = harmonogram.wywolaj('gemini', 'generowanie', model.generate_content, prompt)
         
         if response.candidates and response.candidates[0].finish_reason.value == 1:
             ai_output = response.text.strip()
@@ -243,16 +757,16 @@ def dopasuj_firme_ai(tekst_uzytkownika: str) -> str:
                 if 0 <= idx < len(LISTA_FIRM_WYKONAWCZYCH):
                     wynik_firma = LISTA_FIRM_WYKONAWCZYCH[idx]
                     ai_success = True
-                    logger.info(f"AI dopasowało ID {idx} -> {wynik_firma}")
+                    logger.info("AI dopasowało ID %s -> %s", idx, wynik_firma)
                 elif idx == -1:
                     logger.info("AI stwierdziło brak dopasowania (-1).")
             else:
-                logger.warning(f"AI zwróciło coś dziwnego: '{ai_output}'")
+                logger.warning("AI zwróciło coś dziwnego: '%s'", ai_output)
         else:
             logger.warning("AI zablokowało odpowiedź lub błąd generowania.")
             
     except Exception as e:
-        logger.error(f"Błąd połączenia z AI: {e}")
+        logger.error("Błąd połączenia z AI: %s", e)
 
     if ai_success and wynik_firma:
         return wynik_firma
@@ -269,11 +783,11 @@ def dopasuj_firme_ai(tekst_uzytkownika: str) -> str:
             candidates.append(firm)
     
     if len(candidates) == 1:
-        logger.info(f"Python Smart-Fallback znalazł: {candidates[0]}")
+        logger.debug("Python Smart-Fallback znalazł: %s", candidates[0])
         return candidates[0]
     elif len(candidates) > 1:
         # Jeśli pasuje do kilku, bierzemy najkrótszą (zazwyczaj najbardziej precyzyjną) lub pierwszą
-        logger.info(f"Python Smart-Fallback znalazł kilka, wybieram: {candidates[0]}")
+        logger.debug("Python Smart-Fallback znalazł kilka, wybieram: %s", candidates[0])
         return candidates[0]
 
     # 2. Ostatnia deska ratunku: difflib (literówki)
@@ -282,12 +796,49 @@ def dopasuj_firme_ai(tekst_uzytkownika: str) -> str:
         # Znajdź oryginał
         for firm in LISTA_FIRM_WYKONAWCZYCH:
             if firm.upper() == matches[0]:
-                logger.info(f"Python Difflib znalazł: {firm}")
+                logger.debug("Python Difflib znalazł: %s", firm)
                 return firm
 
     return f"INNA: {tekst_uzytkownika}"
 
 
+# --- 4b. Transkrypcja notatek głosowych (ten sam klucz Gemini) ---
+instrukcja_transkrypcji = """
+Jesteś stenografem na odbiorach technicznych budynków.
+Otrzymasz ponumerowane nagrania głosowe po polsku - każde to opis jednej usterki budowlanej.
+Zwróć WYŁĄCZNIE tablicę JSON z tekstami, po jednym na nagranie, w tej samej kolejności.
+Zapisz to, co zostało powiedziane, bez komentarzy i wstępów.
+Numery lokali zapisuj cyframi w formacie 49/1 (np. "czterdzieści dziewięć przez jeden" -> "49/1").
+Jeśli nagranie jest niezrozumiałe, wpisz pusty tekst.
+"""
+
+model_transkrypcji = genai.GenerativeModel(
+    model_name="gemini-2.5-flash",
+    generation_config={
+        "temperature": 0.0,
+        "response_mime_type": "application/json",
+    },
+    safety_settings=ustawienia_bezpieczenstwa,
+    system_instruction=instrukcja_transkrypcji
+)
+
+
+@profilowane
+def transkrybuj_notatki(nagrania: list) -> list:
+    """Transkrybuje paczkę notatek [(bajty, mime), ...] jednym zapytaniem. Zwraca listę tekstów w tej samej kolejności."""
+    czesci = []
+    for numer, (dane, mime) in enumerate(nagrania, start=1):
+        czesci.append(f"Nagranie {numer}:")
+        czesci.append({"mime_type": mime, "data": dane})
+    czesci.append(f"Zwróć tablicę JSON z {len(nagrania)} tekstami.")
+
+    response = harmonogram.wywolaj('gemini', 'generowanie', model_transkrypcji.generate_content, czesci)
+    teksty = json.loads(response.text)
+    if not isinstance(teksty, list) or len(teksty) != len(nagrania):
+        raise ValueError(f"oczekiwano {len(nagrania)} transkrypcji, otrzymano: {response.text[:200]}")
+    return [str(tekst).strip() for tekst in teksty]
+
+
 # --- Funkcja tworząca klawiaturę Inline ---
 def get_inline_keyboard(usterka_id=None, context: ContextTypes.DEFAULT_TYPE = None):
     """Tworzy i zwraca dynamiczną klawiaturę inline na podstawie stanu sesji."""
@@ -320,6 +871,44 @@ def get_inline_keyboard(usterka_id=None, context: ContextTypes.DEFAULT_TYPE = No
     return InlineKeyboardMarkup(keyboard)
 
 
+# --- 5b. Rozpoznawanie lokalu na początku wpisu ---
+def rozpoznaj_lokal(tekst: str):
+    """
+    Sprawdza, czy tekst zaczyna się od numeru znanego lokalu (np. '49/1 pęknięty tynk').
+    Zwraca (lokal, szereg, reszta_tekstu) albo (None, None, tekst), jeśli to nie jest lokal z INDEKS_LOKALI.
+    """
+    dopasowanie = WZORZEC_LOKALU.match(tekst or '')
+    if not dopasowanie:
+        return None, None, tekst
+
+    lokal = f"{int(dopasowanie.group(2))}/{int(dopasowanie.group(3))}"
+    szereg_name = INDEKS_LOKALI.get(lokal)
+    if not szereg_name:
+        return None, None, tekst
+
+    return lokal, szereg_name, tekst[dopasowanie.end():].strip()
+
+
+def zastosuj_lokal_z_tekstu(chat_data, tekst: str):
+    """
+    Jeśli wpis zaczyna się od numeru lokalu, ustawia go jako aktywny lokal sesji.
+    Zwraca (opis_usterki, komunikat_bledu) - przy błędzie opis jest None, a wpis nie powinien być dodany.
+    """
+    lokal, szereg_name, reszta = rozpoznaj_lokal(tekst)
+    if not lokal:
+        return tekst, None
+
+    if szereg_name != chat_data.get('wybrany_szereg'):
+        return None, (f"❌ Lokal <b>{lokal}</b> należy do: <b>{szereg_name}</b>, "
+                      f"a trwa odbiór: <b>{chat_data.get('odbiur_identyfikator', 'BRAK')}</b>.\n"
+                      f"Wpis NIE został dodany.")
+
+    if chat_data.get('biezacy_lokal_w_szeregu') != lokal:
+        logger.debug("Zmiana aktywnego lokalu z treści wpisu: %s", lokal)
+    chat_data['biezacy_lokal_w_szeregu'] = lokal
+    return reszta, None
+
+
 # -----------------------------------------------------------
 # --- 6a. KONFIGURACJA KOLUMN W ARKUSZU (NOWOŚĆ) ---
 # -----------------------------------------------------------
@@ -336,157 +925,2638 @@ KOLUMNA_ZDJECIE = 'E'
 NUMER_KOLUMNY_KLUCZOWEJ = 1  # Szukamy wolnego wiersza na podstawie kolumny A (Data)
 
 # --- 6. Funkcja do Zapisu w Arkuszu (POPRAWIONA) ---
+# Jeden zapis naraz: wątki handlerów i lustra nie mogą dostać tego samego "pierwszego wolnego wiersza"
+_blokada_arkusza = threading.RLock()
+
+
 def zapisz_w_arkuszu(dane_json: dict, data_telegram: datetime) -> bool:
     """
     Zapisuje dane w pierwszym WOLNYM wierszu, ignorując formatowanie,
     i celuje w konkretne kolumny zdefiniowane w konfiguracji.
     """
+    return zapisz_wiersze_w_arkuszu([dane_json], data_telegram) == 1
+
+
+@profilowane
+def zapisz_wiersze_w_arkuszu(lista_danych: list, data_telegram: datetime) -> int:
+    """
+    Zapis hurtowy: wiele usterek pod rząd od pierwszego WOLNEGO wiersza jednym batch_update.
+    Przy włączonych shardach pisze do bieżącego sharda (bez skanowania kolumny), inaczej do WORKSHEET_NAME.
+    Zwraca liczbę zapisanych wierszy.
+    """
+    if not lista_danych:
+        return 0
+    try:
+        # Przerwy przed ponowieniem poza blokadą - inaczej jeden 5xx wstrzymuje zapisy wszystkich czatów
+        return harmonogram.pod_blokada(_blokada_arkusza, _zapisz_wiersze, lista_danych, data_telegram)
+    except Exception as e:
+        logger.error("Błąd podczas zapisu do Google Sheets: %s", e)
+        return 0
+
+
+def _zapisz_wiersze(lista_danych: list, data_telegram: datetime) -> int:
+    """Właściwy zapis; wołać pod _blokada_arkusza (pierwszy wolny wiersz jest ważny tylko pod nią)."""
     try:
         data_str = data_telegram.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # 1. Pobierz wszystkie wartości z kolumny kluczowej, aby znaleźć gdzie kończy się tekst
-        # Ignoruje puste, sformatowane wiersze na dole.
-        wartosci_w_kolumnie = worksheet.col_values(NUMER_KOLUMNY_KLUCZOWEJ)
-        
-        # Pierwszy wolny wiersz to liczba zajętych wierszy + 1
-        pierwszy_wolny_wiersz = len(wartosci_w_kolumnie) + 1
-        
-        logger.info(f"Znaleziono pierwszy wolny wiersz logiczny: {pierwszy_wolny_wiersz}")
 
-        # 2. Przygotuj dane do wysłania (batch_update)
-        # Dzięki temu wpisujemy dane w KONKRETNE komórki (np. C15, E15) niezależnie od ich kolejności
+        if shardy_arkusza:
+            arkusz, pierwszy_wolny_wiersz = shardy_arkusza.miejsce_na_wiersze(len(lista_danych), data_telegram)
+        else:
+            # 1. Pobierz wszystkie wartości z kolumny kluczowej, aby znaleźć gdzie kończy się tekst
+            # Ignoruje puste, sformatowane wiersze na dole.
+            arkusz = worksheet
+            wartosci_w_kolumnie = harmonogram.wywolaj('sheets', 'odczyt', arkusz.col_values, NUMER_KOLUMNY_KLUCZOWEJ)
+
+            # Pierwszy wolny wiersz to liczba zajętych wierszy + 1
+            pierwszy_wolny_wiersz = len(wartosci_w_kolumnie) + 1
+        ostatni_wiersz = pierwszy_wolny_wiersz + len(lista_danych) - 1
+
+        logger.debug("Znaleziono pierwszy wolny wiersz logiczny: %s (%s)", pierwszy_wolny_wiersz, arkusz.title)
+
+        # 2. Przygotuj dane do wysłania (batch_update) - jeden zakres na kolumnę
+        # Dzięki temu wpisujemy dane w KONKRETNE komórki (np. C15:C40, E15:E40) niezależnie od ich kolejności
+        kolumny = [
+            (KOLUMNA_DATA, lambda d: data_str),
+            (KOLUMNA_LOKAL, lambda d: d.get('numer_lokalu_budynku', 'BŁĄD')),
+            (KOLUMNA_USTERKA, lambda d: d.get('rodzaj_usterki', 'BŁĄD')),
+            (KOLUMNA_PODMIOT, lambda d: d.get('podmiot_odpowiedzialny', 'BŁĄD')),
+            (KOLUMNA_ZDJECIE, lambda d: d.get('link_do_zdjecia', '')),
+        ]
         updates = [
             {
-                'range': f'{KOLUMNA_DATA}{pierwszy_wolny_wiersz}',
-                'values': [[data_str]]
-            },
-            {
-                'range': f'{KOLUMNA_LOKAL}{pierwszy_wolny_wiersz}',
-                'values': [[dane_json.get('numer_lokalu_budynku', 'BŁĄD')]]
-            },
-            {
-                'range': f'{KOLUMNA_USTERKA}{pierwszy_wolny_wiersz}',
-                'values': [[dane_json.get('rodzaj_usterki', 'BŁĄD')]]
-            },
-            {
-                'range': f'{KOLUMNA_PODMIOT}{pierwszy_wolny_wiersz}',
-                'values': [[dane_json.get('podmiot_odpowiedzialny', 'BŁĄD')]]
-            },
-            {
-                'range': f'{KOLUMNA_ZDJECIE}{pierwszy_wolny_wiersz}',
-                'values': [[dane_json.get('link_do_zdjecia', '')]]
+                'range': f'{kolumna}{pierwszy_wolny_wiersz}:{kolumna}{ostatni_wiersz}',
+                'values': [[wartosc(dane_json)] for dane_json in lista_danych]
             }
+            for kolumna, wartosc in kolumny
         ]
 
         # 3. Wyślij zmiany do arkusza jednym strzałem
-        worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+        harmonogram.wywolaj('sheets', 'zapis', arkusz.batch_update, updates, value_input_option='USER_ENTERED')
+        if shardy_arkusza:
+            shardy_arkusza.po_zapisie(len(lista_danych))
+
+        logger.info("Pomyślnie zapisano %s wierszy (%s-%s)",
+                    len(lista_danych), pierwszy_wolny_wiersz, ostatni_wiersz)
+        return len(lista_danych)
+    except Exception:
+        if shardy_arkusza:
+            shardy_arkusza.uniewaznij_licznik()
+        raise
+
+
+def _ostatnie_wiersze_arkusza(arkusz, liczba_wierszy: int, limit: int) -> list:
+    """Czyta tylko ostatnie `limit` wierszy danych (wiersz 1 to nagłówek) kolumnami z konfiguracji."""
+    if liczba_wierszy < 2 or limit <= 0:
+        return []
+    start = max(2, liczba_wierszy - limit + 1)
+
+    klucze = ['data', 'numer_lokalu_budynku', 'rodzaj_usterki', 'podmiot_odpowiedzialny']
+    zakresy = [f'{kolumna}{start}:{kolumna}{liczba_wierszy}'
+               for kolumna in (KOLUMNA_DATA, KOLUMNA_LOKAL, KOLUMNA_USTERKA, KOLUMNA_PODMIOT)]
+    kolumny = harmonogram.wywolaj('sheets', 'odczyt', arkusz.batch_get, zakresy)
+
+    wiersze = []
+    for i in range(liczba_wierszy - start + 1):
+        # Puste komórki na końcu zakresu API po prostu pomija
+        wiersze.append({
+            klucz: (kolumna[i][0] if i < len(kolumna) and kolumna[i] else '')
+            for klucz, kolumna in zip(klucze, kolumny)
+        })
+    return wiersze
+
+
+@profilowane
+def pobierz_ostatnie_wiersze_z_arkusza(limit: int) -> list:
+    """Czyta tylko ostatnie `limit` wierszy (przy shardach - z kolejnych aktywnych shardów). Najnowsze na końcu."""
+    try:
+        if shardy_arkusza:
+            return shardy_arkusza.ostatnie_wiersze(limit)
+        liczba_wierszy = len(harmonogram.wywolaj('sheets', 'odczyt', worksheet.col_values, NUMER_KOLUMNY_KLUCZOWEJ))
+        return _ostatnie_wiersze_arkusza(worksheet, liczba_wierszy, limit)
+
+    except Exception as e:
+        logger.error("Błąd odczytu historii z Google Sheets: %s", e)
+        return []
+
+
+# --- 6a2. Shardy arkusza: jedna zakładka na miesiąc (lub na LIMIT_WIERSZY_SHARDU wierszy) ---
+# Domyślnie wyłączone - istniejące wdrożenia piszą dalej do jednej zakładki, dopóki nie włączą shardów
+SHARDY_ARKUSZA = os.getenv('SHARDY_ARKUSZA', '0') == '1'
+LIMIT_WIERSZY_SHARDU = int(os.getenv('LIMIT_WIERSZY_SHARDU', 5000))
+# Zamknięte shardy starsze niż tyle miesięcy idą do archiwum (CSV.gz na Drive) i znikają z arkusza
+ARCHIWIZUJ_PO_MIESIACACH = int(os.getenv('ARCHIWIZUJ_PO_MIESIACACH', 3))
+NAZWA_MANIFESTU_SHARDOW = '_shardy'
+G_DRIVE_ARCHIWUM_FOLDER_NAME = 'Archiwum_Odbiorow'
+
+
+class ShardyArkusza:
+    """
+    Manifest shardów w zakładce NAZWA_MANIFESTU_SHARDOW: nazwa | okres | status | wiersze | archiwum_id.
+    Status: 'aktywny' (jedyny, do niego piszemy), 'zamkniety', 'archiwum' (zakładka usunięta, dane w CSV.gz na Drive).
+    Pierwotna zakładka WORKSHEET_NAME trafia do manifestu jako pierwszy shard bez okresu.
+    Licznik wolnego wiersza aktywnego sharda jest trzymany w pamięci - kolumnę skanujemy raz po starcie.
+    """
+
+    def __init__(self, spreadsheet, arkusz_bazowy):
+        self.spreadsheet = spreadsheet
+        self.arkusz_bazowy = arkusz_bazowy
+        self.manifest = None   # Worksheet z manifestem
+        self.shardy = None     # lista dictów, kolejność jak w manifeście (od najstarszego)
+        self.arkusze = {}      # nazwa -> Worksheet
+        self.nastepny_wiersz = None
+
+    # --- manifest ---
+    def _wczytaj(self):
+        if self.shardy is not None:
+            return
+        try:
+            self.manifest = harmonogram.wywolaj('sheets', 'odczyt', self.spreadsheet.worksheet, NAZWA_MANIFESTU_SHARDOW)
+            wiersze = harmonogram.wywolaj('sheets', 'odczyt', self.manifest.get_all_values)[1:]
+            self.shardy = [
+                {'nazwa': w[0], 'okres': w[1], 'status': w[2], 'wiersze': int(w[3] or 0), 'archiwum_id': w[4] if len(w) > 4 else ''}
+                for w in (wiersz + [''] * (5 - len(wiersz)) for wiersz in wiersze) if w[0]
+            ]
+        except gspread.WorksheetNotFound:
+            logger.info("Brak manifestu shardów - tworzenie (obecna zakładka staje się pierwszym shardem)...")
+            self.manifest = self._zakladka(NAZWA_MANIFESTU_SHARDOW, 200, 5)
+            harmonogram.wywolaj('sheets', 'zapis', self.manifest.update, range_name='A1:E1',
+                                values=[['nazwa', 'okres', 'status', 'wiersze', 'archiwum_id']])
+            self.shardy = [{'nazwa': self.arkusz_bazowy.title, 'okres': '', 'status': 'aktywny', 'wiersze': 0, 'archiwum_id': ''}]
+            self._zapisz_shard(0)
+        logger.info("Shardy arkusza: %s, aktywny: %s", len(self.shardy), self._aktywny()['nazwa'])
+
+    def _zapisz_shard(self, indeks):
+        shard = self.shardy[indeks]
+        nr = indeks + 2
+        harmonogram.wywolaj('sheets', 'zapis', self.manifest.update, range_name=f'A{nr}:E{nr}',
+                            values=[[shard['nazwa'], shard['okres'], shard['status'], shard['wiersze'], shard['archiwum_id']]])
+
+    def _aktywny(self):
+        aktywny = next((s for s in reversed(self.shardy) if s['status'] == 'aktywny'), None)
+        if aktywny is None:
+            raise RuntimeError(f"Manifest shardów ('{NAZWA_MANIFESTU_SHARDOW}') nie ma aktywnego sharda")
+        return aktywny
+
+    def _arkusz(self, nazwa):
+        if nazwa not in self.arkusze:
+            self.arkusze[nazwa] = (self.arkusz_bazowy if nazwa == self.arkusz_bazowy.title
+                                   else harmonogram.wywolaj('sheets', 'odczyt', self.spreadsheet.worksheet, nazwa))
+        return self.arkusze[nazwa]
+
+    # --- zapis ---
+    def miejsce_na_wiersze(self, liczba: int, data_telegram: datetime):
+        """Zwraca (arkusz, pierwszy_wolny_wiersz) w bieżącym shardzie; w razie potrzeby otwiera nowy."""
+        self._wczytaj()
+        aktywny = self._aktywny()
+        arkusz = self._arkusz(aktywny['nazwa'])
+
+        if self.nastepny_wiersz is None:
+            self.nastepny_wiersz = len(harmonogram.wywolaj('sheets', 'odczyt', arkusz.col_values, NUMER_KOLUMNY_KLUCZOWEJ)) + 1
+
+        okres = data_telegram.strftime('%Y-%m')
+        if aktywny['okres'] != okres or self.nastepny_wiersz - 2 + liczba > LIMIT_WIERSZY_SHARDU:
+            arkusz = self._nowy_shard(okres)
+
+        return arkusz, self.nastepny_wiersz
+
+    def po_zapisie(self, liczba: int):
+        self.nastepny_wiersz += liczba
+
+    def uniewaznij_licznik(self):
+        """Po błędzie zapisu nie ufamy licznikowi - następny zapis przeskanuje kolumnę."""
+        self.nastepny_wiersz = None
+
+    def _zakladka(self, nazwa, wiersze, kolumny):
+        """Zakładka o tej nazwie: istniejąca (zostawiona przez przerwaną wcześniej próbę) albo nowa."""
+        try:
+            return harmonogram.wywolaj('sheets', 'odczyt', self.spreadsheet.worksheet, nazwa)
+        except gspread.WorksheetNotFound:
+            pass
+        try:
+            # Bez ponawiania: 5xx mogło przyjść już po utworzeniu zakładki, a ponowienie skończy się "already exists"
+            return harmonogram.wywolaj('sheets', 'zapis', self.spreadsheet.add_worksheet,
+                                       title=nazwa, rows=wiersze, cols=kolumny, ponawiaj=False)
+        except Exception:
+            try:
+                return harmonogram.wywolaj('sheets', 'odczyt', self.spreadsheet.worksheet, nazwa)
+            except gspread.WorksheetNotFound:
+                pass
+            raise
+
+    def _nowy_shard(self, okres):
+        """Otwiera nowy shard. Stan w pamięci zmienia się dopiero, gdy zakładka i wpis w manifeście już istnieją."""
+        aktywny = self._aktywny()
+
+        nazwa = f"Odbiory_{okres.replace('-', '_')}"
+        istniejace = {s['nazwa'] for s in self.shardy}
+        numer = 2
+        while nazwa in istniejace:
+            nazwa = f"Odbiory_{okres.replace('-', '_')}_{numer}"
+            numer += 1
+
+        naglowek = harmonogram.wywolaj('sheets', 'odczyt', self.arkusz_bazowy.row_values, 1)
+        arkusz = self._zakladka(nazwa, LIMIT_WIERSZY_SHARDU + 10, max(len(naglowek), 5))
+        if naglowek:
+            harmonogram.wywolaj('sheets', 'zapis', arkusz.update, range_name='A1', values=[naglowek])
+
+        # Najpierw wpis nowego sharda: jeśli się nie uda, dotychczasowy zostaje aktywny (zakładka zostanie
+        # użyta przy następnej próbie). Dwa 'aktywne' w manifeście są niegroźne - liczy się nowszy.
+        self.shardy.append({'nazwa': nazwa, 'okres': okres, 'status': 'aktywny', 'wiersze': 0, 'archiwum_id': ''})
+        try:
+            self._zapisz_shard(len(self.shardy) - 1)
+        except Exception:
+            self.shardy.pop()
+            raise
+        self.arkusze[nazwa] = arkusz
+
+        aktywny['status'] = 'zamkniety'
+        aktywny['wiersze'] = max(self.nastepny_wiersz - 2, 0)
+        self.nastepny_wiersz = 2
+        try:
+            self._zapisz_shard(self.shardy.index(aktywny))
+        except Exception as e:
+            logger.error("Nie zapisano zamknięcia sharda '%s' w manifeście: %s", aktywny['nazwa'], e)
+        logger.info("Nowy shard arkusza: '%s' (zamknięto '%s', %s wierszy)",
+                    nazwa, aktywny['nazwa'], aktywny['wiersze'])
+        return arkusz
+
+    # --- archiwum ---
+    def archiwizuj_stare(self, biezacy_okres):
+        """
+        Zamknięte shardy starsze niż ARCHIWIZUJ_PO_MIESIACACH -> CSV.gz na Drive, zakładka usuwana.
+        Uruchamiane w tle (job_queue); _blokada_arkusza tylko na zmianę manifestu, nie na eksport i upload.
+        """
+        rok, miesiac = map(int, biezacy_okres.split('-'))
+        indeks_miesiaca = rok * 12 + miesiac - 1 - ARCHIWIZUJ_PO_MIESIACACH
+        granica = f"{indeks_miesiaca // 12:04d}-{indeks_miesiaca % 12 + 1:02d}"
+
+        harmonogram.pod_blokada(_blokada_arkusza, self._wczytaj)
+        with _blokada_arkusza:
+            shardy = list(enumerate(self.shardy))
+
+        for indeks, shard in shardy:
+            # Zakładka bazowa (bez okresu) zostaje - to ręcznie prowadzona historia sprzed shardów
+            if shard['status'] != 'zamkniety' or not shard['okres'] or shard['okres'] >= granica:
+                continue
+
+            arkusz = self._arkusz(shard['nazwa'])
+            bufor = io.BytesIO()
+            with gzip.GzipFile(fileobj=bufor, mode='wb') as gz:
+                tekst = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+                csv.writer(tekst).writerows(harmonogram.wywolaj('sheets', 'odczyt', arkusz.get_all_values))
+                tekst.flush()
+                tekst.detach()
+            bufor.seek(0)
+
+            rodzic = g_drive_main_folder_id or 'root'
+            folder = _znajdz_folder_drive(G_DRIVE_ARCHIWUM_FOLDER_NAME, rodzic)
+            if folder:
+                folder_id = folder[0]['id']
+            else:
+                # Po 5xx nie ponawiamy - następne uruchomienie najpierw poszuka folderu
+                folder_id = harmonogram.wywolaj('drive', 'zapis', drive_service.files().create(
+                    body={'name': G_DRIVE_ARCHIWUM_FOLDER_NAME, 'mimeType': 'application/vnd.google-apps.folder',
+                          'parents': [rodzic]},
+                    fields='id'
+                ).execute, idempotentne=False)['id']
+            plik = harmonogram.wywolaj('drive', 'zapis', drive_service.files().create(
+                body={'name': f"{shard['nazwa']}.csv.gz", 'parents': [folder_id]},
+                media_body=MediaIoBaseUpload(bufor, mimetype='application/gzip'),
+                fields='id'
+            ).execute, idempotentne=False)
+
+            harmonogram.pod_blokada(_blokada_arkusza, self._oznacz_zarchiwizowany, indeks, arkusz, plik['id'])
+            logger.info("Zarchiwizowano shard '%s' (%s wierszy) jako %s", shard['nazwa'], shard['wiersze'], plik['id'])
+
+    def _oznacz_zarchiwizowany(self, indeks, arkusz, archiwum_id):
+        """Usuwa zakładkę i wpisuje archiwum do manifestu; przy powtórce po 5xx zakładki może już nie być."""
+        shard = self.shardy[indeks]
+        if any(a.id == arkusz.id for a in harmonogram.wywolaj('sheets', 'odczyt', self.spreadsheet.worksheets)):
+            harmonogram.wywolaj('sheets', 'zapis', self.spreadsheet.del_worksheet, arkusz)
+        self.arkusze.pop(shard['nazwa'], None)
+        shard['status'] = 'archiwum'
+        shard['archiwum_id'] = archiwum_id
+        self._zapisz_shard(indeks)
+
+    def _wiersze_archiwum(self, shard) -> list:
+        bufor = io.BytesIO()
+        pobieranie = MediaIoBaseDownload(bufor, drive_service.files().get_media(fileId=shard['archiwum_id']))
+        zakonczone = False
+        while not zakonczone:
+            _, zakonczone = harmonogram.wywolaj('drive', 'odczyt', pobieranie.next_chunk)
+        wszystkie = list(csv.reader(io.StringIO(gzip.decompress(bufor.getvalue()).decode('utf-8'))))[1:]
+
+        indeksy = [gspread.utils.a1_to_rowcol(f"{kolumna}1")[1] - 1
+                   for kolumna in (KOLUMNA_DATA, KOLUMNA_LOKAL, KOLUMNA_USTERKA, KOLUMNA_PODMIOT)]
+        klucze = ['data', 'numer_lokalu_budynku', 'rodzaj_usterki', 'podmiot_odpowiedzialny']
+        return [{klucz: (wiersz[i] if i < len(wiersz) else '') for klucz, i in zip(klucze, indeksy)}
+                for wiersz in wszystkie if any(wiersz)]
+
+    # --- odczyt przez wszystkie shardy ---
+    def ostatnie_wiersze(self, limit: int, z_archiwum=False) -> list:
+        """Ostatnie `limit` wierszy, idąc od najnowszego sharda wstecz. Archiwa tylko na wyraźne życzenie."""
+        return harmonogram.pod_blokada(_blokada_arkusza, self._ostatnie_wiersze, limit, z_archiwum)
+
+    def _ostatnie_wiersze(self, limit, z_archiwum):
+        self._wczytaj()
+        wynik = []
+        for shard in reversed(self.shardy):
+            pozostalo = limit - len(wynik)
+            if pozostalo <= 0:
+                break
+            if shard['status'] == 'archiwum':
+                if z_archiwum:
+                    wynik = self._wiersze_archiwum(shard)[-pozostalo:] + wynik
+                continue
+
+            arkusz = self._arkusz(shard['nazwa'])
+            if shard['status'] == 'aktywny':
+                if self.nastepny_wiersz is None:
+                    self.nastepny_wiersz = len(harmonogram.wywolaj('sheets', 'odczyt', arkusz.col_values, NUMER_KOLUMNY_KLUCZOWEJ)) + 1
+                liczba_wierszy = self.nastepny_wiersz - 1
+            elif shard['okres']:
+                liczba_wierszy = shard['wiersze'] + 1
+            else:
+                liczba_wierszy = len(harmonogram.wywolaj('sheets', 'odczyt', arkusz.col_values, NUMER_KOLUMNY_KLUCZOWEJ))
+            wynik = _ostatnie_wiersze_arkusza(arkusz, liczba_wierszy, pozostalo) + wynik
+        return wynik
+
+
+shardy_arkusza = ShardyArkusza(spreadsheet, worksheet) if (SHARDY_ARKUSZA and worksheet is not None) else None
+INTERWAL_ARCHIWIZACJI_SHARDOW = 24 * 3600
+
+
+async def archiwizuj_shardy(context: ContextTypes.DEFAULT_TYPE):
+    """Zadanie cykliczne (job_queue): archiwizacja starych shardów poza zapisem odbioru użytkownika."""
+    try:
+        with w_tle():
+            await asyncio.to_thread(shardy_arkusza.archiwizuj_stare, datetime.now().strftime('%Y-%m'))
+    except Exception as e:
+        logger.error("Błąd archiwizacji starych shardów: %s", e)
+
+
+# --- FUNKCJA WYSYŁANIA NA GOOGLE DRIVE ---
+# Nazwa folderu lokalu -> ID na Drive (foldery nie znikają, więc każdy szukamy tylko raz)
+_cache_folderow_drive = {}
+
+
+@profilowane
+def _znajdz_folder_drive(target_name, parent_folder_id):
+    """Szuka podfolderu o podanej nazwie w folderze nadrzędnym. Zwraca listę pasujących folderów."""
+    q_str = f"name='{target_name}' and mimeType='application/vnd.google-apps.folder' and '{parent_folder_id}' in parents and trashed=False"
+
+    response = harmonogram.wywolaj('drive', 'odczyt', drive_service.files().list(
+        q=q_str,
+        spaces='drive',
+        fields='files(id, name)',
+    ).execute)
+
+    return response.get('files', [])
+
+
+def _folder_docelowy_drive(target_name):
+    """Zwraca (ID folderu lokalu/szeregu, None), w razie potrzeby go tworząc, albo (None, opis błędu)."""
+    parent_folder_id = g_drive_main_folder_id
+
+    target_folder_id = _cache_folderow_drive.get(target_name)
+    if target_folder_id:
+        return target_folder_id, None
+
+    target_folder = _znajdz_folder_drive(target_name, parent_folder_id)
+    if not target_folder:
+        logger.warning("Nie znaleziono folderu '%s'. Tworzenie nowego...", target_name)
+        try:
+            folder_metadata = {
+                'name': target_name,
+                'mimeType': 'application/vnd.google-apps.folder',
+                'parents': [parent_folder_id]
+            }
+            # Po 5xx nie ponawiamy (folder mógł już powstać) - folder nie trafia do cache, więc następne
+            # wywołanie najpierw go poszuka
+            created_folder = harmonogram.wywolaj('drive', 'zapis', drive_service.files().create(body=folder_metadata, fields='id').execute,
+                                                 idempotentne=False)
+            target_folder_id = created_folder.get('id')
+            logger.info("Pomyślnie utworzono folder '%s' (ID: %s)", target_name, target_folder_id)
+        except Exception as e:
+            logger.error("KRYTYCZNY BŁĄD: Nie można utworzyć folderu na Drive: %s", e)
+            return None, f"Błąd tworzenia folderu na Drive: {e}"
+    else:
+        target_folder_id = target_folder[0].get('id')
+    _cache_folderow_drive[target_name] = target_folder_id
+    return target_folder_id, None
+
+
+@profilowane
+def upload_photo_to_drive(file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal'):
+    """Wyszukuje podfolder (lokalu lub szeregu) i wysyła do niego zdjęcie."""
+    global drive_service, g_drive_main_folder_id, G_DRIVE_MAIN_FOLDER_NAME
+    
+    try:
+        target_folder_id, blad = _folder_docelowy_drive(target_name)
+        if not target_folder_id:
+            return False, blad, None
+
+        file_name = f"{usterka_name} - {podmiot_name}.jpg"
+        file_metadata = {
+            'name': file_name,
+            'parents': [target_folder_id]
+        }
         
-        logger.info(f"Pomyślnie zapisano dane w wierszu {pierwszy_wolny_wiersz}")
-        return True
+        file_bytes.seek(0)
+        media = MediaIoBaseUpload(file_bytes, mimetype='image/jpeg', resumable=True)
+        
+        file = harmonogram.wywolaj('drive', 'zapis', drive_service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id',
+        ).execute, idempotentne=False)
+        
+        file_id = file.get('id')
+        logger.info("Pomyślnie wysłano plik '%s' do folderu '%s' (ID: %s)", file_name, target_name, file_id)
+        return True, file_name, file_id
+    
+    except Exception as e:
+        logger.error("Błąd podczas wysyłania na Google Drive: %s", e)
+        return False, str(e), None
+
+
+# --- Wysyłanie dużych plików (wideo, zdjęcia jako dokument) kawałkami, z wznawianiem ---
+# Wielokrotność 256 KiB (wymóg Drive); po każdym fragmencie raportujemy postęp
+ROZMIAR_FRAGMENTU_UPLOADU = int(os.getenv('ROZMIAR_FRAGMENTU_UPLOADU_MB', 8)) * 1024 * 1024
+MAKS_PROB_FRAGMENTU = 6
+
+
+def _dokoncz_sesje_drive(uri, sciezka, rozmiar, file_name, postep=None):
+    """
+    Kończy sesję resumable z poprzedniego uruchomienia zwykłymi PUT-ami na jej URI:
+    `Content-Range: bytes */<rozmiar>` pyta o potwierdzony zakres, dalej idą fragmenty od tego miejsca.
+    Zwraca metadane pliku albo None, gdy sesja wygasła.
+    """
+    sesja = AuthorizedSession(creds)
+    wyslane = None  # None -> najpierw pytamy serwer, ile już ma
+    proby = 0
+    with open(sciezka, 'rb') as plik:
+        while True:
+            try:
+                if wyslane is None:
+                    odpowiedz = harmonogram.wywolaj('drive', 'zapis', sesja.put, uri, ponawiaj=False,
+                                                    headers={'Content-Range': f'bytes */{rozmiar}'}, timeout=60)
+                else:
+                    plik.seek(wyslane)
+                    dane = plik.read(ROZMIAR_FRAGMENTU_UPLOADU)
+                    zakres = f'bytes {wyslane}-{wyslane + len(dane) - 1}/{rozmiar}'
+                    odpowiedz = harmonogram.wywolaj('drive', 'zapis', sesja.put, uri, ponawiaj=False, data=dane,
+                                                    headers={'Content-Range': zakres}, timeout=300)
+            except OSError as e:
+                przyczyna = e
+            else:
+                if odpowiedz.status_code in (200, 201):
+                    return odpowiedz.json()
+                if odpowiedz.status_code in (404, 410):
+                    return None
+                if odpowiedz.status_code == 308:
+                    # Range: bytes=0-N -> serwer ma N+1 bajtów; brak nagłówka -> nic jeszcze nie dotarło
+                    potwierdzone = odpowiedz.headers.get('Range')
+                    wyslane = int(potwierdzone.rsplit('-', 1)[1]) + 1 if potwierdzone else 0
+                    proby = 0
+                    if postep:
+                        postep(wyslane, rozmiar, uri)
+                    continue
+                if odpowiedz.status_code < 500 and odpowiedz.status_code != 429:
+                    raise RuntimeError(f"Drive odrzucił wznowienie: HTTP {odpowiedz.status_code} {odpowiedz.text[:200]}")
+                przyczyna = f"HTTP {odpowiedz.status_code}"
+
+            wyslane = None
+            proby += 1
+            if proby > MAKS_PROB_FRAGMENTU:
+                raise RuntimeError(f"wznawianie przerwane {MAKS_PROB_FRAGMENTU} razy z rzędu: {przyczyna}")
+            logger.warning("Przerwane wznawianie '%s' (%s) - ponowienie %s/%s",
+                           file_name, przyczyna, proby, MAKS_PROB_FRAGMENTU)
+            time.sleep(min(2 ** proby, 60))
+
+
+@profilowane
+def upload_large_file_to_drive(sciezka, target_name, usterka_name, podmiot_name, mimetype, rozszerzenie,
+                               postep=None, wznowienie=None):
+    """
+    Wysyła plik z dysku sesją resumable Drive po ROZMIAR_FRAGMENTU_UPLOADU.
+    Błąd sieci/5xx przy fragmencie -> ponowienie od miejsca, które potwierdził serwer.
+    `wznowienie` to resumable_uri z poprzedniego uruchomienia; `postep(wyslane, rozmiar, resumable_uri)` po każdym fragmencie.
+    """
+    try:
+        target_folder_id, blad = _folder_docelowy_drive(target_name)
+        if not target_folder_id:
+            return False, blad, None
+
+        file_name = f"{usterka_name} - {podmiot_name}{rozszerzenie}"
+        rozmiar = os.path.getsize(sciezka)
+
+        def nowe_zadanie():
+            media = MediaFileUpload(sciezka, mimetype=mimetype, chunksize=ROZMIAR_FRAGMENTU_UPLOADU, resumable=True)
+            return drive_service.files().create(
+                body={'name': file_name, 'parents': [target_folder_id]},
+                media_body=media,
+                fields='id',
+            )
+
+        odpowiedz = None
+        if wznowienie:
+            logger.info("Wznawianie wysyłania '%s' (%.1f MB)", file_name, rozmiar / 1024 / 1024)
+            odpowiedz = _dokoncz_sesje_drive(wznowienie, sciezka, rozmiar, file_name, postep)
+            if odpowiedz is None:
+                logger.warning("Sesja wysyłania '%s' wygasła - wysyłanie od początku", file_name)
+
+        zadanie = nowe_zadanie()
+        proby = 0
+        while odpowiedz is None:
+            try:
+                # Ponowienia robi ta pętla (od potwierdzonego miejsca), harmonogram tylko pilnuje limitu
+                status, odpowiedz = harmonogram.wywolaj('drive', 'zapis', zadanie.next_chunk, ponawiaj=False)
+            except HttpError as e:
+                if e.resp.status == 404 and zadanie.resumable_uri:
+                    # Sesja wygasła (Drive trzyma ją ok. tygodnia) - zaczynamy od zera
+                    logger.warning("Sesja wysyłania '%s' wygasła - wysyłanie od początku", file_name)
+                    zadanie = nowe_zadanie()
+                    continue
+                if e.resp.status < 500 and e.resp.status != 429:
+                    raise
+                przyczyna = e
+            except OSError as e:
+                przyczyna = e
+            else:
+                proby = 0
+                if postep:
+                    postep(status.resumable_progress if status else rozmiar, rozmiar, zadanie.resumable_uri)
+                continue
+
+            proby += 1
+            if proby > MAKS_PROB_FRAGMENTU:
+                raise RuntimeError(f"wysyłanie przerwane {MAKS_PROB_FRAGMENTU} razy z rzędu: {przyczyna}")
+            logger.warning("Przerwane wysyłanie '%s' (%s) - ponowienie %s/%s",
+                           file_name, przyczyna, proby, MAKS_PROB_FRAGMENTU)
+            time.sleep(min(2 ** proby, 60))
+
+        file_id = odpowiedz.get('id')
+        logger.info("Pomyślnie wysłano plik '%s' (%.1f MB) do folderu '%s' (ID: %s)",
+                    file_name, rozmiar / 1024 / 1024, target_name, file_id)
+        return True, file_name, file_id
+
+    except Exception as e:
+        logger.error("Błąd podczas wysyłania dużego pliku na Google Drive: %s", e)
+        return False, str(e), None
+
+
+# --- Funkcja do usuwania pliku z Google Drive ---
+@profilowane
+def delete_file_from_drive(file_id):
+    """Usuwa plik z Google Drive na podstawie jego ID."""
+    global drive_service
+    if not file_id:
+        logger.warning("Próba usunięcia pliku, ale brak file_id.")
+        return False, "Brak ID pliku"
+        
+    try:
+        harmonogram.wywolaj('drive', 'zapis', drive_service.files().delete(fileId=file_id).execute)
+        logger.info("Pomyślnie usunięto plik z Drive (ID: %s)", file_id)
+        return True, None
+    except Exception as e:
+        logger.error("Błąd podczas usuwania pliku %s z Drive: %s", file_id, e)
+        return False, str(e)
+
+
+@profilowane
+def delete_files_from_drive(file_ids):
+    """Usuwa wiele plików z Drive zapytaniami zbiorczymi (batch, do 100 na żądanie). Zwraca {file_id: błąd lub None}."""
+    wyniki = {}
+
+    def po_usunieciu(request_id, response, exception):
+        wyniki[request_id] = exception
+
+    file_ids = [file_id for file_id in file_ids if file_id]
+    do_usuniecia = file_ids
+    for proba in range(MAKS_PONOWIEN_GOOGLE + 1):
+        for i in range(0, len(do_usuniecia), 100):
+            fragment = do_usuniecia[i:i + 100]
+            batch = drive_service.new_batch_http_request(callback=po_usunieciu)
+            for file_id in fragment:
+                batch.add(drive_service.files().delete(fileId=file_id), request_id=file_id)
+            try:
+                # Każde zapytanie w paczce liczy się do limitu osobno
+                harmonogram.wywolaj('drive', 'zapis', batch.execute, koszt=len(fragment))
+            except Exception as e:
+                logger.error("Błąd zbiorczego usuwania z Drive: %s", e)
+                for file_id in fragment:
+                    wyniki.setdefault(file_id, e)
+
+        # 429/5xx pojedynczych zapytań w paczce - jeszcze raz tylko te pliki
+        do_usuniecia = [file_id for file_id in do_usuniecia
+                        if wyniki.get(file_id) is not None and czy_ponowic_google(wyniki[file_id])]
+        if not do_usuniecia or proba == MAKS_PONOWIEN_GOOGLE:
+            break
+        for file_id in do_usuniecia:
+            del wyniki[file_id]
+        time.sleep(random.uniform(0, min(60, 2 ** (proba + 1))))
+
+    wyniki = {file_id: (str(blad) if blad else None) for file_id, blad in wyniki.items()}
+
+    logger.info("Usunięto z Drive %s z %s plików", sum(1 for b in wyniki.values() if b is None), len(file_ids))
+    return wyniki
+
+
+# --- 6b. Funkcje do budowania klawiatur dynamicznych ---
+
+def build_szereg_keyboard():
+    """Tworzy klawiaturę wyboru Szeregu (z ZAKRESEM)."""
+    keyboard = []
+    row = []
+    sorted_keys = sorted(DANE_SZEREGOW.keys(), key=lambda x: int(x.split(' ')[1]))
+    
+    for szereg_name in sorted_keys:
+        dane = DANE_SZEREGOW[szereg_name]
+        zakres = dane['zakres']
+        button_text = f"{szereg_name} ({zakres})"
+        
+        row.append(InlineKeyboardButton(button_text, callback_data=f"szereg_{szereg_name}"))
+        if len(row) >= 2:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    
+    keyboard.append([InlineKeyboardButton("<< Anuluj", callback_data="start_menu")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# -----------------------------------------------------------
+# --- 6c. CYKL ŻYCIA: bezpieczne zamykanie i zaległe zapisy ---
+# -----------------------------------------------------------
+# Sesje (chat_data) są trzymane w pliku, żeby restart nie gubił trwającego odbioru.
+PLIK_SESJI = os.getenv('PLIK_SESJI', 'sesje_bota.pickle')
+# Operacje Google, których nie zdążono wykonać przed zamknięciem (jeden JSON w linii).
+PLIK_ZALEGLYCH_ZADAN = os.getenv('PLIK_ZALEGLYCH_ZADAN', 'zalegle_zadania.jsonl')
+# Zadania odłożone na dysk, których wątek mimo to zdążył się wykonać: klucz -> wynik (bez tego replay dubluje zapis)
+PLIK_WYKONANYCH_ZADAN = os.getenv('PLIK_WYKONANYCH_ZADAN', 'wykonane_zadania.jsonl')
+KATALOG_ZALEGLYCH_PLIKOW = os.getenv('KATALOG_ZALEGLYCH_PLIKOW', 'zalegle_pliki')
+# Cloud Run daje 10 s między SIGTERM a SIGKILL - zostawiamy zapas na zapis stanu.
+LIMIT_CZASU_ZAMYKANIA = float(os.getenv('LIMIT_CZASU_ZAMYKANIA', 8))
+
+# Zwracane zamiast wyniku, gdy operacja trafiła do pliku zaległych zadań.
+ODLOZONO = object()
+
+
+class MenedzerCyklu:
+    """
+    Śledzi operacje Google w toku (upload, usuwanie, zapis wiersza).
+    Po SIGTERM przestaje przyjmować aktualizacje, czeka na operacje w toku do LIMIT_CZASU_ZAMYKANIA,
+    a wszystko, czego nie zdążono wykonać, zapisuje na dysk do odtworzenia przy następnym starcie.
+    """
+
+    def __init__(self, plik_zadan, katalog_plikow, limit_czasu, plik_wykonanych):
+        self.plik_zadan = plik_zadan
+        self.katalog_plikow = katalog_plikow
+        self.limit_czasu = limit_czasu
+        self.plik_wykonanych = plik_wykonanych
+        self.blokada = threading.Lock()  # znaczniki _wykonane/_odlozone (wątek roboczy vs. zamykanie)
+        self.w_toku = {}  # asyncio.Task -> opis zadania (dict), który da się odłożyć na dysk
+        self.zamykanie = False
+        self.termin = None
+        self.dokonczone = 0
+        self.odlozone = 0
+
+    def po_terminie(self):
+        return self.termin is not None and time.monotonic() >= self.termin
+
+    @staticmethod
+    def klucz_zadania(zadanie: dict) -> str:
+        """Klucz idempotencji: ten sam zapis zlecony ponownie (np. przy odtwarzaniu) ma ten sam klucz."""
+        typ = zadanie.get('typ')
+        if typ == 'usterki':
+            dane = zadanie['dane']
+            odbior = next((d.get('odbior_id') for d in dane if d.get('odbior_id')), '')
+            skrot = hashlib.sha256(json.dumps(dane, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+            return f"usterki:{odbior}:{skrot}"
+        if typ in ('zdjecie', 'duzy_plik'):
+            return f"{typ}:{zadanie.get('odbiur')}:{zadanie['usterka_id']}"
+        return f"{typ}:{zadanie.get('file_id')}"
+
+    def _w_watku(self, zadanie, funkcja, *args, **kwargs):
+        wynik = funkcja(*args, **kwargs)
+        with self.blokada:
+            zadanie['_wykonane'], zadanie['_wynik'] = True, wynik
+            odlozone = zadanie.get('_odlozone')
+        if odlozone:
+            # Zamykanie odłożyło już to zadanie na dysk - odtworzenie nie może go powtórzyć
+            self._zapisz_wykonane(zadanie['klucz'], wynik)
+        return wynik
+
+    def _zapisz_wykonane(self, klucz, wynik):
+        try:
+            with open(self.plik_wykonanych, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'klucz': klucz, 'wynik': wynik}, ensure_ascii=False) + '\n')
+        except Exception as e:
+            logger.critical("Nie można zapisać wykonania zadania %s: %s", klucz, e)
+
+    def _wczytaj_wykonane(self) -> dict:
+        if not os.path.exists(self.plik_wykonanych):
+            return {}
+        return {wpis['klucz']: wpis['wynik'] for wpis in self._wczytaj_jsonl(self.plik_wykonanych)}
+
+    @staticmethod
+    def _wczytaj_jsonl(sciezka) -> list:
+        with open(sciezka, 'r', encoding='utf-8') as f:
+            return [json.loads(linia) for linia in f if linia.strip()]
+
+    @staticmethod
+    def _zapisz_jsonl(sciezka, wpisy):
+        """Zapis atomowy (plik tymczasowy + os.replace): przerwany proces nie zostawi połowy pliku."""
+        tymczasowy = sciezka + '.tmp'
+        with open(tymczasowy, 'w', encoding='utf-8') as f:
+            for wpis in wpisy:
+                f.write(json.dumps(wpis, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tymczasowy, sciezka)
+
+    async def wykonaj(self, zadanie: dict, funkcja, *args, **kwargs):
+        """
+        Uruchamia blokującą funkcję Google w wątku (nie blokuje pętli zdarzeń) i śledzi ją do zamknięcia.
+        Po upływie limitu czasu zamykania funkcja nie jest już wywoływana - zadanie trafia na dysk, a wynik to ODLOZONO.
+        """
+        zadanie.setdefault('klucz', self.klucz_zadania(zadanie))
+        if self.po_terminie():
+            self.odloz(zadanie)
+            return ODLOZONO
+
+        task = asyncio.ensure_future(asyncio.to_thread(self._w_watku, zadanie, funkcja, *args, **kwargs))
+        self.w_toku[task] = zadanie
+        task.add_done_callback(self._zakonczono)
+        # shield: anulowanie handlera nie przerywa uploadu/zapisu w połowie
+        return await asyncio.shield(task)
+
+    def _zakonczono(self, task):
+        if self.w_toku.pop(task, None) is not None and self.zamykanie:
+            self.dokonczone += 1
+
+    def odloz(self, zadanie: dict):
+        """Dopisuje zadanie do pliku zaległych zadań (zawartość pliku w pamięci ląduje w osobnym pliku)."""
+        zadanie = {klucz: wartosc for klucz, wartosc in zadanie.items() if not klucz.startswith('_')}
+        zadanie.setdefault('slad_odbioru', _slad_odbioru.get())  # ślad przetrwa restart
+        plik = zadanie.pop('plik', None)
+        try:
+            if plik is not None:
+                os.makedirs(self.katalog_plikow, exist_ok=True)
+                sciezka = os.path.join(self.katalog_plikow, f"{uuid.uuid4()}.bin")
+                with open(sciezka, 'wb') as f:
+                    f.write(plik.getvalue())
+                zadanie['sciezka_pliku'] = sciezka
+
+            with open(self.plik_zadan, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(zadanie, ensure_ascii=False) + '\n')
+            self.odlozone += 1
+            logger.warning("Odłożono zadanie '%s' do wykonania po restarcie.", zadanie.get('typ'))
+        except Exception as e:
+            logger.critical("Nie można odłożyć zadania na dysk (%s): %s", zadanie.get('typ'), e)
+
+    async def zamknij(self, application: Application):
+        """Obsługa SIGTERM: stop webhooka, opróżnienie operacji w toku, zapis reszty i sesji na dysk."""
+        if self.zamykanie:
+            return
+        self.zamykanie = True
+        logger.info("Otrzymano sygnał zamknięcia. Wstrzymuję przyjmowanie nowych aktualizacji...")
+
+        # Telegram nie dostanie potwierdzenia, więc nowe aktualizacje dostarczy ponownie do nowej instancji
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+
+        self.termin = time.monotonic() + self.limit_czasu
+
+        # Handlery w toku mogą jeszcze zlecać kolejne operacje (np. pętla zapisu odbioru) - czekamy aż ucichną
+        while not self.po_terminie():
+            if not self.w_toku:
+                await asyncio.sleep(0.5)
+                if not self.w_toku:
+                    break
+                continue
+            pozostalo = max(self.termin - time.monotonic(), 0)
+            await asyncio.wait(list(self.w_toku), timeout=pozostalo, return_when=asyncio.FIRST_COMPLETED)
+
+        # Od teraz wykonaj() nie uruchamia już nic nowego
+        self.termin = time.monotonic()
+        for task, zadanie in list(self.w_toku.items()):
+            # Wątku nie da się przerwać. Jeśli zdąży (lub już zdążył, a handler nie), zapisze wynik
+            # w pliku wykonanych, a odtworzenie użyje go zamiast powtarzać zapis.
+            self.w_toku.pop(task, None)
+            with self.blokada:
+                zadanie['_odlozone'] = True
+                wykonane = zadanie.get('_wykonane')
+            if wykonane:
+                self._zapisz_wykonane(zadanie['klucz'], zadanie['_wynik'])
+            self.odloz(zadanie)
+
+        try:
+            await application.update_persistence()
+        except Exception as e:
+            logger.error("Nie można zapisać sesji na dysk: %s", e)
+
+        logger.info("Zamykanie: dokończono %s operacji Google, odłożono %s do wykonania po restarcie.",
+                    self.dokonczone, self.odlozone)
+        application.stop_running()
+
+    async def odtworz(self, application: Application):
+        """
+        Przy starcie wykonuje zadania odłożone podczas poprzedniego zamknięcia.
+        Dziennik jest najpierw przenoszony do <plik>.w_toku i po każdym zadaniu przepisywany z tym, co zostało,
+        więc odtwarzanie przerwane przez awarię dokończy następny start. Nieudane wracają do zwykłego dziennika.
+        """
+        w_toku = self.plik_zadan + '.w_toku'
+        if not os.path.exists(w_toku):
+            if not os.path.exists(self.plik_zadan):
+                return
+            os.replace(self.plik_zadan, w_toku)
+        zadania = self._wczytaj_jsonl(w_toku)
+        if os.path.exists(self.plik_zadan):
+            # Poprzednie odtwarzanie się przerwało: jego nieudane zadania są już w zwykłym dzienniku.
+            # Ten sam klucz dwa razy = to samo zadanie (awaria między przepisaniem obu plików).
+            unikalne, klucze = [], set()
+            for zadanie in zadania + self._wczytaj_jsonl(self.plik_zadan):
+                klucz = zadanie.get('klucz')
+                if klucz is None or klucz not in klucze:
+                    klucze.add(klucz)
+                    unikalne.append(zadanie)
+            zadania = unikalne
+            self._zapisz_jsonl(w_toku, zadania)
+            os.remove(self.plik_zadan)
+        wykonane = self._wczytaj_wykonane()
+
+        logger.info("Odtwarzanie %s zaległych zadań z poprzedniego uruchomienia (%s już wykonanych)...",
+                    len(zadania), sum(1 for zadanie in zadania if zadanie.get('klucz') in wykonane))
+        nieudane = []
+        for indeks, zadanie in enumerate(zadania):
+            try:
+                with w_tle(), slad(odbior=zadanie.get('slad_odbioru')):
+                    ok = await self._odtworz_zadanie(application, zadanie, wykonane.get(zadanie.get('klucz')))
+            except Exception as e:
+                logger.error("Błąd przy odtwarzaniu zadania '%s': %s", zadanie.get('typ'), e)
+                ok = False
+
+            if ok:
+                sciezka = zadanie.get('sciezka_pliku')
+                if sciezka and os.path.exists(sciezka):
+                    os.remove(sciezka)
+            else:
+                nieudane.append(zadanie.get('klucz'))
+                with open(self.plik_zadan, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(zadanie, ensure_ascii=False) + '\n')
+            self._zapisz_jsonl(w_toku, zadania[indeks + 1:])
+
+        # Wyniki zostają tylko dla zadań, które wróciły do pliku zaległych; .w_toku znika na samym końcu
+        self._zapisz_jsonl(self.plik_wykonanych,
+                           [{'klucz': klucz, 'wynik': wykonane[klucz]} for klucz in set(nieudane) & wykonane.keys()])
+        os.remove(w_toku)
+
+        logger.info("Odtworzono %s z %s zaległych zadań.", len(zadania) - len(nieudane), len(zadania))
+
+    async def _odtworz_zadanie(self, application: Application, zadanie: dict, wykonane=None) -> bool:
+        """wykonane: wynik zapisany przez wątek, który dokończył zadanie już po odłożeniu go na dysk."""
+        typ = zadanie.get('typ')
+
+        if typ == 'usterki':
+            if wykonane == len(zadanie['dane']):
+                return True  # wiersze trafiły do arkusza przed wyjściem procesu
+            data = datetime.fromisoformat(zadanie['data'])
+            return await asyncio.to_thread(magazyn.zapisz_usterki, zadanie['dane'], data) == len(zadanie['dane'])
+
+        if typ == 'usun':
+            if wykonane and wykonane[0]:
+                return True
+            ok, _ = await asyncio.to_thread(magazyn.usun_plik, zadanie['file_id'])
+            return ok
+
+        if typ in ('zdjecie', 'duzy_plik'):
+            chat_data = menedzer_sesji.przywroc(application, zadanie['chat_id'])
+            wpisy = chat_data.get('odbiur_wpisy', [])
+            if any(w.get('id') == zadanie['usterka_id'] for w in wpisy):
+                return True  # upload zdążył się zakończyć przed zamknięciem
+
+            if wykonane and wykonane[0]:
+                success, file_id = True, wykonane[2]  # plik jest już w magazynie - bez ponownego uploadu
+            elif typ == 'duzy_plik':
+                # Drive kontynuuje od ostatniego potwierdzonego fragmentu (resumable_uri z chwili zamknięcia)
+                success, _, file_id = await asyncio.to_thread(
+                    magazyn.zapisz_duzy_plik, zadanie['sciezka_pliku'], zadanie['target'], zadanie['usterka'],
+                    zadanie['podmiot'], zadanie.get('tryb', 'lokal'), zadanie['mimetype'], zadanie['rozszerzenie'],
+                    wznowienie=zadanie.get('resumable_uri')
+                )
+            else:
+                with open(zadanie['sciezka_pliku'], 'rb') as f:
+                    file_bytes_io = io.BytesIO(f.read())
+                success, _, file_id = await asyncio.to_thread(
+                    magazyn.zapisz_zdjecie, file_bytes_io, zadanie['target'], zadanie['usterka'],
+                    zadanie['podmiot'], zadanie.get('tryb', 'lokal')
+                )
+            if not success:
+                return False
+
+            nowy_wpis = {'id': zadanie['usterka_id'], 'typ': zadanie.get('rodzaj', 'zdjecie'), 'opis': zadanie['opis'],
+                         'file_id': file_id}
+            if chat_data.get('odbiur_aktywny') and chat_data.get('odbiur_identyfikator') == zadanie['odbiur']:
+                wpisy.append(nowy_wpis)
+                return True
+
+            # Odbiór już zamknięty - usterka idzie od razu do arkusza
+            lokal, _, usterka = zadanie['opis'].partition(' - ')
+            dane_json = {
+                "numer_lokalu_budynku": lokal,
+                "rodzaj_usterki": usterka,
+                "podmiot_odpowiedzialny": zadanie['podmiot'],
+                "link_do_zdjecia": magazyn.link_do_pliku(file_id),
+                "file_id": file_id
+            }
+            return await asyncio.to_thread(magazyn.zapisz_usterke, dane_json, datetime.now())
+
+        logger.error("Nieznany typ zaległego zadania: %s", typ)
+        return True
+
+
+menedzer_cyklu = MenedzerCyklu(PLIK_ZALEGLYCH_ZADAN, KATALOG_ZALEGLYCH_PLIKOW, LIMIT_CZASU_ZAMYKANIA,
+                               PLIK_WYKONANYCH_ZADAN)
+
+
+# --- 6c2. Odporność na ponowne dostarczenie aktualizacji przez Telegram ---
+PLIK_PRZETWORZONYCH_AKTUALIZACJI = os.getenv('PLIK_PRZETWORZONYCH_AKTUALIZACJI', 'przetworzone_aktualizacje.json')
+ROZMIAR_OKNA_DEDUPLIKACJI = int(os.getenv('ROZMIAR_OKNA_DEDUPLIKACJI', 5000))
+# Ile aktualizacji (z różnych czatów) może być przetwarzanych jednocześnie
+MAKS_ROWNOLEGLYCH_AKTUALIZACJI = int(os.getenv('MAKS_ROWNOLEGLYCH_AKTUALIZACJI', 64))
+
+
+class OknoDeduplikacji:
+    """
+    Ograniczone okno ostatnio widzianych aktualizacji: update_id oraz (czat, id wiadomości).
+    Zapisywane na dysk co najwyżej raz na 30 s i przy zamknięciu, więc działa też po restarcie.
+    """
+
+    def __init__(self, plik, rozmiar):
+        self.plik = plik
+        self.rozmiar = rozmiar
+        self.klucze = OrderedDict()
+        self.zmienione = False
+        self.ostatni_zapis = time.monotonic()
+
+    @staticmethod
+    def klucze_aktualizacji(update) -> list:
+        klucze = [f"u:{update.update_id}"]
+        if update.message:
+            klucze.append(f"m:{update.message.chat_id}:{update.message.message_id}")
+        if update.callback_query:
+            klucze.append(f"c:{update.callback_query.id}")
+        return klucze
+
+    def czy_duplikat(self, update) -> bool:
+        """Sprawdza i jednocześnie zapamiętuje aktualizację."""
+        klucze = self.klucze_aktualizacji(update)
+        if any(klucz in self.klucze for klucz in klucze):
+            return True
+
+        for klucz in klucze:
+            self.klucze[klucz] = None
+        while len(self.klucze) > self.rozmiar:
+            self.klucze.popitem(last=False)
+        self.zmienione = True
+        if time.monotonic() - self.ostatni_zapis > 30:
+            self.zapisz()
+        return False
+
+    def wczytaj(self):
+        try:
+            with open(self.plik, 'r', encoding='utf-8') as f:
+                self.klucze = OrderedDict.fromkeys(json.load(f)[-self.rozmiar:])
+            logger.info("Wczytano okno deduplikacji: %s kluczy", len(self.klucze))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("Nie można wczytać okna deduplikacji: %s", e)
+
+    def zapisz(self):
+        self.ostatni_zapis = time.monotonic()
+        if not self.zmienione:
+            return
+        try:
+            tymczasowy = f"{self.plik}.tmp"
+            with open(tymczasowy, 'w', encoding='utf-8') as f:
+                json.dump(list(self.klucze), f)
+            os.replace(tymczasowy, self.plik)
+            self.zmienione = False
+        except Exception as e:
+            logger.error("Nie można zapisać okna deduplikacji: %s", e)
+
+
+class KolejkaPerCzat(BaseUpdateProcessor):
+    """
+    Webhook od razu potwierdza odbiór, a aktualizacje są przetwarzane w tle: różne czaty równolegle,
+    jeden czat po kolei (kolejność "wybór lokalu -> usterka" musi zostać zachowana).
+    Powtórzone przez Telegram aktualizacje są odrzucane, zanim dotrą do handlerów (Drive, arkusz).
+    """
+
+    def __init__(self, max_concurrent_updates, okno: OknoDeduplikacji):
+        super().__init__(max_concurrent_updates)
+        self.okno = okno
+        # Blokada znika sama, gdy nikt na nią nie czeka ani jej nie trzyma
+        self.blokady_czatow = weakref.WeakValueDictionary()
+
+    async def process_update(self, update, coroutine):
+        # Najpierw kolejka czatu, dopiero potem globalny slot: czat zasypujący bota aktualizacjami (np. album
+        # 50 zdjęć) czeka we własnej kolejce, zamiast zająć wszystkie MAKS_ROWNOLEGLYCH_AKTUALIZACJI slotów.
+        if isinstance(update, Update) and update.effective_chat:
+            async with self.blokada_czatu(update.effective_chat.id):
+                await super().process_update(update, coroutine)
+            return
+        await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            # Każda aktualizacja ma własne zadanie asyncio, więc ślad nie przecieka między czatami
+            _slad_aktualizacji.set(update.update_id)
+            if self.okno.czy_duplikat(update):
+                logger.info("Pominięto ponownie dostarczoną aktualizację %s", update.update_id)
+                coroutine.close()
+                return
+
+        await coroutine
+
+    def blokada_czatu(self, chat_id) -> asyncio.Lock:
+        """Blokada kolejki czatu - także dla zadań spoza aktualizacji (np. automatyczne zakończenie odbioru)."""
+        return self.blokady_czatow.setdefault(chat_id, asyncio.Lock())
+
+    async def initialize(self):
+        self.okno.wczytaj()
+
+    async def shutdown(self):
+        self.okno.zapisz()
+
+
+# --- 6d. Zapis całego odbioru do arkusza ---
+async def zapisz_odbior(chat_data, message_time: datetime, czekaj_na_transkrypcje=True):
+    """
+    Zapisuje wszystkie usterki z sesji w arkuszu. Zwraca (zapisane, odlozone) albo None, gdy notatki są w toku.
+    czekaj_na_transkrypcje=False: bez czekania - dla zadań w tle, które trzymają blokadę czatu.
+    """
+    limit = CZAS_OCZEKIWANIA_NA_TRANSKRYPCJE if czekaj_na_transkrypcje else 0
+    if not await kolejka_transkrypcji.poczekaj_na(chat_data, limit):
+        return None
+    identyfikator_odbioru = chat_data.get('odbiur_identyfikator', 'Brak ID Odbioru')
+    podmiot = chat_data.get('odbiur_podmiot')
+    wpisy_lista = chat_data.get('odbiur_wpisy', [])
+
+    logger.info("Zapisywanie %s usterek dla %s...", len(wpisy_lista), identyfikator_odbioru)
+    lista_danych = []
+
+    for wpis in wpisy_lista:
+        opis_caly = wpis.get('opis', 'BŁĄD WPISU')
+
+        lokal_dla_wpisu = identyfikator_odbioru
+        usterka_dla_wpisu = opis_caly
+
+        if ' - ' in opis_caly:
+            parts = opis_caly.split(' - ', 1)
+            if len(parts) == 2:
+                lokal_dla_wpisu = parts[0]
+                usterka_dla_wpisu = parts[1]
+
+        dane_json = {
+            "numer_lokalu_budynku": lokal_dla_wpisu,
+            "rodzaj_usterki": usterka_dla_wpisu,
+            "podmiot_odpowiedzialny": podmiot,
+            "link_do_zdjecia": "",
+            "odbior_id": chat_data.get('odbiur_id'),
+            "czat_id": chat_data.get('odbiur_czat_id')
+        }
+        file_id_ze_zdjecia = wpis.get('file_id')
+        if file_id_ze_zdjecia:
+            dane_json['file_id'] = file_id_ze_zdjecia
+            dane_json['link_do_zdjecia'] = magazyn.link_do_pliku(file_id_ze_zdjecia)
+        lista_danych.append(dane_json)
+
+    # Cały odbiór jednym zapisem hurtowym (jeden odczyt + jeden batch_update zamiast dwóch wywołań na usterkę)
+    zadanie = {'typ': 'usterki', 'dane': lista_danych, 'data': message_time.isoformat()}
+    with w_tle():
+        wynik = await menedzer_cyklu.wykonaj(zadanie, magazyn.zapisz_usterki, lista_danych, message_time)
+    if wynik is ODLOZONO:
+        return 0, len(lista_danych)
+    return wynik, 0
+
+
+KOMUNIKAT_TRANSKRYPCJE_W_TOKU = ("⏳ Notatki głosowe są jeszcze transkrybowane - odbiór nie został zakończony. "
+                                 "Spróbuj ponownie za chwilę.")
+KOMUNIKAT_ZAPIS_NIEUDANY = ("❌ Nie udało się zapisać usterek - odbiór nie został zakończony, nic nie przepadło. "
+                            "Spróbuj zakończyć go ponownie za chwilę.")
+
+
+def komunikat_zakonczenia(chat_data, licznik_zapisanych, licznik_odlozonych):
+    """Tekst podsumowania po zakończeniu odbioru."""
+    identyfikator_odbioru = chat_data.get('odbiur_identyfikator', 'Brak ID Odbioru')
+    wpisy_lista = chat_data.get('odbiur_wpisy', [])
+    tekst = f"✅ Zakończono odbiór.\nZapisano {licznik_zapisanych} z {len(wpisy_lista)} usterek dla {identyfikator_odbioru}."
+    if licznik_odlozonych:
+        tekst += f"\n⏳ {licznik_odlozonych} usterek zostanie zapisanych po restarcie bota."
+    return tekst
+
+
+# -----------------------------------------------------------
+# --- 6e. MAGAZYN: zdjęcia i rejestr usterek ---
+# -----------------------------------------------------------
+class Magazyn(abc.ABC):
+    """
+    Wspólny interfejs magazynu zdjęć (pliki) i rejestru usterek (wiersze).
+    Wszystkie metody są blokujące - z handlerów wołamy je przez menedzer_cyklu.wykonaj().
+    """
+
+    @abc.abstractmethod
+    def zapisz_zdjecie(self, file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal'):
+        """Zapisuje zdjęcie w folderze lokalu. Zwraca (success, nazwa_pliku lub błąd, file_id)."""
+        raise NotImplementedError
+
+    def zapisz_zdjecia(self, zdjecia: list) -> list:
+        """Zapis hurtowy - lista dictów z argumentami zapisz_zdjecie, wynik w tej samej kolejności."""
+        return [self.zapisz_zdjecie(**zdjecie) for zdjecie in zdjecia]
+
+    @abc.abstractmethod
+    def zapisz_duzy_plik(self, sciezka, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal',
+                         mimetype='video/mp4', rozszerzenie='.mp4', postep=None, wznowienie=None):
+        """
+        Zapisuje plik z dysku (wideo, zdjęcie wysłane jako dokument) bez wczytywania go do pamięci.
+        postep(wyslane, rozmiar, resumable_uri) i wznowienie mają znaczenie tylko dla Drive.
+        Zwraca (success, nazwa_pliku lub błąd, file_id).
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def usun_plik(self, file_id):
+        """Usuwa plik. Zwraca (success, błąd)."""
+        raise NotImplementedError
+
+    def usun_pliki(self, file_ids: list) -> dict:
+        """Usuwanie hurtowe. Zwraca {file_id: błąd lub None}."""
+        return {file_id: self.usun_plik(file_id)[1] for file_id in file_ids}
+
+    @abc.abstractmethod
+    def zapisz_usterki(self, lista_danych: list, data_telegram: datetime) -> int:
+        """Zapisuje wiersze usterek (dane_json jak dla arkusza). Zwraca liczbę zapisanych."""
+        raise NotImplementedError
+
+    def zapisz_usterke(self, dane_json: dict, data_telegram: datetime) -> bool:
+        return self.zapisz_usterki([dane_json], data_telegram) == 1
+
+    @abc.abstractmethod
+    def link_do_pliku(self, file_id) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def lista_plikow(self, target_name) -> list:
+        """Pliki w folderze lokalu, najnowsze pierwsze: dicty id, nazwa, mime, utworzono, link, miniatura (lub None)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ostatnie_usterki(self, limit: int) -> list:
+        """Ostatnie zapisane usterki (dane_json + 'data'), najnowsze na końcu."""
+        raise NotImplementedError
+
+
+class GoogleMagazyn(Magazyn):
+    """Zdjęcia na Google Drive (folder per lokal), usterki w Arkuszu Google."""
+
+    def zapisz_zdjecie(self, file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal'):
+        wynik = upload_photo_to_drive(file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru)
+        if wynik[0] and cache_galerii:
+            cache_galerii.dodaj(target_name, wynik[2], wynik[1], 'image/jpeg')
+        return wynik
+
+    def zapisz_duzy_plik(self, sciezka, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal',
+                         mimetype='video/mp4', rozszerzenie='.mp4', postep=None, wznowienie=None):
+        wynik = upload_large_file_to_drive(sciezka, target_name, usterka_name, podmiot_name, mimetype, rozszerzenie,
+                                           postep, wznowienie)
+        if wynik[0] and cache_galerii:
+            cache_galerii.dodaj(target_name, wynik[2], wynik[1], mimetype)
+        return wynik
+
+    def usun_plik(self, file_id):
+        wynik = delete_file_from_drive(file_id)
+        if wynik[0] and cache_galerii:
+            cache_galerii.usun([file_id])
+        return wynik
+
+    def usun_pliki(self, file_ids):
+        wyniki = delete_files_from_drive(file_ids)
+        if cache_galerii:
+            cache_galerii.usun([file_id for file_id, blad in wyniki.items() if blad is None])
+        return wyniki
+
+    def zapisz_usterki(self, lista_danych, data_telegram):
+        return zapisz_wiersze_w_arkuszu(lista_danych, data_telegram)
+
+    def link_do_pliku(self, file_id):
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+    def lista_plikow(self, target_name):
+        if cache_galerii is None:
+            # Kopia listingów istnieje tylko przy samym Drive; jako lustro galerię podaje magazyn lokalny
+            logger.warning("Galeria Drive bez kopii listingów (backend %s) - pusta lista", MAGAZYN_BACKEND)
+            return []
+        return [
+            {**plik, 'link': self.link_do_pliku(plik['id']), 'miniatura': miniatura_drive(plik['id'])}
+            for plik in cache_galerii.lista(target_name)
+        ]
+
+    def ostatnie_usterki(self, limit):
+        return pobierz_ostatnie_wiersze_z_arkusza(limit)
+
+
+class LokalnyMagazyn(Magazyn):
+    """
+    Zdjęcia na dysku lokalnym, adresowane treścią (SHA-256 - ten sam plik zapisany dwa razy zajmuje miejsce raz),
+    usterki i metadane plików w SQLite. Tabela kolejka_lustra przechowuje zlecenia dla LustrzanyMagazyn.
+    """
+
+    SCHEMAT = """
+        CREATE TABLE IF NOT EXISTS pliki (
+            id TEXT PRIMARY KEY, sha256 TEXT NOT NULL, folder TEXT, nazwa TEXT, utworzono TEXT
+        );
+        CREATE INDEX IF NOT EXISTS pliki_folder ON pliki(folder);
+        CREATE INDEX IF NOT EXISTS pliki_sha ON pliki(sha256);
+        CREATE TABLE IF NOT EXISTS usterki (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT, lokal TEXT, usterka TEXT, podmiot TEXT, file_id TEXT, link TEXT,
+            odbior TEXT, czat INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS usterki_lokal ON usterki(lokal);
+        CREATE TABLE IF NOT EXISTS lustro (file_id TEXT PRIMARY KEY, zdalny_id TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS kolejka_lustra (id INTEGER PRIMARY KEY AUTOINCREMENT, zadanie TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS martwe_zadania_lustra (
+            id INTEGER PRIMARY KEY, zadanie TEXT NOT NULL, blad TEXT, odlozono TEXT
+        );
+    """
+
+    def __init__(self, katalog):
+        self.katalog_plikow = os.path.join(katalog, 'pliki')
+        os.makedirs(self.katalog_plikow, exist_ok=True)
+        self.sciezka_bazy = os.path.join(katalog, 'magazyn.sqlite3')
+        self.baza = sqlite3.connect(self.sciezka_bazy, check_same_thread=False)
+        self.baza.row_factory = sqlite3.Row
+        self.blokada = threading.Lock()
+        with self.blokada:
+            self.baza.execute("PRAGMA journal_mode=WAL")
+            self.baza.executescript(self.SCHEMAT)
+            # Bazy sprzed raportów nie mają kolumn odbior/czat
+            kolumny = {w['name'] for w in self.baza.execute("PRAGMA table_info(usterki)")}
+            for kolumna, typ in (('odbior', 'TEXT'), ('czat', 'INTEGER')):
+                if kolumna not in kolumny:
+                    self.baza.execute(f"ALTER TABLE usterki ADD COLUMN {kolumna} {typ}")
+            self.baza.execute("CREATE INDEX IF NOT EXISTS usterki_odbior ON usterki(odbior)")
+            self.baza.commit()
+        logger.info("Lokalny magazyn gotowy: %s", self.sciezka_bazy)
+
+    def _sciezka_bloba(self, sha256):
+        return os.path.join(self.katalog_plikow, sha256[:2], sha256)
+
+    def sciezka_pliku(self, file_id):
+        """Ścieżka do zawartości pliku na dysku albo None, jeśli plik usunięto."""
+        with self.blokada:
+            wiersz = self.baza.execute("SELECT sha256 FROM pliki WHERE id = ?", (file_id,)).fetchone()
+        return self._sciezka_bloba(wiersz['sha256']) if wiersz else None
+
+    def zapisz_zdjecie(self, file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal'):
+        try:
+            file_bytes.seek(0)
+            zawartosc = file_bytes.read()
+            sha256 = hashlib.sha256(zawartosc).hexdigest()
+            sciezka = self._sciezka_bloba(sha256)
+
+            if not os.path.exists(sciezka):
+                os.makedirs(os.path.dirname(sciezka), exist_ok=True)
+                tymczasowa = f"{sciezka}.{uuid.uuid4().hex}.tmp"
+                with open(tymczasowa, 'wb') as f:
+                    f.write(zawartosc)
+                os.replace(tymczasowa, sciezka)
+
+            file_name = f"{usterka_name} - {podmiot_name}.jpg"
+            return True, file_name, self._zarejestruj_plik(sha256, target_name, file_name)
+
+        except Exception as e:
+            logger.error("Błąd zapisu zdjęcia w lokalnym magazynie: %s", e)
+            return False, str(e), None
+
+    def zapisz_duzy_plik(self, sciezka, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal',
+                         mimetype='video/mp4', rozszerzenie='.mp4', postep=None, wznowienie=None):
+        try:
+            skrot = hashlib.sha256()
+            with open(sciezka, 'rb') as f:
+                for fragment in iter(lambda: f.read(1024 * 1024), b''):
+                    skrot.update(fragment)
+            sha256 = skrot.hexdigest()
+            sciezka_bloba = self._sciezka_bloba(sha256)
+
+            if not os.path.exists(sciezka_bloba):
+                os.makedirs(os.path.dirname(sciezka_bloba), exist_ok=True)
+                tymczasowa = f"{sciezka_bloba}.{uuid.uuid4().hex}.tmp"
+                shutil.copyfile(sciezka, tymczasowa)
+                os.replace(tymczasowa, sciezka_bloba)
+
+            file_name = f"{usterka_name} - {podmiot_name}{rozszerzenie}"
+            return True, file_name, self._zarejestruj_plik(sha256, target_name, file_name)
+
+        except Exception as e:
+            logger.error("Błąd zapisu pliku %s w lokalnym magazynie: %s", sciezka, e)
+            return False, str(e), None
+
+    def _zarejestruj_plik(self, sha256, target_name, file_name):
+        file_id = str(uuid.uuid4())
+        with self.blokada, self.baza:
+            self.baza.execute(
+                "INSERT INTO pliki (id, sha256, folder, nazwa, utworzono) VALUES (?, ?, ?, ?, ?)",
+                (file_id, sha256, target_name, file_name, datetime.now().isoformat())
+            )
+        logger.info("Zapisano lokalnie plik '%s' w folderze '%s' (ID: %s)", file_name, target_name, file_id)
+        return file_id
+
+    def usun_plik(self, file_id):
+        if not file_id:
+            return False, "Brak ID pliku"
+        try:
+            with self.blokada, self.baza:
+                wiersz = self.baza.execute("SELECT sha256 FROM pliki WHERE id = ?", (file_id,)).fetchone()
+                if not wiersz:
+                    return False, "Nie ma takiego pliku"
+                self.baza.execute("DELETE FROM pliki WHERE id = ?", (file_id,))
+                pozostale = self.baza.execute("SELECT COUNT(*) FROM pliki WHERE sha256 = ?", (wiersz['sha256'],)).fetchone()[0]
+
+            # Zawartość kasujemy dopiero, gdy nie wskazuje na nią żaden inny plik
+            if not pozostale:
+                sciezka = self._sciezka_bloba(wiersz['sha256'])
+                if os.path.exists(sciezka):
+                    os.remove(sciezka)
+            logger.info("Usunięto plik z lokalnego magazynu (ID: %s)", file_id)
+            return True, None
+
+        except Exception as e:
+            logger.error("Błąd usuwania pliku %s z lokalnego magazynu: %s", file_id, e)
+            return False, str(e)
+
+    def zapisz_usterki(self, lista_danych, data_telegram):
+        data_str = data_telegram.strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            with self.blokada, self.baza:
+                self.baza.executemany(
+                    "INSERT INTO usterki (data, lokal, usterka, podmiot, file_id, link, odbior, czat) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (data_str, d.get('numer_lokalu_budynku', 'BŁĄD'), d.get('rodzaj_usterki', 'BŁĄD'),
+                         d.get('podmiot_odpowiedzialny', 'BŁĄD'), d.get('file_id'), d.get('link_do_zdjecia', ''),
+                         d.get('odbior_id'), d.get('czat_id'))
+                        for d in lista_danych
+                    ]
+                )
+            logger.info("Zapisano lokalnie %s usterek", len(lista_danych))
+            return len(lista_danych)
+
+        except Exception as e:
+            logger.error("Błąd zapisu usterek w lokalnym magazynie: %s", e)
+            return 0
+
+    def link_do_pliku(self, file_id):
+        sciezka = self.sciezka_pliku(file_id)
+        return os.path.abspath(sciezka) if sciezka else ''
+
+    def lista_plikow(self, target_name):
+        with self.blokada:
+            wiersze = self.baza.execute(
+                "SELECT id, nazwa, utworzono FROM pliki WHERE folder = ? ORDER BY utworzono DESC", (target_name,)
+            ).fetchall()
+        # Pliki lokalne nie mają adresu dostępnego z Telegrama
+        return [
+            {'id': w['id'], 'nazwa': w['nazwa'], 'mime': mimetypes.guess_type(w['nazwa'] or '')[0],
+             'utworzono': w['utworzono'], 'link': None, 'miniatura': None}
+            for w in wiersze
+        ]
+
+    def ostatnie_usterki(self, limit):
+        with self.blokada:
+            wiersze = self.baza.execute(
+                "SELECT data, lokal, usterka, podmiot, file_id FROM usterki ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [
+            {'data': w['data'], 'numer_lokalu_budynku': w['lokal'], 'rodzaj_usterki': w['usterka'],
+             'podmiot_odpowiedzialny': w['podmiot'], 'file_id': w['file_id']}
+            for w in reversed(wiersze)
+        ]
+
+    # --- Obsługa lustra (używane przez LustrzanyMagazyn) ---
+    def zdalny_id(self, file_id):
+        with self.blokada:
+            wiersz = self.baza.execute("SELECT zdalny_id FROM lustro WHERE file_id = ?", (file_id,)).fetchone()
+        return wiersz['zdalny_id'] if wiersz else None
+
+    def ustaw_zdalny_id(self, file_id, zdalny_id):
+        with self.blokada, self.baza:
+            self.baza.execute("INSERT OR REPLACE INTO lustro (file_id, zdalny_id) VALUES (?, ?)", (file_id, zdalny_id))
+
+    def dodaj_zadanie_lustra(self, zadanie: dict):
+        with self.blokada, self.baza:
+            self.baza.execute("INSERT INTO kolejka_lustra (zadanie) VALUES (?)", (json.dumps(zadanie, ensure_ascii=False),))
+
+    def nastepne_zadanie_lustra(self):
+        with self.blokada:
+            wiersz = self.baza.execute("SELECT id, zadanie FROM kolejka_lustra ORDER BY id LIMIT 1").fetchone()
+        return (wiersz['id'], json.loads(wiersz['zadanie'])) if wiersz else None
+
+    def usun_zadanie_lustra(self, id_zadania):
+        with self.blokada, self.baza:
+            self.baza.execute("DELETE FROM kolejka_lustra WHERE id = ?", (id_zadania,))
+
+    def porzuc_zadanie_lustra(self, id_zadania, blad):
+        """Przenosi zlecenie, które ciągle się nie udaje, do martwe_zadania_lustra (do ręcznego przejrzenia)."""
+        with self.blokada, self.baza:
+            self.baza.execute(
+                "INSERT OR REPLACE INTO martwe_zadania_lustra (id, zadanie, blad, odlozono) "
+                "SELECT id, zadanie, ?, ? FROM kolejka_lustra WHERE id = ?",
+                (blad, datetime.now().isoformat(), id_zadania)
+            )
+            self.baza.execute("DELETE FROM kolejka_lustra WHERE id = ?", (id_zadania,))
+
+
+# Po tylu nieudanych próbach z rzędu zlecenie lustra trafia do martwe_zadania_lustra (ok. 4 min przy przerwach 1-128 s)
+MAKS_PROB_LUSTRA = int(os.getenv('MAKS_PROB_LUSTRA', 8))
+
+
+class LustrzanyMagazyn(Magazyn):
+    """
+    Lokalny magazyn jako główny (szybka odpowiedź dla handlera), Google jako lustro.
+    Zlecenia lustra są trwałe (SQLite) i wykonywane po kolei w osobnym wątku, więc zdjęcie
+    zawsze trafia na Drive przed wierszem, który do niego linkuje.
+    """
+
+    def __init__(self, glowny: LokalnyMagazyn, lustro: Magazyn):
+        self.glowny = glowny
+        self.lustro = lustro
+        self.sygnal = threading.Event()
+        self.wznowienia = {}  # file_id -> resumable_uri przerwanego wysyłania dużego pliku
+        threading.Thread(target=self._petla_lustra, name='lustro-google', daemon=True).start()
+
+    def _zlec(self, zadanie: dict):
+        zadanie['slad_odbioru'] = _slad_odbioru.get()
+        self.glowny.dodaj_zadanie_lustra(zadanie)
+        self.sygnal.set()
+
+    def zapisz_zdjecie(self, file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal'):
+        wynik = self.glowny.zapisz_zdjecie(file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru)
+        if wynik[0]:
+            self._zlec({'typ': 'zdjecie', 'file_id': wynik[2], 'target': target_name,
+                        'usterka': usterka_name, 'podmiot': podmiot_name, 'tryb': tryb_odbioru})
+        return wynik
+
+    def zapisz_duzy_plik(self, sciezka, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal',
+                         mimetype='video/mp4', rozszerzenie='.mp4', postep=None, wznowienie=None):
+        wynik = self.glowny.zapisz_duzy_plik(sciezka, target_name, usterka_name, podmiot_name, tryb_odbioru,
+                                             mimetype, rozszerzenie)
+        if wynik[0]:
+            self._zlec({'typ': 'duzy_plik', 'file_id': wynik[2], 'target': target_name, 'usterka': usterka_name,
+                        'podmiot': podmiot_name, 'tryb': tryb_odbioru, 'mimetype': mimetype, 'rozszerzenie': rozszerzenie})
+        return wynik
+
+    def usun_plik(self, file_id):
+        wynik = self.glowny.usun_plik(file_id)
+        if wynik[0]:
+            self._zlec({'typ': 'usun', 'file_ids': [file_id]})
+        return wynik
+
+    def usun_pliki(self, file_ids):
+        wyniki = self.glowny.usun_pliki(file_ids)
+        usuniete = [file_id for file_id, blad in wyniki.items() if blad is None]
+        if usuniete:
+            self._zlec({'typ': 'usun', 'file_ids': usuniete})
+        return wyniki
+
+    def zapisz_usterki(self, lista_danych, data_telegram):
+        zapisane = self.glowny.zapisz_usterki(lista_danych, data_telegram)
+        if zapisane:
+            self._zlec({'typ': 'usterki', 'dane': lista_danych, 'data': data_telegram.isoformat()})
+        return zapisane
+
+    def link_do_pliku(self, file_id):
+        zdalny_id = self.glowny.zdalny_id(file_id)
+        return self.lustro.link_do_pliku(zdalny_id) if zdalny_id else self.glowny.link_do_pliku(file_id)
+
+    def lista_plikow(self, target_name):
+        # Lista z lokalnej bazy (bez zapytań do Drive); link do kopii na Drive, jeśli już zsynchronizowana
+        pliki = self.glowny.lista_plikow(target_name)
+        for plik in pliki:
+            zdalny_id = self.glowny.zdalny_id(plik['id'])
+            if zdalny_id:
+                plik['link'] = self.lustro.link_do_pliku(zdalny_id)
+                plik['miniatura'] = miniatura_drive(zdalny_id)
+        return pliki
+
+    def ostatnie_usterki(self, limit):
+        return self.glowny.ostatnie_usterki(limit)
+
+    def _petla_lustra(self):
+        _priorytet_google.set('w_tle')  # synchronizacja nie może zabierać limitu użytkownikom
+        przerwa = 1
+        id_glowy, proby = None, 0
+        while True:
+            nastepne = self.glowny.nastepne_zadanie_lustra()
+            if not nastepne:
+                self.sygnal.wait(60)
+                self.sygnal.clear()
+                continue
+
+            id_zadania, zadanie = nastepne
+            if id_zadania != id_glowy:
+                id_glowy, proby = id_zadania, 0
+            try:
+                with slad(odbior=zadanie.get('slad_odbioru')):
+                    self._wykonaj_w_lustrze(zadanie)
+                self.glowny.usun_zadanie_lustra(id_zadania)
+                przerwa = 1
+            except Exception as e:
+                proby += 1
+                status = status_bledu_google(e)
+                if proby >= MAKS_PROB_LUSTRA or (status is not None and not czy_ponowic_google(e)):
+                    # Błąd trwały (4xx, usunięty folder...) nie może zatrzymać całej kolejki
+                    logger.error("Lustro Google: porzucono zadanie '%s' po %s próbach: %s", zadanie.get('typ'), proby, e)
+                    self.glowny.porzuc_zadanie_lustra(id_zadania, str(e))
+                    przerwa = 1
+                    continue
+                # Zlecenie zostaje w kolejce - ponawiamy z rosnącą przerwą (max 5 min)
+                logger.error("Lustro Google: błąd zadania '%s', ponowienie za %ss: %s", zadanie.get('typ'), przerwa, e)
+                time.sleep(przerwa)
+                przerwa = min(przerwa * 2, 300)
+
+    def _wykonaj_w_lustrze(self, zadanie: dict):
+        typ = zadanie.get('typ')
+
+        if typ == 'zdjecie':
+            sciezka = self.glowny.sciezka_pliku(zadanie['file_id'])
+            if not sciezka or self.glowny.zdalny_id(zadanie['file_id']):
+                return  # usunięte zanim doszło do lustra albo już wysłane
+            with open(sciezka, 'rb') as f:
+                success, message, zdalny_id = self.lustro.zapisz_zdjecie(
+                    io.BytesIO(f.read()), zadanie['target'], zadanie['usterka'], zadanie['podmiot'], zadanie.get('tryb', 'lokal')
+                )
+            if not success:
+                raise RuntimeError(message)
+            self.glowny.ustaw_zdalny_id(zadanie['file_id'], zdalny_id)
+
+        elif typ == 'duzy_plik':
+            file_id = zadanie['file_id']
+            sciezka = self.glowny.sciezka_pliku(file_id)
+            if not sciezka or self.glowny.zdalny_id(file_id):
+                return
+            success, message, zdalny_id = self.lustro.zapisz_duzy_plik(
+                sciezka, zadanie['target'], zadanie['usterka'], zadanie['podmiot'], zadanie.get('tryb', 'lokal'),
+                zadanie['mimetype'], zadanie['rozszerzenie'],
+                postep=lambda wyslane, rozmiar, uri: self.wznowienia.__setitem__(file_id, uri),
+                wznowienie=self.wznowienia.get(file_id)
+            )
+            if not success:
+                raise RuntimeError(message)
+            self.wznowienia.pop(file_id, None)
+            self.glowny.ustaw_zdalny_id(file_id, zdalny_id)
+
+        elif typ == 'usterki':
+            lista_danych = []
+            for dane_json in zadanie['dane']:
+                dane_json = dict(dane_json)
+                if dane_json.get('file_id'):
+                    zdalny_id = self.glowny.zdalny_id(dane_json['file_id'])
+                    dane_json['link_do_zdjecia'] = self.lustro.link_do_pliku(zdalny_id) if zdalny_id else ''
+                lista_danych.append(dane_json)
+            if self.lustro.zapisz_usterki(lista_danych, datetime.fromisoformat(zadanie['data'])) != len(lista_danych):
+                raise RuntimeError("nie zapisano wszystkich wierszy")
+
+        elif typ == 'usun':
+            zdalne = [z for z in (self.glowny.zdalny_id(file_id) for file_id in zadanie['file_ids']) if z]
+            if zdalne:
+                # Błędy usuwania (np. plik już skasowany ręcznie) tylko logujemy - nie blokują kolejki
+                for zdalny_id, blad in self.lustro.usun_pliki(zdalne).items():
+                    if blad:
+                        logger.warning("Lustro Google: nie usunięto %s: %s", zdalny_id, blad)
+
+
+def utworz_magazyn() -> Magazyn:
+    """Tworzy magazyn według zmiennej MAGAZYN_BACKEND."""
+    if MAGAZYN_BACKEND == 'lokalny':
+        return LokalnyMagazyn(KATALOG_MAGAZYNU)
+    if MAGAZYN_BACKEND == 'lokalny+google':
+        return LustrzanyMagazyn(LokalnyMagazyn(KATALOG_MAGAZYNU), GoogleMagazyn())
+    return GoogleMagazyn()
+
+
+magazyn = utworz_magazyn()
+logger.info("Magazyn danych: %s (%s)", MAGAZYN_BACKEND, type(magazyn).__name__)
+
+
+# -----------------------------------------------------------
+# --- 6f. WYKRYWANIE DUPLIKATÓW USTEREK ---
+# -----------------------------------------------------------
+# Ile ostatnich wierszy historii wczytać przy starcie i z ilu dni
+LIMIT_HISTORII_DUPLIKATOW = int(os.getenv('LIMIT_HISTORII_DUPLIKATOW', 3000))
+DNI_HISTORII_DUPLIKATOW = int(os.getenv('DNI_HISTORII_DUPLIKATOW', 14))
+# Minimalne podobieństwo (Jaccard na shinglach), od którego pytamy o potwierdzenie
+PROG_DUPLIKATU = float(os.getenv('PROG_DUPLIKATU', 0.6))
+
+_POLSKIE_ZNAKI = str.maketrans('ąćęłńóśźż', 'acelnoszz')
+
+
+def shingle_usterki(tekst: str) -> frozenset:
+    """
+    Normalizuje opis usterki i zwraca zbiór shingli: rdzenie słów (5 znaków - odmiana 'pęknięty/pęknięta'
+    daje ten sam rdzeń) oraz trigramy znakowe w obrębie słów (odporność na literówki).
+    """
+    tekst = tekst.lower().replace('(zdjęcie)', '').translate(_POLSKIE_ZNAKI)
+    slowa = [slowo[:5] for slowo in re.findall(r'[a-z0-9]+', tekst) if len(slowo) > 2 or slowo.isdigit()]
+    shingle = set(slowa)
+    for slowo in slowa:
+        shingle.update(f"#{slowo[i:i + 3]}" for i in range(max(len(slowo) - 2, 1)))
+    return frozenset(shingle)
+
+
+class IndeksDuplikatow:
+    """
+    Indeks podobieństwa usterek per lokal: MinHash + LSH (pasma sygnatur jako klucze słownika).
+    Wyszukiwanie sprawdza tylko kandydatów z tych samych kubełków, a potem liczy dokładny Jaccard.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, prog, liczba_pasm=8, wiersze_w_pasmie=4):
+        self.prog = prog
+        self.liczba_pasm = liczba_pasm
+        self.wiersze_w_pasmie = wiersze_w_pasmie
+        losowanie = random.Random(2024)  # stałe ziarno - te same współczynniki funkcji haszujących przy każdym starcie
+        self.wspolczynniki = [(losowanie.randrange(1, self._PRIME), losowanie.randrange(0, self._PRIME))
+                              for _ in range(liczba_pasm * wiersze_w_pasmie)]
+        self.kubelki = {}  # (lokal, nr_pasma, fragment sygnatury) -> set(kluczy)
+        self.wpisy = {}    # klucz -> (lokal, tekst, zrodlo, shingle, klucze_kubelkow)
+
+    @staticmethod
+    def _hasz(shingiel):
+        # Nie hash(): dla str zmienia się między procesami (PYTHONHASHSEED)
+        return int.from_bytes(hashlib.blake2b(shingiel.encode(), digest_size=8).digest(), 'big')
+
+    def _sygnatura(self, shingle):
+        hasze = [self._hasz(s) for s in shingle]
+        return [min((a * h + b) % self._PRIME for h in hasze) for a, b in self.wspolczynniki]
+
+    def _klucze_kubelkow(self, lokal, shingle):
+        sygnatura = self._sygnatura(shingle)
+        r = self.wiersze_w_pasmie
+        return [(lokal, i, tuple(sygnatura[i * r:(i + 1) * r])) for i in range(self.liczba_pasm)]
+
+    def dodaj(self, lokal, klucz, tekst, zrodlo):
+        shingle = shingle_usterki(tekst)
+        if not lokal or not shingle:
+            return
+        self.usun(klucz)
+        klucze_kubelkow = self._klucze_kubelkow(lokal, shingle)
+        for klucz_kubelka in klucze_kubelkow:
+            self.kubelki.setdefault(klucz_kubelka, set()).add(klucz)
+        self.wpisy[klucz] = (lokal, tekst, zrodlo, shingle, klucze_kubelkow)
+
+    def usun(self, klucz):
+        wpis = self.wpisy.pop(klucz, None)
+        if not wpis:
+            return
+        for klucz_kubelka in wpis[4]:
+            kubelek = self.kubelki.get(klucz_kubelka)
+            if kubelek:
+                kubelek.discard(klucz)
+                if not kubelek:
+                    del self.kubelki[klucz_kubelka]
+
+    def znajdz(self, lokal, tekst):
+        """Zwraca najbardziej podobny wpis dla lokalu ({'tekst', 'zrodlo', 'podobienstwo'}) albo None."""
+        shingle = shingle_usterki(tekst)
+        if not lokal or not shingle:
+            return None
+
+        kandydaci = set()
+        for klucz_kubelka in self._klucze_kubelkow(lokal, shingle):
+            kandydaci.update(self.kubelki.get(klucz_kubelka, ()))
+
+        najlepszy = None
+        for klucz in kandydaci:
+            _, tekst_wpisu, zrodlo, shingle_wpisu, _ = self.wpisy[klucz]
+            podobienstwo = len(shingle & shingle_wpisu) / len(shingle | shingle_wpisu)
+            if podobienstwo >= self.prog and (not najlepszy or podobienstwo > najlepszy['podobienstwo']):
+                najlepszy = {'klucz': klucz, 'tekst': tekst_wpisu, 'zrodlo': zrodlo, 'podobienstwo': podobienstwo}
+        return najlepszy
+
+
+indeks_duplikatow = IndeksDuplikatow(PROG_DUPLIKATU)
+
+
+def odczytaj_date_wiersza(tekst: str):
+    """Data z kolumny arkusza - w formacie zapisu albo w formacie wyświetlania po konwersji przez Sheets."""
+    for format_daty in ('%Y-%m-%d %H:%M:%S', '%d.%m.%Y %H:%M:%S', '%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(tekst.strip(), format_daty)
+        except ValueError:
+            continue
+    return None
+
+
+def opis_zrodla_sesji(chat_data) -> str:
+    return f"odbiór {chat_data.get('odbiur_identyfikator', '')}, {datetime.now().strftime('%d.%m %H:%M')}"
+
+
+def zaladuj_indeks_duplikatow(application: Application):
+    """Wypełnia indeks historią z magazynu (ostatnie DNI_HISTORII_DUPLIKATOW dni) i wpisami z trwających sesji."""
+    granica = datetime.now() - timedelta(days=DNI_HISTORII_DUPLIKATOW)
+    historia = magazyn.ostatnie_usterki(LIMIT_HISTORII_DUPLIKATOW)
+    for numer, dane_json in enumerate(historia):
+        data_wpisu = odczytaj_date_wiersza(dane_json.get('data', ''))
+        if data_wpisu and data_wpisu < granica:
+            continue
+        indeks_duplikatow.dodaj(dane_json.get('numer_lokalu_budynku'), f"historia:{numer}",
+                                dane_json.get('rodzaj_usterki', ''), f"zapisane {dane_json.get('data', '')[:16]}")
+
+    for chat_data in application.chat_data.values():
+        for wpis in chat_data.get('odbiur_wpisy', []):
+            lokal, _, usterka = wpis.get('opis', '').partition(' - ')
+            indeks_duplikatow.dodaj(lokal, wpis.get('id'), usterka, opis_zrodla_sesji(chat_data))
+
+    logger.info("Indeks duplikatów: %s usterek z historii i trwających odbiorów", len(indeks_duplikatow.wpisy))
+
+
+# -----------------------------------------------------------
+# --- 6g. RAPORTY (protokoły odbioru w HTML) ---
+# -----------------------------------------------------------
+KATALOG_RAPORTOW = os.getenv('KATALOG_RAPORTOW', os.path.join(KATALOG_MAGAZYNU, 'raporty'))
+ROZMIAR_MINIATURY = (320, 320)
+
+# Raporty generuje osobny wątek (jeden - dwa raporty naraz tylko by się przepychały), żeby skalowanie zdjęć
+# nie blokowało handlerów; Pillow zwalnia GIL przy dekodowaniu i skalowaniu. Nie proces: 'fork' wielowątkowego
+# bota może zakleszczyć potomka na cudzej blokadzie, a 'spawn' wykonałby bota.py od nowa (łącznie z Google).
+pula_raportow = ThreadPoolExecutor(max_workers=1, thread_name_prefix='raporty')
+
+
+def lokalny_magazyn():
+    """Lokalny magazyn z danymi do raportów albo None przy MAGAZYN_BACKEND='google'."""
+    if isinstance(magazyn, LokalnyMagazyn):
+        return magazyn
+    if isinstance(magazyn, LustrzanyMagazyn):
+        return magazyn.glowny
+    return None
+
+
+def _miniatura_base64(sciezka_bazy, katalog_plikow, file_id):
+    """Miniatura zdjęcia jako base64 (JPEG), z pamięcią podręczną na dysku - ten sam plik skalujemy raz."""
+    with sqlite3.connect(f"file:{sciezka_bazy}?mode=ro", uri=True) as baza:
+        wiersz = baza.execute("SELECT sha256 FROM pliki WHERE id = ?", (file_id,)).fetchone()
+    if not wiersz:
+        return None
+
+    sha256 = wiersz[0]
+    sciezka_miniatury = os.path.join(katalog_plikow, 'miniatury', f"{sha256}.jpg")
+    if not os.path.exists(sciezka_miniatury):
+        sciezka_oryginalu = os.path.join(katalog_plikow, sha256[:2], sha256)
+        if not os.path.exists(sciezka_oryginalu):
+            return None
+        os.makedirs(os.path.dirname(sciezka_miniatury), exist_ok=True)
+        try:
+            with Image.open(sciezka_oryginalu) as obraz:
+                obraz.thumbnail(ROZMIAR_MINIATURY)
+                obraz.convert('RGB').save(sciezka_miniatury, 'JPEG', quality=70)
+        except OSError:
+            return None  # wideo - w protokole zostaje sam link
+
+    with open(sciezka_miniatury, 'rb') as f:
+        return base64.b64encode(f.read()).decode('ascii')
+
+
+def generuj_raport_html(sciezka_bazy, katalog_plikow, filtr: dict, tytul: str, sciezka_wyjscia: str) -> tuple:
+    """
+    Uruchamiane w wątku raportów. Czyta usterki z lokalnej bazy (bez Google) i zapisuje protokół HTML
+    wiersz po wierszu prosto z kursora, z miniaturami zdjęć osadzonymi w pliku.
+    Zwraca (liczba usterek w raporcie, tytuł); liczba to None, gdy czat nie ma jeszcze zapisanego odbioru.
+    """
+    baza = sqlite3.connect(f"file:{sciezka_bazy}?mode=ro", uri=True)
+    try:
+        if 'ostatni_odbior_czatu' in filtr:
+            wiersz = baza.execute(
+                "SELECT odbior, podmiot FROM usterki WHERE czat = ? AND odbior IS NOT NULL ORDER BY id DESC LIMIT 1",
+                (filtr['ostatni_odbior_czatu'],)
+            ).fetchone()
+            if not wiersz:
+                return None, tytul
+            filtr = {'odbior': wiersz[0]}
+            tytul = f"Protokół odbioru - {wiersz[1]}"
+        return _generuj_raport_html(baza, sciezka_bazy, katalog_plikow, filtr, tytul, sciezka_wyjscia), tytul
+    finally:
+        baza.close()
+
+
+def _generuj_raport_html(baza, sciezka_bazy, katalog_plikow, filtr, tytul, sciezka_wyjscia) -> int:
+    warunki, parametry = [], []
+    if filtr.get('odbior'):
+        warunki.append("odbior = ?")
+        parametry.append(filtr['odbior'])
+    if filtr.get('lokale'):
+        warunki.append(f"lokal IN ({', '.join('?' * len(filtr['lokale']))})")
+        parametry.extend(filtr['lokale'])
+    if filtr.get('podmiot'):
+        warunki.append("podmiot = ?")
+        parametry.append(filtr['podmiot'])
+    gdzie = (" WHERE " + " AND ".join(warunki)) if warunki else ""
+    # Kolejność lokali numerycznie ("49/2" przed "49/10"), bez numeru na końcu - w SQL, żeby nie sortować w pamięci.
+    # CAST bierze wiodące cyfry: CAST('49/10' AS INTEGER) = 49.
+    zapytanie = (
+        "SELECT data, lokal, usterka, podmiot, file_id FROM usterki" + gdzie +
+        " ORDER BY (lokal IS NULL OR lokal NOT GLOB '[0-9]*'), CAST(lokal AS INTEGER),"
+        " CAST(substr(lokal, instr(lokal, '/') + 1) AS INTEGER), data, id"
+    )
+
+    liczba = baza.execute("SELECT COUNT(*) FROM usterki" + gdzie, parametry).fetchone()[0]
+    wiersze = baza.execute(zapytanie, parametry)
+    os.makedirs(os.path.dirname(sciezka_wyjscia), exist_ok=True)
+    _zapisz_raport_html(wiersze, liczba, sciezka_bazy, katalog_plikow, tytul, sciezka_wyjscia)
+    return liczba
+
+
+def _zapisz_raport_html(wiersze, liczba, sciezka_bazy, katalog_plikow, tytul, sciezka_wyjscia):
+    with open(sciezka_wyjscia, 'w', encoding='utf-8') as f:
+        f.write(
+            "<!DOCTYPE html><html lang='pl'><head><meta charset='utf-8'>"
+            f"<title>{html.escape(tytul)}</title><style>"
+            "body{font-family:sans-serif;margin:24px}table{border-collapse:collapse;width:100%}"
+            "td,th{border:1px solid #999;padding:6px;vertical-align:top;text-align:left}"
+            "th{background:#eee}img{max-width:320px}tr{page-break-inside:avoid}"
+            "</style></head><body>"
+            f"<h1>{html.escape(tytul)}</h1>"
+            f"<p>Wygenerowano: {datetime.now().strftime('%Y-%m-%d %H:%M')} &middot; Liczba usterek: {liczba}</p>"
+            "<table><tr><th>#</th><th>Data</th><th>Lokal</th><th>Usterka</th><th>Wykonawca</th><th>Zdjęcie</th></tr>"
+        )
+        for numer, (data, lokal, usterka, podmiot, file_id) in enumerate(wiersze, start=1):
+            miniatura = ''
+            if file_id:
+                try:
+                    dane_obrazu = _miniatura_base64(sciezka_bazy, katalog_plikow, file_id)
+                    if dane_obrazu:
+                        miniatura = f"<img src='data:image/jpeg;base64,{dane_obrazu}'>"
+                except Exception as e:
+                    miniatura = f"(błąd zdjęcia: {html.escape(str(e))})"
+            f.write(
+                f"<tr><td>{numer}</td><td>{html.escape(data or '')}</td><td>{html.escape(lokal or '')}</td>"
+                f"<td>{html.escape(usterka or '')}</td><td>{html.escape(podmiot or '')}</td><td>{miniatura}</td></tr>"
+            )
+        f.write("</table></body></html>")
+
+
+def filtr_raportu(argumenty: list, chat_id):
+    """
+    Zamienia argumenty /raport na (filtr, tytuł) albo (None, komunikat_błędu).
+    /raport - ostatni zapisany odbiór z tego czatu, /raport szereg 3, /raport firma Pelc.
+    """
+    if not argumenty:
+        return {'ostatni_odbior_czatu': chat_id}, "Protokół odbioru"
+
+    rodzaj, reszta = argumenty[0].lower(), " ".join(argumenty[1:]).strip()
+
+    if rodzaj == 'szereg':
+        szereg_name = f"Szereg {reszta}"
+        if szereg_name not in DANE_SZEREGOW:
+            return None, f"Nie ma szeregu '{reszta}'. Dostępne: 1-{len(DANE_SZEREGOW)}."
+        dane = DANE_SZEREGOW[szereg_name]
+        return {'lokale': dane['lokale']}, f"Protokół usterek - {szereg_name} ({dane['zakres']})"
+
+    if rodzaj == 'firma' and reszta:
+        szukane = reszta.upper()
+        pasujace = [firma for firma in LISTA_FIRM_WYKONAWCZYCH if szukane in firma.upper()]
+        if len(pasujace) != 1:
+            return None, (f"Nie rozpoznano jednoznacznie firmy '{reszta}'." if not pasujace else
+                          "Pasuje kilka firm: " + ", ".join(pasujace) + ". Doprecyzuj nazwę.")
+        return {'podmiot': pasujace[0]}, f"Protokół usterek - {pasujace[0]}"
+
+    return None, "Użycie: /raport, /raport szereg 3 albo /raport firma Pelc"
+
+
+# -----------------------------------------------------------
+# --- 6h. CYKL ŻYCIA SESJI: wygasanie, budżet pamięci, automatyczne zakończenie ---
+# -----------------------------------------------------------
+CZAS_OSTRZEZENIA_SESJI = int(os.getenv('CZAS_OSTRZEZENIA_SESJI_MIN', 90)) * 60
+CZAS_WYGASNIECIA_SESJI = int(os.getenv('CZAS_WYGASNIECIA_SESJI_MIN', 120)) * 60
+BUDZET_PAMIECI_SESJI = int(os.getenv('BUDZET_PAMIECI_SESJI_MB', 32)) * 1024 * 1024
+MIN_BEZCZYNNOSC_USPIENIA = 10 * 60  # świeżo używanych sesji nie usypiamy nawet przy przekroczonym budżecie
+KATALOG_USPIONYCH_SESJI = os.getenv('KATALOG_USPIONYCH_SESJI', 'uspione_sesje')
+INTERWAL_SPRAWDZANIA_SESJI = 60
+INTERWAL_RAPORTU_SESJI = int(os.getenv('INTERWAL_RAPORTU_SESJI_MIN', 15)) * 60
+
+
+class MenedzerSesji:
+    """
+    Każda aktualizacja stempluje chat_data['ostatnia_aktywnosc'] (handler w grupie -1). Co minutę:
+    - po CZAS_OSTRZEZENIA_SESJI bezczynności - jednorazowe ostrzeżenie z przyciskiem zakończenia,
+    - po CZAS_WYGASNIECIA_SESJI - automatyczne zakończenie odbioru (zapis hurtowy) i usunięcie sesji,
+    - przy przekroczonym BUDZET_PAMIECI_SESJI - najdłużej bezczynne sesje są usypiane do KATALOG_USPIONYCH_SESJI
+      i wracają do pamięci przy następnej wiadomości z czatu.
+    """
+
+    def __init__(self, katalog):
+        self.katalog = katalog
+        self.uspione = {}  # chat_id -> ostatnia_aktywnosc (czas modyfikacji pliku)
+        self.rozmiary = {}  # chat_id -> (ostatnia_aktywnosc w chwili pomiaru, rozmiar po serializacji)
+        self.zajeta_pamiec = 0
+        self.zakonczone_automatycznie = 0
+
+    def _sciezka(self, chat_id):
+        return os.path.join(self.katalog, f"{chat_id}.pickle")
+
+    def wczytaj(self):
+        os.makedirs(self.katalog, exist_ok=True)
+        for nazwa in os.listdir(self.katalog):
+            if not nazwa.endswith('.pickle'):
+                continue
+            try:
+                chat_id = int(nazwa[:-len('.pickle')])
+            except ValueError:
+                continue
+            self.uspione[chat_id] = os.path.getmtime(os.path.join(self.katalog, nazwa))
+        if self.uspione:
+            logger.info("Uśpione sesje na dysku: %s", len(self.uspione))
+
+    def przywroc(self, application: Application, chat_id) -> dict:
+        """Zwraca chat_data czatu; uśpioną sesję najpierw wczytuje z dysku."""
+        if chat_id not in self.uspione:
+            return application.chat_data.get(chat_id, {})
+
+        chat_data = application.chat_data[chat_id]
+        sciezka = self._sciezka(chat_id)
+        with open(sciezka, 'rb') as f:
+            chat_data.update(pickle.load(f))
+        os.remove(sciezka)
+        del self.uspione[chat_id]
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+        logger.info("Przywrócono uśpioną sesję czatu %s", chat_id)
+        return chat_data
+
+    def uspij(self, application: Application, chat_id):
+        chat_data = application.chat_data[chat_id]
+        ostatnia = chat_data.get('ostatnia_aktywnosc', time.time())
+
+        sciezka = self._sciezka(chat_id)
+        with open(sciezka + '.tmp', 'wb') as f:
+            pickle.dump(dict(chat_data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(sciezka + '.tmp', sciezka)
+        os.utime(sciezka, (ostatnia, ostatnia))
+
+        application.drop_chat_data(chat_id)
+        self.uspione[chat_id] = ostatnia
+        logger.info("Uśpiono sesję czatu %s (bezczynna od %.0f min)", chat_id, (time.time() - ostatnia) / 60)
+
+    async def przy_aktywnosci(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handler w grupie -1: przywraca uśpioną sesję i odnotowuje aktywność, zanim zadziałają właściwe handlery."""
+        if not update.effective_chat:
+            return
+        chat_data = self.przywroc(context.application, update.effective_chat.id)
+        chat_data['ostatnia_aktywnosc'] = time.time()
+        chat_data.pop('ostrzezono_o_wygasnieciu', None)
+        if chat_data.get('odbiur_aktywny'):
+            _slad_odbioru.set(chat_data.get('odbiur_id'))
+
+    async def sprawdz(self, context: ContextTypes.DEFAULT_TYPE):
+        """Zadanie cykliczne (job_queue): ostrzeżenia, automatyczne zakończenia i pilnowanie budżetu pamięci."""
+        application = context.application
+        teraz = time.time()
+
+        for chat_id, chat_data in list(application.chat_data.items()):
+            if not chat_data:
+                continue
+            bezczynnosc = teraz - chat_data.setdefault('ostatnia_aktywnosc', teraz)
+
+            if bezczynnosc >= CZAS_WYGASNIECIA_SESJI:
+                with slad(odbior=chat_data.get('odbiur_id')):
+                    await self._wygas(application, chat_id)
+            elif (bezczynnosc >= CZAS_OSTRZEZENIA_SESJI and chat_data.get('odbiur_aktywny')
+                  and not chat_data.get('ostrzezono_o_wygasnieciu')):
+                await self._ostrzez(application, chat_id, chat_data, bezczynnosc)
+
+        for chat_id, ostatnia in list(self.uspione.items()):
+            if teraz - ostatnia >= CZAS_WYGASNIECIA_SESJI:
+                await self._wygas(application, chat_id)
+
+        self._pilnuj_budzetu(application, teraz)
+
+    async def _ostrzez(self, application: Application, chat_id, chat_data, bezczynnosc):
+        chat_data['ostrzezono_o_wygasnieciu'] = True
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+        pozostalo = max(CZAS_WYGASNIECIA_SESJI - bezczynnosc, 0) / 60
+        try:
+            await application.bot.send_message(
+                chat_id,
+                f"⏰ Odbiór <b>{chat_data.get('odbiur_identyfikator', '')}</b> jest nieaktywny od "
+                f"{bezczynnosc / 60:.0f} min.\n"
+                f"Za ok. {pozostalo:.0f} min zostanie automatycznie zakończony, "
+                f"a {len(chat_data.get('odbiur_wpisy', []))} usterek zapisanych w arkuszu.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("Zakończ Cały Odbiór 🏁", callback_data='koniec_odbioru')
+                ]]),
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.warning("Nie można wysłać ostrzeżenia o wygaśnięciu do czatu %s: %s", chat_id, e)
+
+    async def _wygas(self, application: Application, chat_id):
+        # Ta sama blokada co aktualizacje czatu - nie kończymy odbioru w trakcie dodawania usterki
+        async with application.update_processor.blokada_czatu(chat_id):
+            chat_data = self.przywroc(application, chat_id)
+            bezczynnosc = time.time() - chat_data.get('ostatnia_aktywnosc', 0)
+            if not chat_data or bezczynnosc < CZAS_WYGASNIECIA_SESJI:
+                return  # ktoś właśnie napisał
+
+            tekst = None
+            if chat_data.get('odbiur_aktywny'):
+                identyfikator_odbioru = chat_data.get('odbiur_identyfikator', 'Brak ID Odbioru')
+                wpisy_lista = chat_data.get('odbiur_wpisy', [])
+                naglowek = f"🏁 Odbiór zakończony automatycznie po {bezczynnosc / 60:.0f} min bezczynności.\n"
+
+                if wpisy_lista:
+                    # Bez czekania pod blokadą czatu: notatki w toku -> sesję weźmie następny przegląd
+                    wynik = await zapisz_odbior(chat_data, datetime.now(), czekaj_na_transkrypcje=False)
+                    if wynik is None:
+                        logger.info("Automatyczne zakończenie %s pominięte - transkrypcje w toku, ponowna próba za %s s",
+                                    identyfikator_odbioru, INTERWAL_SPRAWDZANIA_SESJI)
+                        return
+                    licznik_zapisanych, licznik_odlozonych = wynik
+                    if licznik_zapisanych + licznik_odlozonych < len(wpisy_lista):
+                        logger.error("Automatyczne zakończenie %s nie zapisało usterek - sesja zostaje, ponowna "
+                                     "próba za %s s", identyfikator_odbioru, INTERWAL_SPRAWDZANIA_SESJI)
+                        return
+                    tekst = naglowek + komunikat_zakonczenia(chat_data, licznik_zapisanych, licznik_odlozonych)
+                else:
+                    tekst = naglowek + f"Nie dodano żadnych usterek dla {identyfikator_odbioru}."
+
+                self.zakonczone_automatycznie += 1
+                logger.info("Automatycznie zakończono odbiór %s (czat %s, %s usterek)",
+                            identyfikator_odbioru, chat_id, len(wpisy_lista))
+
+            application.drop_chat_data(chat_id)
+
+        if tekst:
+            try:
+                await application.bot.send_message(chat_id, tekst, reply_markup=START_KEYBOARD)
+            except Exception as e:
+                logger.warning("Nie można powiadomić czatu %s o automatycznym zakończeniu: %s", chat_id, e)
+
+    def _rozmiar(self, chat_id, chat_data):
+        """
+        Rozmiar sesji po serializacji. Serializujemy tylko sesje, do których od poprzedniego pomiaru przyszła
+        aktualizacja (zmienił się znacznik aktywności), więc koszt na pętli zależy od ruchu, a nie od liczby sesji.
+        """
+        znacznik = chat_data.get('ostatnia_aktywnosc')
+        pomiar = self.rozmiary.get(chat_id)
+        if pomiar is None or pomiar[0] != znacznik:
+            pomiar = (znacznik, len(pickle.dumps(dict(chat_data), protocol=pickle.HIGHEST_PROTOCOL)))
+            self.rozmiary[chat_id] = pomiar
+        return pomiar[1]
+
+    def zmieniono(self, chat_id):
+        """Sesja zmieniona poza aktualizacją z czatu (np. transkrypcja w tle) - przy następnym sprawdzeniu pomiar od nowa."""
+        self.rozmiary.pop(chat_id, None)
+
+    def _pilnuj_budzetu(self, application: Application, teraz):
+        rozmiary = {
+            chat_id: self._rozmiar(chat_id, chat_data)
+            for chat_id, chat_data in application.chat_data.items() if chat_data
+        }
+        for chat_id in self.rozmiary.keys() - rozmiary.keys():
+            del self.rozmiary[chat_id]  # sesja uśpiona albo zakończona
+        self.zajeta_pamiec = sum(rozmiary.values())
+        if self.zajeta_pamiec <= BUDZET_PAMIECI_SESJI:
+            return
+
+        kandydaci = sorted((application.chat_data[chat_id].get('ostatnia_aktywnosc', teraz), chat_id)
+                           for chat_id in rozmiary)
+        for ostatnia, chat_id in kandydaci:
+            if self.zajeta_pamiec <= BUDZET_PAMIECI_SESJI or teraz - ostatnia < MIN_BEZCZYNNOSC_USPIENIA:
+                break
+            if application.update_processor.blokada_czatu(chat_id).locked():
+                continue  # aktualizacja tego czatu właśnie trwa
+            self.uspij(application, chat_id)
+            self.zajeta_pamiec -= rozmiary[chat_id]
+
+        if self.zajeta_pamiec > BUDZET_PAMIECI_SESJI:
+            logger.warning("Sesje zajmują %.1f MB mimo usypiania (budżet %.0f MB) - wszystkie są świeże",
+                           self.zajeta_pamiec / 1024 / 1024, BUDZET_PAMIECI_SESJI / 1024 / 1024)
+
+    async def raportuj(self, context: ContextTypes.DEFAULT_TYPE):
+        """Zadanie cykliczne (job_queue): stan sesji do logów."""
+        teraz = time.time()
+        sesje = [chat_data for chat_data in context.application.chat_data.values() if chat_data]
+        aktywne = [chat_data for chat_data in sesje if chat_data.get('odbiur_aktywny')]
+        bezczynne = sum(1 for chat_data in aktywne
+                        if teraz - chat_data.get('ostatnia_aktywnosc', teraz) >= CZAS_OSTRZEZENIA_SESJI)
+        logger.info("Sesje: %s w pamięci (%s aktywnych odbiorów, %s bezczynnych), %s uśpionych na dysku, ~%.0f KiB, "
+                    "automatycznie zakończonych: %s",
+                    len(sesje), len(aktywne), bezczynne, len(self.uspione), self.zajeta_pamiec / 1024,
+                    self.zakonczone_automatycznie)
+
+
+menedzer_sesji = MenedzerSesji(KATALOG_USPIONYCH_SESJI)
+
+
+# -----------------------------------------------------------
+# --- 6i. NOTATKI GŁOSOWE: transkrypcja w tle, paczkami ---
+# -----------------------------------------------------------
+# Notatki, które przyjdą w tym oknie, idą do Gemini jednym zapytaniem
+OKNO_PACZKI_TRANSKRYPCJI = float(os.getenv('OKNO_PACZKI_TRANSKRYPCJI', 2.0))
+MAKS_NOTATEK_W_PACZCE = int(os.getenv('MAKS_NOTATEK_W_PACZCE', 8))
+MAKS_BAJTOW_PACZKI = 15 * 1024 * 1024  # dane inline w jednym zapytaniu Gemini: limit 20 MB
+MAKS_DLUGOSC_NOTATKI = int(os.getenv('MAKS_DLUGOSC_NOTATKI_S', 180))
+# Tyle najwyżej czeka zakończenie odbioru na transkrypcje w toku; potem odbiór zostaje otwarty
+CZAS_OCZEKIWANIA_NA_TRANSKRYPCJE = 30
+
+
+class KolejkaTranskrypcji:
+    """
+    Notatka głosowa trafia do odbioru od razu jako wpis 'w toku' (oczekuje_transkrypcji), a tutaj, w tle:
+    zbieramy notatki przez OKNO_PACZKI_TRANSKRYPCJI, transkrybujemy paczkę jednym zapytaniem Gemini,
+    uzupełniamy opisy wpisów (pod blokadą czatu) i wysyłamy tekst na czat. Wpisy w toku są w chat_data,
+    więc przeżywają restart. Odbiór z wpisami w toku nie jest zapisywany - zastępczych opisów nie ma w arkuszu.
+    """
+
+    def __init__(self):
+        self.application = None
+        self.kolejka = None
+        self.oczekujace = {}  # usterka_id -> asyncio.Future (rozwiązana, gdy tekst jest gotowy)
+        self.wyniki = {}  # usterka_id -> (element, tekst) - gotowe, jeszcze nie wpisane do sesji
+
+    def uruchom(self, application: Application):
+        self.application = application
+        self.kolejka = asyncio.Queue()
+        application.create_task(self._petla(), name='transkrypcje')
+
+        wznowione = 0
+        for chat_id, chat_data in application.chat_data.items():
+            for wpis in chat_data.get('odbiur_wpisy', []):
+                if wpis.get('oczekuje_transkrypcji'):
+                    self.zglos(chat_id, chat_data, wpis)
+                    wznowione += 1
+        if wznowione:
+            logger.info("Wznowiono %s transkrypcji notatek głosowych z poprzedniego uruchomienia", wznowione)
+
+    def zglos(self, chat_id, chat_data, wpis) -> asyncio.Future:
+        przyszlosc = asyncio.get_running_loop().create_future()
+        self.oczekujace[wpis['id']] = przyszlosc
+        self.kolejka.put_nowait({
+            'chat_id': chat_id, 'usterka_id': wpis['id'], 'telegram_file_id': wpis['telegram_file_id'],
+            'mime': wpis.get('mime', 'audio/ogg'), 'lokal': wpis.get('lokal'), 'odbior_id': chat_data.get('odbiur_id')
+        })
+        return przyszlosc
+
+    async def poczekaj_na(self, chat_data, limit=CZAS_OCZEKIWANIA_NA_TRANSKRYPCJE) -> bool:
+        """
+        Przed zapisem odbioru: czeka na transkrypcje wpisów w toku (najwyżej `limit` s, 0 = bez czekania)
+        i sama wpisuje gotowe teksty - wołający trzyma blokadę czatu, więc _uzupelnij musiałby czekać na niego.
+        Zwraca False, jeśli któraś notatka jest nadal w toku (odbioru nie wolno wtedy zapisać).
+        """
+        if self.kolejka is None:
+            return True
+        w_toku = [wpis for wpis in chat_data.get('odbiur_wpisy', []) if wpis.get('oczekuje_transkrypcji')]
+        przyszlosci = [
+            self.oczekujace.get(wpis['id']) or self.zglos(chat_data.get('odbiur_czat_id'), chat_data, wpis)
+            for wpis in w_toku if wpis['id'] not in self.wyniki
+        ]
+        if przyszlosci and limit:
+            logger.info("Zakończenie odbioru czeka na %s transkrypcji...", len(przyszlosci))
+            await asyncio.wait(przyszlosci, timeout=limit)
+        for wpis in w_toku:
+            await self._zastosuj(chat_data, wpis['id'])
+        return not any(wpis.get('oczekuje_transkrypcji') for wpis in chat_data.get('odbiur_wpisy', []))
+
+    async def _petla(self):
+        while True:
+            paczka = [await self.kolejka.get()]
+            koniec_okna = time.monotonic() + OKNO_PACZKI_TRANSKRYPCJI
+            while len(paczka) < MAKS_NOTATEK_W_PACZCE:
+                try:
+                    paczka.append(await asyncio.wait_for(self.kolejka.get(), koniec_okna - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._przetworz(paczka)
+            except Exception as e:
+                logger.error("Błąd przetwarzania paczki transkrypcji: %s", e)
+                for element in paczka:
+                    if element['usterka_id'] in self.oczekujace:
+                        self._gotowe(element, None)
+                        with slad(odbior=element['odbior_id']):
+                            await self._uzupelnij(element)
+
+    async def _przetworz(self, paczka):
+        nagrania = []
+        for element in paczka:
+            try:
+                plik = await self.application.bot.get_file(element['telegram_file_id'])
+                nagrania.append((bytes(await plik.download_as_bytearray()), element['mime']))
+            except Exception as e:
+                logger.error("Nie można pobrać notatki głosowej %s: %s", element['usterka_id'], e)
+                nagrania.append(None)
+
+        # Podział na zapytania po MAKS_BAJTOW_PACZKI (w praktyce notatki mają po kilkadziesiąt KB)
+        teksty = [None] * len(paczka)
+        porcja, rozmiar_porcji = [], 0
+        for indeks, nagranie in enumerate(nagrania + [None]):
+            koniec = indeks == len(nagrania)
+            if porcja and (koniec or rozmiar_porcji + len(nagranie[0] if nagranie else b'') > MAKS_BAJTOW_PACZKI):
+                wyniki = await self._transkrybuj([nagrania[i] for i in porcja])
+                for i, tekst in zip(porcja, wyniki):
+                    teksty[i] = tekst
+                porcja, rozmiar_porcji = [], 0
+            if nagranie:
+                porcja.append(indeks)
+                rozmiar_porcji += len(nagranie[0])
+
+        logger.info("Transkrypcja paczki: %s z %s notatek rozpoznanych", sum(1 for t in teksty if t), len(paczka))
+        for element, tekst in zip(paczka, teksty):
+            self._gotowe(element, tekst)
+        for element in paczka:
+            with slad(odbior=element['odbior_id']):
+                await self._uzupelnij(element)
+
+    async def _transkrybuj(self, nagrania) -> list:
+        for proba in range(3):
+            try:
+                return await asyncio.to_thread(transkrybuj_notatki, nagrania)
+            except Exception as e:
+                logger.warning("Transkrypcja %s notatek nie powiodła się (próba %s): %s", len(nagrania), proba + 1, e)
+                if len(nagrania) > 1:
+                    # Paczka mogła pomylić liczbę/kolejność - pojedynczo jest pewniej
+                    return [(await self._transkrybuj([nagranie]))[0] for nagranie in nagrania]
+                await asyncio.sleep(2 ** proba)
+        return [None]
+
+    def _gotowe(self, element, tekst):
+        """Tekst jest gotowy: zapamiętuje go do wpisania i budzi zakończenie odbioru, jeśli na niego czeka."""
+        self.wyniki[element['usterka_id']] = (element, tekst)
+        przyszlosc = self.oczekujace.pop(element['usterka_id'], None)
+        if przyszlosc and not przyszlosc.done():
+            przyszlosc.set_result(None)
+
+    async def _uzupelnij(self, element):
+        # Ta sama blokada co aktualizacje czatu - nie zmieniamy sesji w trakcie obsługi wiadomości
+        chat_id = element['chat_id']
+        async with self.application.update_processor.blokada_czatu(chat_id):
+            await self._zastosuj(menedzer_sesji.przywroc(self.application, chat_id), element['usterka_id'])
+
+    async def _zastosuj(self, chat_data, usterka_id):
+        """Wpisuje gotową transkrypcję do sesji; wołać pod blokadą czatu."""
+        element, tekst = self.wyniki.pop(usterka_id, (None, None))
+        if element is None:
+            return  # jeszcze w toku albo już wpisana (np. przez poczekaj_na przy zakończeniu odbioru)
+        chat_id = element['chat_id']
+        wpis = next((w for w in chat_data.get('odbiur_wpisy', []) if w.get('id') == usterka_id), None)
+        if wpis is None:
+            return  # wpis cofnięto
+
+        prefix_lokalu = wpis.get('lokal')
+        if tekst:
+            lokal, szereg_name, reszta = rozpoznaj_lokal(tekst)
+            if lokal and szereg_name == chat_data.get('wybrany_szereg'):
+                prefix_lokalu, tekst = lokal, reszta
+
+        wpis.pop('oczekuje_transkrypcji', None)
+        if not tekst or not prefix_lokalu:
+            chat_data['odbiur_wpisy'].remove(wpis)
+            powod = "nie udało się rozpoznać nagrania" if not tekst else "nie wybrano lokalu ani nie podano go w nagraniu"
+            tresc = f" ('{html.escape(tekst)}')" if tekst else ""
+            await self._wyslij(chat_id, f"❌ Notatka głosowa nie została dodana - {powod}{tresc}.\n"
+                                        f"Wpisz usterkę tekstem albo nagraj ją ponownie.")
+        else:
+            podobny = indeks_duplikatow.znajdz(prefix_lokalu, tekst)
+            wpis['opis'] = f"{prefix_lokalu} - {tekst} (głos)"
+            indeks_duplikatow.dodaj(prefix_lokalu, usterka_id, tekst, opis_zrodla_sesji(chat_data))
+
+            komunikat = f"📝 Transkrypcja: <b>{html.escape(wpis['opis'])}</b>"
+            if podobny:
+                komunikat += (f"\n⚠️ Podobna usterka już istnieje ({int(podobny['podobienstwo'] * 100)}%): "
+                              f"<b>{html.escape(podobny['tekst'])}</b> ({podobny['zrodlo']}) - cofnij, jeśli to ta sama.")
+            await self._wyslij(chat_id, komunikat, get_inline_keyboard(usterka_id=usterka_id))
+
+        self.application.mark_data_for_update_persistence(chat_ids=chat_id)
+        menedzer_sesji.zmieniono(chat_id)
+
+    async def _wyslij(self, chat_id, tekst, reply_markup=None):
+        try:
+            await self.application.bot.send_message(chat_id, tekst, reply_markup=reply_markup, parse_mode='HTML')
+        except Exception as e:
+            logger.warning("Nie można wysłać transkrypcji do czatu %s: %s", chat_id, e)
+
+
+kolejka_transkrypcji = KolejkaTranskrypcji()
+
+
+# -----------------------------------------------------------
+# --- 6j. GALERIA: zdjęcia lokalu z lokalnej kopii listingów Drive ---
+# -----------------------------------------------------------
+PLIK_CACHE_GALERII = os.getenv('PLIK_CACHE_GALERII', 'galeria_drive.sqlite3')
+INTERWAL_SYNCHRONIZACJI_GALERII = int(os.getenv('INTERWAL_SYNCHRONIZACJI_GALERII', 300))
+ZDJEC_NA_STRONE_GALERII = 8
+POLA_PLIKU_DRIVE = 'id, name, mimeType, createdTime, parents, trashed'
+
+
+def miniatura_drive(file_id, szerokosc=400):
+    """Stały adres miniatury (dla zalogowanych z dostępem); thumbnailLink z API wygasa po kilku godzinach."""
+    return f"https://drive.google.com/thumbnail?id={file_id}&sz=w{szerokosc}"
+
+
+class CacheListingowDrive:
+    """
+    Lokalna kopia zawartości folderów lokali na Drive (SQLite). Folder jest listowany z Drive tylko raz,
+    przy pierwszym otwarciu galerii; dalej aktualizuje go wyłącznie feed zmian Drive (changes.list
+    od zapamiętanego tokenu), przetwarzany cyklicznie w tle. Przeglądanie galerii czyta tylko z bazy.
+    """
+
+    SCHEMAT = """
+        CREATE TABLE IF NOT EXISTS foldery (id TEXT PRIMARY KEY, nazwa TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS pliki (id TEXT PRIMARY KEY, folder_id TEXT NOT NULL, nazwa TEXT, mime TEXT, utworzono TEXT);
+        CREATE INDEX IF NOT EXISTS pliki_folder ON pliki(folder_id);
+        CREATE TABLE IF NOT EXISTS stan (klucz TEXT PRIMARY KEY, wartosc TEXT);
+    """
+
+    def __init__(self, sciezka):
+        self.baza = sqlite3.connect(sciezka, check_same_thread=False)
+        self.baza.row_factory = sqlite3.Row
+        self.blokada = threading.Lock()
+        with self.blokada:
+            self.baza.executescript(self.SCHEMAT)
+            self.baza.commit()
+
+    def _token(self):
+        with self.blokada:
+            wiersz = self.baza.execute("SELECT wartosc FROM stan WHERE klucz = 'token_zmian'").fetchone()
+        return wiersz['wartosc'] if wiersz else None
+
+    def _ustaw_token(self, token):
+        with self.blokada, self.baza:
+            self.baza.execute("INSERT OR REPLACE INTO stan (klucz, wartosc) VALUES ('token_zmian', ?)", (token,))
+
+    def lista(self, target_name) -> list:
+        """Pliki folderu lokalu, najnowsze pierwsze."""
+        with self.blokada:
+            znany = self.baza.execute("SELECT 1 FROM foldery WHERE nazwa = ?", (target_name,)).fetchone()
+        if not znany and not self._wczytaj_folder(target_name):
+            return []
+        with self.blokada:
+            wiersze = self.baza.execute(
+                "SELECT p.id, p.nazwa, p.mime, p.utworzono FROM pliki p JOIN foldery f ON p.folder_id = f.id "
+                "WHERE f.nazwa = ? ORDER BY p.utworzono DESC", (target_name,)
+            ).fetchall()
+        return [dict(wiersz) for wiersz in wiersze]
+
+    def _wczytaj_folder(self, target_name) -> bool:
+        if self._token() is None:
+            # Token pobrany przed listingiem - zmiany z czasu listowania przyjdą feedem
+            start = harmonogram.wywolaj('drive', 'odczyt', drive_service.changes().getStartPageToken().execute)
+            self._ustaw_token(start['startPageToken'])
+
+        folder_id = _cache_folderow_drive.get(target_name)
+        if not folder_id:
+            znalezione = _znajdz_folder_drive(target_name, g_drive_main_folder_id)
+            if not znalezione:
+                return False  # folder powstanie przy pierwszym zdjęciu
+            folder_id = znalezione[0]['id']
+            _cache_folderow_drive[target_name] = folder_id
+
+        pliki, strona = [], None
+        while True:
+            odpowiedz = harmonogram.wywolaj('drive', 'odczyt', drive_service.files().list(
+                q=f"'{folder_id}' in parents and trashed=false and mimeType != 'application/vnd.google-apps.folder'",
+                fields=f'nextPageToken, files({POLA_PLIKU_DRIVE})',
+                pageSize=1000,
+                pageToken=strona,
+                spaces='drive',
+            ).execute)
+            pliki.extend(odpowiedz.get('files', []))
+            strona = odpowiedz.get('nextPageToken')
+            if not strona:
+                break
+
+        with self.blokada, self.baza:
+            self.baza.execute("INSERT OR REPLACE INTO foldery (id, nazwa) VALUES (?, ?)", (folder_id, target_name))
+            self.baza.executemany(
+                "INSERT OR REPLACE INTO pliki (id, folder_id, nazwa, mime, utworzono) VALUES (?, ?, ?, ?, ?)",
+                [(p['id'], folder_id, p['name'], p.get('mimeType'), p.get('createdTime')) for p in pliki]
+            )
+        logger.info("Galeria: wczytano folder '%s' z Drive (%s plików)", target_name, len(pliki))
+        return True
+
+    def dodaj(self, target_name, file_id, nazwa, mime):
+        """Własny upload trafia do galerii od razu, nie dopiero z najbliższą synchronizacją."""
+        with self.blokada, self.baza:
+            self.baza.execute(
+                "INSERT OR REPLACE INTO pliki (id, folder_id, nazwa, mime, utworzono) "
+                "SELECT ?, id, ?, ?, ? FROM foldery WHERE nazwa = ?",
+                (file_id, nazwa, mime, datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'), target_name)
+            )
+
+    def usun(self, file_ids):
+        """Własne usunięcie (cofnięcie usterki) znika z galerii od razu, nie dopiero z feedem zmian."""
+        with self.blokada, self.baza:
+            self.baza.executemany("DELETE FROM pliki WHERE id = ?", [(file_id,) for file_id in file_ids])
+
+    @profilowane
+    def synchronizuj(self) -> int:
+        """Nanosi zmiany z feedu Drive na znane foldery. Zwraca liczbę dodanych/zmienionych/usuniętych plików."""
+        token = self._token()
+        if token is None:
+            return 0  # galerii jeszcze nikt nie otwierał
+        with self.blokada:
+            znane = {wiersz['id'] for wiersz in self.baza.execute("SELECT id FROM foldery")}
+
+        zastosowane = 0
+        while True:
+            odpowiedz = harmonogram.wywolaj('drive', 'odczyt', drive_service.changes().list(
+                pageToken=token,
+                spaces='drive',
+                pageSize=1000,
+                fields=f'nextPageToken, newStartPageToken, changes(fileId, removed, file({POLA_PLIKU_DRIVE}))',
+            ).execute)
+
+            with self.blokada, self.baza:
+                for zmiana in odpowiedz.get('changes', []):
+                    plik = zmiana.get('file') or {}
+                    folder_id = next((rodzic for rodzic in plik.get('parents', []) if rodzic in znane), None)
+                    if (zmiana.get('removed') or plik.get('trashed') or not folder_id
+                            or plik.get('mimeType') == 'application/vnd.google-apps.folder'):
+                        # Usunięty, w koszu albo przeniesiony poza znane foldery
+                        kursor = self.baza.execute("DELETE FROM pliki WHERE id = ?", (zmiana['fileId'],))
+                    else:
+                        kursor = self.baza.execute(
+                            "INSERT OR REPLACE INTO pliki (id, folder_id, nazwa, mime, utworzono) VALUES (?, ?, ?, ?, ?)",
+                            (plik['id'], folder_id, plik.get('name'), plik.get('mimeType'), plik.get('createdTime'))
+                        )
+                    zastosowane += kursor.rowcount
+
+            token = odpowiedz.get('nextPageToken') or odpowiedz.get('newStartPageToken')
+            self._ustaw_token(token)
+            if 'newStartPageToken' in odpowiedz:
+                return zastosowane
+
+
+cache_galerii = CacheListingowDrive(PLIK_CACHE_GALERII) if MAGAZYN_BACKEND == 'google' else None
+
+
+async def synchronizuj_galerie(context: ContextTypes.DEFAULT_TYPE):
+    """Zadanie cykliczne (job_queue): feed zmian Drive -> lokalna kopia listingów."""
+    try:
+        with w_tle():
+            zmiany = await asyncio.to_thread(cache_galerii.synchronizuj)
+    except Exception as e:
+        logger.error("Galeria: błąd synchronizacji zmian z Drive: %s", e)
+        return
+    if zmiany:
+        logger.info("Galeria: naniesiono %s zmian z Drive", zmiany)
+
+
+def strona_galerii(lokal, pliki: list, strona: int):
+    """Tekst (HTML) i klawiatura jednej strony galerii lokalu."""
+    liczba_stron = max((len(pliki) + ZDJEC_NA_STRONE_GALERII - 1) // ZDJEC_NA_STRONE_GALERII, 1)
+    strona = min(max(strona, 1), liczba_stron)
+
+    if not pliki:
+        return f"🖼 Lokal <b>{lokal}</b>: brak zdjęć i nagrań w magazynie.", None
+
+    poczatek = (strona - 1) * ZDJEC_NA_STRONE_GALERII
+    linie = [f"🖼 Lokal <b>{lokal}</b>: {len(pliki)} plików (strona {strona}/{liczba_stron})", ""]
+    for numer, plik in enumerate(pliki[poczatek:poczatek + ZDJEC_NA_STRONE_GALERII], start=poczatek + 1):
+        ikona = '🎥' if (plik.get('mime') or '').startswith('video/') else '📷'
+        nazwa = html.escape(plik.get('nazwa') or plik['id'])
+        if plik.get('link'):
+            nazwa = f"<a href=\"{html.escape(plik['link'])}\">{nazwa}</a>"
+        miniatura = f" · <a href=\"{html.escape(plik['miniatura'])}\">miniatura</a>" if plik.get('miniatura') else ""
+        data = (plik.get('utworzono') or '')[:10]
+        linie.append(f"{numer}. {ikona} {nazwa}{miniatura} — {data}")
+
+    przyciski = []
+    if strona > 1:
+        przyciski.append(InlineKeyboardButton("⬅️", callback_data=f"galeria_{lokal}_{strona - 1}"))
+    przyciski.append(InlineKeyboardButton(f"{strona}/{liczba_stron}", callback_data="noop"))
+    if strona < liczba_stron:
+        przyciski.append(InlineKeyboardButton("➡️", callback_data=f"galeria_{lokal}_{strona + 1}"))
+    return "\n".join(linie), InlineKeyboardMarkup([przyciski])
+
+
+# --- Handler komendy /raport ---
+async def raport_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Generuje protokół HTML (odbiór / szereg / firma) z lokalnego magazynu i wysyła go jako plik."""
+    lokalny = lokalny_magazyn()
+    if not lokalny:
+        await update.message.reply_text("Raporty wymagają lokalnego magazynu (MAGAZYN_BACKEND='lokalny' lub 'lokalny+google').")
+        return
+
+    filtr, tytul = filtr_raportu(context.args or [], update.effective_chat.id)
+    if filtr is None:
+        await update.message.reply_text(tytul)
+        return
 
+    await update.message.reply_text("📄 Generuję raport...")
+
+    sciezka_wyjscia = os.path.join(KATALOG_RAPORTOW, f"raport_{uuid.uuid4().hex}.html")
+    try:
+        # Całość, łącznie z zapytaniem o ostatni odbiór czatu, w wątku raportów - nic z SQLite na pętli zdarzeń
+        loop = asyncio.get_running_loop()
+        liczba, tytul = await loop.run_in_executor(
+            pula_raportow, generuj_raport_html,
+            lokalny.sciezka_bazy, lokalny.katalog_plikow, filtr, tytul, sciezka_wyjscia
+        )
+        if liczba is None:
+            await update.message.reply_text("Brak zapisanych odbiorów z tego czatu. Użyj /raport szereg N lub /raport firma X.")
+            return
+        if not liczba:
+            await update.message.reply_text("Brak usterek spełniających kryteria raportu.")
+            return
+
+        nazwa_pliku = re.sub(r'[^\w.-]+', '_', tytul) + ".html"
+        with open(sciezka_wyjscia, 'rb') as f:
+            await update.message.reply_document(f, filename=nazwa_pliku, caption=f"{tytul}\nUsterek: {liczba}")
     except Exception as e:
-        logger.error(f"Błąd podczas zapisu do Google Sheets: {e}")
-        return False
+        logger.error("Błąd generowania raportu: %s", e)
+        await update.message.reply_text(f"❌ Nie udało się wygenerować raportu: {e}")
+    finally:
+        if os.path.exists(sciezka_wyjscia):
+            os.remove(sciezka_wyjscia)
 
 
-# --- FUNKCJA WYSYŁANIA NA GOOGLE DRIVE ---
-def upload_photo_to_drive(file_bytes, target_name, usterka_name, podmiot_name, tryb_odbioru='lokal'):
-    """Wyszukuje podfolder (lokalu lub szeregu) i wysyła do niego zdjęcie."""
-    global drive_service, g_drive_main_folder_id, G_DRIVE_MAIN_FOLDER_NAME
-    
+# --- Handler komendy /zdjecia ---
+async def zdjecia_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/zdjecia 49/1 - galeria zdjęć i nagrań lokalu (bez argumentu: aktywny lokal sesji)."""
+    lokal, _, _ = rozpoznaj_lokal(" ".join(context.args or []))
+    lokal = lokal or context.chat_data.get('biezacy_lokal_w_szeregu')
+    if not lokal:
+        await update.message.reply_text("Podaj numer lokalu, np. /zdjecia 49/1")
+        return
+
     try:
-        parent_folder_id = g_drive_main_folder_id
-        
-        q_str = f"name='{target_name}' and mimeType='application/vnd.google-apps.folder' and '{parent_folder_id}' in parents and trashed=False"
-        
-        response = drive_service.files().list(
-            q=q_str,
-            spaces='drive',
-            fields='files(id, name)',
-        ).execute()
-        
-        target_folder = response.get('files', [])
+        pliki = await asyncio.to_thread(magazyn.lista_plikow, lokal.replace('/', '.'))
+    except Exception as e:
+        logger.error("Błąd pobierania listy plików lokalu %s: %s", lokal, e)
+        await update.message.reply_text(f"❌ Nie udało się pobrać listy zdjęć: {e}")
+        return
 
-        if not target_folder:
-            logger.warning(f"Nie znaleziono folderu '{target_name}'. Tworzenie nowego...")
-            try:
-                folder_metadata = {
-                    'name': target_name,
-                    'mimeType': 'application/vnd.google-apps.folder',
-                    'parents': [parent_folder_id]
-                }
-                created_folder = drive_service.files().create(body=folder_metadata, fields='id').execute()
-                target_folder_id = created_folder.get('id')
-                logger.info(f"Pomyślnie utworzono folder '{target_name}' (ID: {target_folder_id})")
-            except Exception as e:
-                logger.error(f"KRYTYCZNY BŁĄD: Nie można utworzyć folderu na Drive: {e}")
-                return False, f"Błąd tworzenia folderu na Drive: {e}", None
+    tekst, klawiatura = strona_galerii(lokal, pliki, 1)
+    await update.message.reply_text(tekst, reply_markup=klawiatura, parse_mode='HTML', disable_web_page_preview=True)
+
+
+# --- Handler komendy /profil (tylko administratorzy) ---
+async def profil_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profil [sekundy] | /profil n=LICZBA_AKTUALIZACJI | /profil stop"""
+    if update.effective_user.id not in ADMIN_IDS:
+        logger.warning("Odmowa /profil dla użytkownika %s", update.effective_user.id)
+        return
+
+    argumenty = context.args or []
+    if argumenty and argumenty[0] == 'stop':
+        if profiler.aktywny:
+            profiler.koniec.set()
         else:
-            target_folder_id = target_folder[0].get('id')
-        
-        file_name = f"{usterka_name} - {podmiot_name}.jpg"
-        file_metadata = {
-            'name': file_name,
-            'parents': [target_folder_id]
-        }
-        
-        file_bytes.seek(0)
-        media = MediaIoBaseUpload(file_bytes, mimetype='image/jpeg', resumable=True)
-        
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id',
-        ).execute()
-        
-        file_id = file.get('id')
-        logger.info(f"Pomyślnie wysłano plik '{file_name}' do folderu '{target_name}' (ID: {file_id})")
-        return True, file_name, file_id
-    
-    except Exception as e:
-        logger.error(f"Błąd podczas wysyłania na Google Drive: {e}")
-        return False, str(e), None
+            await update.message.reply_text("Profilowanie nie jest włączone.")
+        return
 
+    if profiler.aktywny:
+        await update.message.reply_text("Profilowanie już trwa. Zakończ je: /profil stop")
+        return
 
-# --- Funkcja do usuwania pliku z Google Drive ---
-def delete_file_from_drive(file_id):
-    """Usuwa plik z Google Drive na podstawie jego ID."""
-    global drive_service
-    if not file_id:
-        logger.warning("Próba usunięcia pliku, ale brak file_id.")
-        return False, "Brak ID pliku"
-        
+    sekundy, limit_aktualizacji = 60.0, None
     try:
-        drive_service.files().delete(fileId=file_id).execute()
-        logger.info(f"Pomyślnie usunięto plik z Drive (ID: {file_id})")
-        return True, None
-    except Exception as e:
-        logger.error(f"Błąd podczas usuwania pliku {file_id} z Drive: {e}")
-        return False, str(e)
+        for argument in argumenty:
+            if argument.startswith('n='):
+                limit_aktualizacji = int(argument[2:])
+                sekundy = 600.0  # przy limicie aktualizacji czas jest tylko zabezpieczeniem
+            else:
+                sekundy = min(float(argument), 600.0)
+    except ValueError:
+        await update.message.reply_text("Użycie: /profil [sekundy] | /profil n=LICZBA | /profil stop")
+        return
 
+    await update.message.reply_text(f"🔬 Profilowanie włączone (do {sekundy:.0f} s"
+                                    + (f" lub {limit_aktualizacji} aktualizacji" if limit_aktualizacji else "") + ").")
+    context.application.create_task(profiluj(context.bot, [update.effective_chat.id], sekundy, limit_aktualizacji))
 
-# --- 6b. Funkcje do budowania klawiatur dynamicznych ---
 
-def build_szereg_keyboard():
-    """Tworzy klawiaturę wyboru Szeregu (z ZAKRESEM)."""
-    keyboard = []
-    row = []
-    sorted_keys = sorted(DANE_SZEREGOW.keys(), key=lambda x: int(x.split(' ')[1]))
-    
-    for szereg_name in sorted_keys:
-        dane = DANE_SZEREGOW[szereg_name]
-        zakres = dane['zakres']
-        button_text = f"{szereg_name} ({zakres})"
-        
-        row.append(InlineKeyboardButton(button_text, callback_data=f"szereg_{szereg_name}"))
-        if len(row) >= 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-    
-    keyboard.append([InlineKeyboardButton("<< Anuluj", callback_data="start_menu")])
-    return InlineKeyboardMarkup(keyboard)
+# --- Handler komendy /limity (tylko administratorzy) ---
+async def limity_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Bieżący zapas limitów Google (żetony w kubełkach) i statystyki harmonogramu."""
+    if update.effective_user.id not in ADMIN_IDS:
+        logger.warning("Odmowa /limity dla użytkownika %s", update.effective_user.id)
+        return
+
+    linie = ["📊 Zapas limitów Google (żetony / pojemność, limit na minutę):"]
+    for (api, klasa), stan in harmonogram.zapas().items():
+        procent = max(stan['tokeny'], 0) / stan['pojemnosc'] * 100
+        linie.append(f"{'🟢' if procent > 50 else '🟡' if procent > 0 else '🔴'} {api}/{klasa}: "
+                     f"{stan['tokeny']:.1f}/{stan['pojemnosc']:.0f} ({stan['limit']}/min) · "
+                     f"wywołania {stan['wywolania']}, czekało {stan['oczekiwania']}, "
+                     f"ponowienia {stan['ponowienia']}, 429: {stan['429']}")
+    await update.message.reply_text("\n".join(linie))
 
 
 # --- Handler komendy /start ---
@@ -544,7 +3614,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"🔎 Szukam firmy pasującej do: '{wpis_usera}'...")
         
         # --- WYWOŁANIE AI DO DOPASOWANIA FIRMY ---
-        firma = dopasuj_firme_ai(wpis_usera)
+        firma = await asyncio.to_thread(dopasuj_firme_ai, wpis_usera)
         # -----------------------------------------
 
         szereg_name = chat_data.get('wybrany_szereg', 'BŁĄD STANU')
@@ -558,6 +3628,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         chat_data['odbiur_aktywny'] = True
         chat_data['odbiur_identyfikator'] = target_name 
+        chat_data['odbiur_id'] = str(uuid.uuid4())
+        _slad_odbioru.set(chat_data['odbiur_id'])
+        chat_data['odbiur_czat_id'] = update.effective_chat.id
         chat_data['odbiur_target_nazwa_do_zdjec'] = None
         chat_data['tryb_odbioru'] = "szereg"
         chat_data['odbiur_podmiot'] = firma
@@ -571,7 +3644,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await update.message.reply_text(f"✅ Rozpoczęto odbiór dla: <b>CAŁY {target_name}</b>\n"
                                         f"Wykonawca: <b>{firma}</b>\n\n"
-                                        f"Teraz <b>koniecznie wybierz lokal z przycisków poniżej</b> i wpisuj usterki.\n",
+                                        f"Teraz <b>koniecznie wybierz lokal z przycisków poniżej</b> i wpisuj usterki.\n"
+                                        f"Możesz też zaczynać wpis od numeru lokalu, np. <b>49/1 pęknięty tynk</b>.\n",
                                         reply_markup=get_inline_keyboard(usterka_id=None, context=context),
                                         parse_mode='HTML')
         return
@@ -594,45 +3668,26 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_message.lower().strip() == 'koniec odbioru':
             if chat_data.get('odbiur_aktywny'):
                 identyfikator_odbioru = chat_data.get('odbiur_identyfikator', 'Brak ID Odbioru')
-                podmiot = chat_data.get('odbiur_podmiot')
                 wpisy_lista = chat_data.get('odbiur_wpisy', [])
-                
+
                 if not wpisy_lista:
                     await update.message.reply_text(f"Zakończono odbiór dla {identyfikator_odbioru}. Nie dodano żadnych usterek.",
                                                     reply_markup=START_KEYBOARD)
                 else:
-                    logger.info(f"Zapisywanie {len(wpisy_lista)} usterek dla {identyfikator_odbioru}...")
-                    licznik_zapisanych = 0
-                    
-                    for wpis in wpisy_lista:
-                        opis_caly = wpis.get('opis', 'BŁĄD WPISU')
-                        
-                        lokal_dla_wpisu = identyfikator_odbioru 
-                        usterka_dla_wpisu = opis_caly
-
-                        if ' - ' in opis_caly:
-                            parts = opis_caly.split(' - ', 1)
-                            if len(parts) == 2:
-                                lokal_dla_wpisu = parts[0]
-                                usterka_dla_wpisu = parts[1]
-                        
-                        dane_json = {
-                            "numer_lokalu_budynku": lokal_dla_wpisu,
-                            "rodzaj_usterki": usterka_dla_wpisu,
-                            "podmiot_odpowiedzialny": podmiot,
-                            "link_do_zdjecia": ""
-                        }
-                        file_id_ze_zdjecia = wpis.get('file_id')
-                        if file_id_ze_zdjecia:
-                            link_zdjecia = f"https://drive.google.com/file/d/{file_id_ze_zdjecia}/view"
-                            dane_json['link_do_zdjecia'] = link_zdjecia
-                        
-                        if zapisz_w_arkuszu(dane_json, message_time):
-                            licznik_zapisanych += 1
-                    
-                    await update.message.reply_text(f"✅ Zakończono odbiór.\nZapisano {licznik_zapisanych} z {len(wpisy_lista)} usterek dla {identyfikator_odbioru}.",
+                    wynik = await zapisz_odbior(chat_data, message_time)
+                    if wynik is None:
+                        await update.message.reply_text(KOMUNIKAT_TRANSKRYPCJE_W_TOKU,
+                                                        reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+                        return
+                    if sum(wynik) < len(wpisy_lista):
+                        # Zapis hurtowy jest wszystko-albo-nic: sesja zostaje, żeby usterki nie przepadły
+                        logger.error("Zakończenie %s nie zapisało usterek - sesja zostaje", identyfikator_odbioru)
+                        await update.message.reply_text(KOMUNIKAT_ZAPIS_NIEUDANY,
+                                                        reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+                        return
+                    await update.message.reply_text(komunikat_zakonczenia(chat_data, *wynik),
                                                     reply_markup=START_KEYBOARD)
-                
+
                 chat_data.clear()
             else:
                 await update.message.reply_text("Żaden odbiór nie jest aktywny.",
@@ -641,108 +3696,129 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # SCENARIUSZ 3: Odbiór jest AKTYWNY, a to jest usterka TEKSTOWA
         if chat_data.get('odbiur_aktywny'):
-            logger.info(f"Odbiór aktywny. Zapisywanie usterki tekstowej: '{user_message}'")
+            logger.debug("Odbiór aktywny. Zapisywanie usterki tekstowej: '%s'", user_message)
             
-            usterka_opis_raw = user_message.strip()
+            usterka_opis_raw, blad_lokalu = zastosuj_lokal_z_tekstu(chat_data, user_message.strip())
+            if blad_lokalu:
+                await update.message.reply_text(blad_lokalu,
+                                                reply_markup=get_inline_keyboard(usterka_id=None, context=context),
+                                                parse_mode='HTML')
+                return
+
             prefix_lokalu = chat_data.get('biezacy_lokal_w_szeregu')
-            
+
             if not prefix_lokalu:
                 await update.message.reply_text(
                     "❌ BŁĄD: Nie wybrano lokalu.\n\n"
-                    "Proszę, <b>wybierz lokal z przycisków poniżej</b> i wpisz usterkę ponownie.",
+                    "Proszę, <b>wybierz lokal z przycisków poniżej</b> (albo zacznij wpis od numeru, np. '49/1 pęknięty tynk') "
+                    "i wpisz usterkę ponownie.",
                     reply_markup=get_inline_keyboard(usterka_id=None, context=context),
                     parse_mode='HTML'
                 )
                 return
 
-            # Połączenie lokal + tekst usterki
-            usterka_opis = f"{prefix_lokalu} - {usterka_opis_raw}"
-            
-            usterka_id = str(uuid.uuid4())
-            nowy_wpis = {
-                'id': usterka_id,
-                'typ': 'tekst',
-                'opis': usterka_opis
-            }
-            chat_data['odbiur_wpisy'].append(nowy_wpis)
-            
-            await update.message.reply_text(f"➕ Dodano: <b>{usterka_opis}</b>\n"
-                                            f"(Łącznie: {len(chat_data['odbiur_wpisy'])}).",
-                                            reply_markup=get_inline_keyboard(usterka_id=usterka_id, context=context),
-                                            parse_mode='HTML')
+            nagranie = chat_data.pop('oczekujace_nagranie', None)
+            if nagranie and usterka_opis_raw:
+                await zglos_duzy_plik(update.message, context, nagranie, prefix_lokalu, usterka_opis_raw)
+                return
+            if nagranie:
+                chat_data['oczekujace_nagranie'] = nagranie  # sam numer lokalu - opis wciąż potrzebny
+
+            if not usterka_opis_raw:
+                # Sam numer lokalu (np. "49/1") - tylko przełączamy aktywny lokal
+                await update.message.reply_text(f"Aktywny lokal dla usterek: <b>{prefix_lokalu}</b>",
+                                                reply_markup=get_inline_keyboard(usterka_id=None, context=context),
+                                                parse_mode='HTML')
+                return
+
+            podobny = indeks_duplikatow.znajdz(prefix_lokalu, usterka_opis_raw)
+            if podobny:
+                await zapytaj_o_duplikat(update.message, context,
+                                         {'typ': 'tekst', 'lokal': prefix_lokalu, 'opis_raw': usterka_opis_raw}, podobny)
+                return
+
+            await dodaj_wpis_tekstowy(update.message, context, prefix_lokalu, usterka_opis_raw)
             return
 
     except Exception as session_err:
-        logger.error(f"Wystąpił nieoczekiwany błąd w logice sesji: {session_err}")
+        logger.error("Wystąpił nieoczekiwany błąd w logice sesji: %s", session_err)
         await update.message.reply_text(f"❌ Wystąpił krytyczny błąd: {session_err}", reply_markup=START_KEYBOARD)
         return
 
     # --- FALLBACK ---
     if not chat_data.get('odbiur_aktywny'):
-        logger.warning(f"Otrzymano nieobsługiwaną wiadomość poza sesją: {user_message}")
+        logger.warning("Otrzymano nieobsługiwaną wiadomość poza sesją: %s", user_message)
         await update.message.reply_text(
             "Nieprawidłowa komenda. Aby rozpocząć, naciśnij przycisk 'NOWY ODBIÓR'.",
             reply_markup=START_KEYBOARD
         )
 
 
-# --- 7b. HANDLER DLA ZDJĘĆ ---
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Przechwytuje zdjęcie W TRAKCIE aktywnej sesji odbioru."""
+# --- 7a. Dodawanie wpisów do sesji (wspólne dla handlerów i potwierdzenia duplikatu) ---
+async def dodaj_wpis_tekstowy(wiadomosc, context: ContextTypes.DEFAULT_TYPE, prefix_lokalu, usterka_opis_raw):
+    """Dodaje usterkę tekstową do listy odbioru i odpowiada na podaną wiadomość."""
     chat_data = context.chat_data
+
+    # Połączenie lokal + tekst usterki
+    usterka_opis = f"{prefix_lokalu} - {usterka_opis_raw}"
     
-    if not chat_data.get('odbiur_aktywny'):
-        await update.message.reply_text("Wyślij zdjęcie *po* rozpoczęciu odbioru. Teraz ta fotka zostanie zignorowana.",
-                                        reply_markup=START_KEYBOARD)
-        return
+    usterka_id = str(uuid.uuid4())
+    nowy_wpis = {
+        'id': usterka_id,
+        'typ': 'tekst',
+        'opis': usterka_opis
+    }
+    chat_data['odbiur_wpisy'].append(nowy_wpis)
+    indeks_duplikatow.dodaj(prefix_lokalu, usterka_id, usterka_opis_raw, opis_zrodla_sesji(chat_data))
+    
+    await wiadomosc.reply_text(f"➕ Dodano: <b>{usterka_opis}</b>\n"
+                               f"(Łącznie: {len(chat_data['odbiur_wpisy'])}).",
+                               reply_markup=get_inline_keyboard(usterka_id=usterka_id, context=context),
+                               parse_mode='HTML')
 
-    usterka_opis_raw = update.message.caption
-    if not usterka_opis_raw:
-        await update.message.reply_text("❌ Zdjęcie musi mieć opis (usterkę)!",
-                                        reply_markup=get_inline_keyboard(usterka_id=None, context=context))
-        return
 
+async def dodaj_zdjecie(wiadomosc, context: ContextTypes.DEFAULT_TYPE, telegram_file_id, prefix_lokalu, usterka_opis_raw):
+    """Pobiera zdjęcie z Telegrama, zapisuje je w magazynie i dodaje usterkę do listy odbioru."""
+    chat_data = context.chat_data
     podmiot = chat_data.get('odbiur_podmiot')
     tryb = chat_data.get('tryb_odbioru')
-    
-    prefix_lokalu = chat_data.get('biezacy_lokal_w_szeregu') # Np. "70/1"
-    
+
     opis_do_nazwy_pliku = usterka_opis_raw.strip()
-    
-    target_folder_name = ""
-    
-    if prefix_lokalu:
-        target_folder_name = prefix_lokalu.replace('/', '.')
-        opis_do_arkusza = f"{prefix_lokalu} - {usterka_opis_raw} (zdjęcie)"
-    else:
-        await update.message.reply_text(
-            "❌ BŁĄD: Nie wybrano lokalu dla zdjęcia.\n\n"
-            "Proszę, <b>wybierz lokal z przycisków poniżej</b> i wyślij zdjęcie ponownie.",
-            reply_markup=get_inline_keyboard(usterka_id=None, context=context),
-            parse_mode='HTML'
-        )
-        return
+    target_folder_name = prefix_lokalu.replace('/', '.')
+    opis_do_arkusza = f"{prefix_lokalu} - {usterka_opis_raw} (zdjęcie)"
 
-    await update.message.reply_text(f"Otrzymano zdjęcie dla usterki: '{opis_do_nazwy_pliku}'.\n"
-                                    f"Wysyłam do folderu: <b>{target_folder_name}</b>...",
-                                    reply_markup=get_inline_keyboard(usterka_id=None, context=context),
-                                    parse_mode='HTML')
+    await wiadomosc.reply_text(f"Otrzymano zdjęcie dla usterki: '{opis_do_nazwy_pliku}'.\n"
+                               f"Wysyłam do folderu: <b>{target_folder_name}</b>...",
+                               reply_markup=get_inline_keyboard(usterka_id=None, context=context),
+                               parse_mode='HTML')
 
     try:
-        photo_file = await update.message.photo[-1].get_file()
+        photo_file = await context.bot.get_file(telegram_file_id)
         file_bytes_io = io.BytesIO()
         await photo_file.download_to_memory(file_bytes_io)
         
-        success, message, file_id = upload_photo_to_drive(
+        usterka_id = str(uuid.uuid4())
+        zadanie = {
+            'typ': 'zdjecie', 'chat_id': wiadomosc.chat_id, 'odbiur': chat_data.get('odbiur_identyfikator'),
+            'usterka_id': usterka_id, 'opis': opis_do_arkusza, 'target': target_folder_name,
+            'usterka': opis_do_nazwy_pliku, 'podmiot': podmiot, 'tryb': tryb, 'plik': file_bytes_io
+        }
+        wynik = await menedzer_cyklu.wykonaj(
+            zadanie,
+            magazyn.zapisz_zdjecie,
             file_bytes_io, 
             target_folder_name,
             opis_do_nazwy_pliku,
             podmiot, 
             tryb_odbioru=tryb
         )
+        if wynik is ODLOZONO:
+            await wiadomosc.reply_text("⏳ Bot jest właśnie restartowany. Zdjęcie zostanie wysłane na Drive "
+                                       "i dodane do odbioru zaraz po ponownym uruchomieniu.")
+            return
+        success, message, file_id = wynik
         
         if success:
-            usterka_id = str(uuid.uuid4())
             nowy_wpis = {
                 'id': usterka_id,
                 'typ': 'zdjecie',
@@ -750,20 +3826,318 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'file_id': file_id
             }
             chat_data['odbiur_wpisy'].append(nowy_wpis)
+            indeks_duplikatow.dodaj(prefix_lokalu, usterka_id, usterka_opis_raw, opis_zrodla_sesji(chat_data))
             
-            await update.message.reply_text(f"✅ Zdjęcie zapisane na Drive jako: <b>{message}</b>\n"
-                                            f"➕ Usterka dodana do listy: <b>{opis_do_arkusza}</b>\n"
-                                            f"(Łącznie: {len(chat_data['odbiur_wpisy'])}).",
-                                            reply_markup=get_inline_keyboard(usterka_id=usterka_id, context=context),
-                                            parse_mode='HTML')
+            await wiadomosc.reply_text(f"✅ Zdjęcie zapisane jako: <b>{message}</b>\n"
+                                       f"➕ Usterka dodana do listy: <b>{opis_do_arkusza}</b>\n"
+                                       f"(Łącznie: {len(chat_data['odbiur_wpisy'])}).",
+                                       reply_markup=get_inline_keyboard(usterka_id=usterka_id, context=context),
+                                       parse_mode='HTML')
         else:
-            await update.message.reply_text(f"❌ Błąd Google Drive: {message}",
-                                            reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+            await wiadomosc.reply_text(f"❌ Błąd zapisu zdjęcia: {message}",
+                                       reply_markup=get_inline_keyboard(usterka_id=None, context=context))
             
     except Exception as e:
-        logger.error(f"Błąd podczas przetwarzania zdjęcia: {e}")
-        await update.message.reply_text(f"❌ Wystąpił błąd przy pobieraniu zdjęcia: {e}",
+        logger.error("Błąd podczas przetwarzania zdjęcia: %s", e)
+        await wiadomosc.reply_text(f"❌ Wystąpił błąd przy pobieraniu zdjęcia: {e}",
+                                   reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+
+
+def _zaloguj_blad_postepu(przyszlosc):
+    """Callback do future z run_coroutine_threadsafe: nieudana edycja komunikatu o postępie trafia do logów."""
+    if przyszlosc.cancelled():
+        return
+    blad = przyszlosc.exception()
+    if blad:
+        logger.warning("Nie udało się zaktualizować postępu wysyłania: %s", blad)
+
+
+async def dodaj_duzy_plik(wiadomosc, context: ContextTypes.DEFAULT_TYPE, media: dict, prefix_lokalu, usterka_opis_raw):
+    """
+    Pobiera nagranie/plik z Telegrama na dysk i wysyła do magazynu kawałkami, pokazując postęp w jednej wiadomości.
+    Przy zamknięciu bota zadanie (ze ścieżką pliku i resumable_uri) trafia do zaległych i jest wznawiane po restarcie.
+    """
+    chat_data = context.chat_data
+    podmiot = chat_data.get('odbiur_podmiot')
+    tryb = chat_data.get('tryb_odbioru')
+    rozmiar_mb = media['rozmiar'] / 1024 / 1024
+
+    if media['rozmiar'] > LIMIT_POBIERANIA_TELEGRAM:
+        await wiadomosc.reply_text(f"❌ Plik ma {rozmiar_mb:.0f} MB - bot może pobrać najwyżej "
+                                   f"{LIMIT_POBIERANIA_TELEGRAM // 1024 // 1024} MB. Skróć nagranie i wyślij ponownie.",
+                                   reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+        return
+
+    opis_do_nazwy_pliku = usterka_opis_raw.strip()
+    target_folder_name = prefix_lokalu.replace('/', '.')
+    dopisek = 'wideo' if media['rodzaj'] == 'wideo' else 'zdjęcie'
+    opis_do_arkusza = f"{prefix_lokalu} - {usterka_opis_raw} ({dopisek})"
+
+    status = await wiadomosc.reply_text(
+        f"⏳ {'Oczekuje w kolejce' if _semafor_duzych_plikow.locked() else 'Pobieram'}: "
+        f"'{opis_do_nazwy_pliku}' ({rozmiar_mb:.1f} MB) -> folder <b>{target_folder_name}</b>",
+        parse_mode='HTML'
+    )
+
+    petla = asyncio.get_running_loop()
+    ostatnia_aktualizacja = [0.0]
+
+    def postep(wyslane, rozmiar, resumable_uri):
+        # Wołane z wątku uploadu po każdym fragmencie
+        zadanie['resumable_uri'] = resumable_uri
+        if time.monotonic() - ostatnia_aktualizacja[0] < 3 or wyslane >= rozmiar:
+            return
+        ostatnia_aktualizacja[0] = time.monotonic()
+        procent = 100 * wyslane // max(rozmiar, 1)
+        asyncio.run_coroutine_threadsafe(
+            status.edit_text(f"📤 Wysyłanie '{opis_do_nazwy_pliku}': {procent}% "
+                             f"({wyslane / 1024 / 1024:.1f} / {rozmiar / 1024 / 1024:.1f} MB)"),
+            petla
+        ).add_done_callback(_zaloguj_blad_postepu)
+
+    usterka_id = str(uuid.uuid4())
+    os.makedirs(KATALOG_PRZESYLANYCH, exist_ok=True)
+    sciezka = os.path.join(KATALOG_PRZESYLANYCH, f"{usterka_id}{media['rozszerzenie']}")
+    zadanie = {
+        'typ': 'duzy_plik', 'chat_id': wiadomosc.chat_id, 'odbiur': chat_data.get('odbiur_identyfikator'),
+        'usterka_id': usterka_id, 'opis': opis_do_arkusza, 'target': target_folder_name,
+        'usterka': opis_do_nazwy_pliku, 'podmiot': podmiot, 'tryb': tryb, 'rodzaj': media['rodzaj'],
+        'mimetype': media['mimetype'], 'rozszerzenie': media['rozszerzenie'], 'sciezka_pliku': sciezka,
+        'resumable_uri': None
+    }
+
+    odlozono = False
+    try:
+        async with _semafor_duzych_plikow:
+            plik_telegram = await context.bot.get_file(media['telegram_file_id'])
+            await plik_telegram.download_to_drive(sciezka)
+
+            wynik = await menedzer_cyklu.wykonaj(
+                zadanie,
+                magazyn.zapisz_duzy_plik,
+                sciezka, target_folder_name, opis_do_nazwy_pliku, podmiot, tryb,
+                media['mimetype'], media['rozszerzenie'],
+                postep=postep
+            )
+        if wynik is ODLOZONO:
+            odlozono = True
+            await status.edit_text("⏳ Bot jest właśnie restartowany. Wysyłanie zostanie wznowione "
+                                   "i plik dodany do odbioru zaraz po ponownym uruchomieniu.")
+            return
+        success, message, file_id = wynik
+
+        if success:
+            nowy_wpis = {
+                'id': usterka_id,
+                'typ': media['rodzaj'],
+                'opis': opis_do_arkusza,
+                'file_id': file_id
+            }
+            chat_data['odbiur_wpisy'].append(nowy_wpis)
+            indeks_duplikatow.dodaj(prefix_lokalu, usterka_id, usterka_opis_raw, opis_zrodla_sesji(chat_data))
+
+            await status.edit_text(f"✅ Plik zapisany jako: <b>{message}</b>", parse_mode='HTML')
+            await wiadomosc.reply_text(f"➕ Usterka dodana do listy: <b>{opis_do_arkusza}</b>\n"
+                                       f"(Łącznie: {len(chat_data['odbiur_wpisy'])}).",
+                                       reply_markup=get_inline_keyboard(usterka_id=usterka_id, context=context),
+                                       parse_mode='HTML')
+        else:
+            await status.edit_text(f"❌ Błąd zapisu pliku: {message}")
+            await wiadomosc.reply_text("Możesz wysłać plik ponownie.",
+                                       reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+
+    except Exception as e:
+        logger.error("Błąd podczas przetwarzania nagrania/pliku: %s", e)
+        await wiadomosc.reply_text(f"❌ Wystąpił błąd przy pobieraniu pliku: {e}",
+                                   reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+    finally:
+        # Odłożone zadanie (także to przerwane zamknięciem w trakcie) potrzebuje pliku po restarcie - usunie go odtworz()
+        if not (odlozono or menedzer_cyklu.zamykanie) and os.path.exists(sciezka):
+            os.remove(sciezka)
+
+
+async def zapytaj_o_duplikat(wiadomosc, context: ContextTypes.DEFAULT_TYPE, oczekujacy: dict, podobny: dict):
+    """Wstrzymuje wpis podobny do już istniejącego i pyta, czy mimo to go dodać."""
+    # Każdy wstrzymany wpis ma własne ID w przyciskach - kolejne pytanie nie nadpisuje poprzedniego
+    id_oczekujacego = uuid.uuid4().hex
+    oczekujacy['odbior_id'] = context.chat_data.get('odbiur_id')
+    context.chat_data.setdefault('oczekujace_duplikaty', {})[id_oczekujacego] = oczekujacy
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Dodaj mimo to", callback_data=f'duplikat_tak_{id_oczekujacego}'),
+        InlineKeyboardButton("❌ Pomiń", callback_data=f'duplikat_nie_{id_oczekujacego}'),
+    ]])
+    await wiadomosc.reply_text(
+        f"⚠️ Podobna usterka dla lokalu <b>{oczekujacy['lokal']}</b> już istnieje "
+        f"({int(podobny['podobienstwo'] * 100)}% zgodności):\n"
+        f"<b>{podobny['tekst']}</b>\n({podobny['zrodlo']})\n\n"
+        f"Nowy wpis: <b>{oczekujacy['opis_raw']}</b>\nWpis NIE został dodany - potwierdź, jeśli to inna usterka.",
+        reply_markup=keyboard,
+        parse_mode='HTML'
+    )
+
+
+# --- 7b. HANDLER DLA ZDJĘĆ ---
+async def lokal_i_opis_dla_mediow(wiadomosc, context: ContextTypes.DEFAULT_TYPE, usterka_opis_raw, nazwa='Zdjęcie'):
+    """Wspólna walidacja zdjęć, nagrań i plików: aktywny odbiór, opis, lokal. Zwraca (prefix_lokalu, opis) albo None."""
+    chat_data = context.chat_data
+
+    if not chat_data.get('odbiur_aktywny'):
+        await wiadomosc.reply_text(f"{nazwa}: wyślij *po* rozpoczęciu odbioru. Teraz zostanie zignorowane.",
+                                   reply_markup=START_KEYBOARD)
+        return None
+
+    if not usterka_opis_raw:
+        await wiadomosc.reply_text(f"❌ {nazwa} musi mieć opis (usterkę)!",
+                                   reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+        return None
+
+    usterka_opis_raw, blad_lokalu = zastosuj_lokal_z_tekstu(chat_data, usterka_opis_raw.strip())
+    if blad_lokalu:
+        await wiadomosc.reply_text(blad_lokalu,
+                                   reply_markup=get_inline_keyboard(usterka_id=None, context=context),
+                                   parse_mode='HTML')
+        return None
+
+    if not usterka_opis_raw:
+        await wiadomosc.reply_text(f"❌ {nazwa} musi mieć opis (usterkę), nie tylko numer lokalu!",
+                                   reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+        return None
+
+    prefix_lokalu = chat_data.get('biezacy_lokal_w_szeregu') # Np. "70/1"
+
+    if not prefix_lokalu:
+        await wiadomosc.reply_text(
+            f"❌ BŁĄD: Nie wybrano lokalu ({nazwa.lower()}).\n\n"
+            "Proszę, <b>wybierz lokal z przycisków poniżej</b> (albo zacznij opis od numeru, np. '49/1 przeciek') "
+            "i wyślij ponownie.",
+            reply_markup=get_inline_keyboard(usterka_id=None, context=context),
+            parse_mode='HTML'
+        )
+        return None
+
+    return prefix_lokalu, usterka_opis_raw
+
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Przechwytuje zdjęcie W TRAKCIE aktywnej sesji odbioru."""
+    wynik = await lokal_i_opis_dla_mediow(update.message, context, update.message.caption)
+    if not wynik:
+        return
+    prefix_lokalu, usterka_opis_raw = wynik
+
+    telegram_file_id = update.message.photo[-1].file_id
+
+    podobny = indeks_duplikatow.znajdz(prefix_lokalu, usterka_opis_raw)
+    if podobny:
+        # Zdjęcia jeszcze nie pobieramy - po potwierdzeniu wystarczy jego file_id z Telegrama
+        await zapytaj_o_duplikat(update.message, context,
+                                 {'typ': 'zdjecie', 'lokal': prefix_lokalu, 'opis_raw': usterka_opis_raw,
+                                  'telegram_file_id': telegram_file_id}, podobny)
+        return
+
+    await dodaj_zdjecie(update.message, context, telegram_file_id, prefix_lokalu, usterka_opis_raw)
+
+
+# --- 7b2. HANDLER DLA NAGRAŃ I PLIKÓW (wideo, notatka wideo, zdjęcie wysłane jako plik) ---
+# Bot API w chmurze pozwala pobrać najwyżej 20 MB (lokalny serwer Bot API - więcej)
+LIMIT_POBIERANIA_TELEGRAM = int(os.getenv('LIMIT_POBIERANIA_TELEGRAM_MB', 20)) * 1024 * 1024
+# Ile dużych plików wysyłamy naraz - reszta czeka, żeby nie zabierać wątków zdjęciom
+MAKS_ROWNOLEGLYCH_DUZYCH_PLIKOW = int(os.getenv('MAKS_ROWNOLEGLYCH_DUZYCH_PLIKOW', 2))
+KATALOG_PRZESYLANYCH = os.getenv('KATALOG_PRZESYLANYCH', 'przesylane')
+_semafor_duzych_plikow = asyncio.Semaphore(MAKS_ROWNOLEGLYCH_DUZYCH_PLIKOW)
+
+
+def opis_mediow(message) -> dict:
+    """Dane pliku z wiadomości (wideo / notatka wideo / obraz jako dokument) albo None."""
+    if message.video:
+        plik, rodzaj, mimetype = message.video, 'wideo', message.video.mime_type or 'video/mp4'
+    elif message.video_note:
+        plik, rodzaj, mimetype = message.video_note, 'wideo', 'video/mp4'
+    elif message.document and (message.document.mime_type or '').startswith('image/'):
+        plik, rodzaj, mimetype = message.document, 'zdjecie', message.document.mime_type
+    else:
+        return None
+
+    rozszerzenie = os.path.splitext(getattr(plik, 'file_name', None) or '')[1].lower()
+    return {
+        'telegram_file_id': plik.file_id,
+        'rodzaj': rodzaj,
+        'mimetype': mimetype,
+        'rozszerzenie': rozszerzenie or mimetypes.guess_extension(mimetype) or '.bin',
+        'rozmiar': plik.file_size or 0,
+    }
+
+
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Wideo i zdjęcia w pełnej rozdzielczości (jako plik) W TRAKCIE odbioru - wysyłane na Drive kawałkami."""
+    media = opis_mediow(update.message)
+    if not media:
+        return
+
+    if update.message.video_note and context.chat_data.get('odbiur_aktywny'):
+        # Notatka wideo nie ma podpisu - opisem będzie następna wiadomość tekstowa
+        context.chat_data['oczekujace_nagranie'] = media
+        await update.message.reply_text("🎥 Otrzymano notatkę wideo. Napisz teraz opis usterki "
+                                        "(np. '49/1 przeciek pod oknem').",
+                                        reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+        return
+
+    nazwa = 'Nagranie' if media['rodzaj'] == 'wideo' else 'Plik'
+    wynik = await lokal_i_opis_dla_mediow(update.message, context, update.message.caption, nazwa)
+    if not wynik:
+        return
+    await zglos_duzy_plik(update.message, context, media, *wynik)
+
+
+async def zglos_duzy_plik(wiadomosc, context: ContextTypes.DEFAULT_TYPE, media: dict, prefix_lokalu, usterka_opis_raw):
+    """Sprawdzenie duplikatu, potem dodanie nagrania/pliku (wspólne dla podpisu i opisu notatki wideo)."""
+    podobny = indeks_duplikatow.znajdz(prefix_lokalu, usterka_opis_raw)
+    if podobny:
+        await zapytaj_o_duplikat(wiadomosc, context,
+                                 {'typ': 'duzy_plik', 'lokal': prefix_lokalu, 'opis_raw': usterka_opis_raw,
+                                  'media': media}, podobny)
+        return
+
+    await dodaj_duzy_plik(wiadomosc, context, media, prefix_lokalu, usterka_opis_raw)
+
+
+# --- 7b3. HANDLER DLA NOTATEK GŁOSOWYCH ---
+async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Usterka podyktowana głosem: wpis powstaje od razu, tekst uzupełnia w tle KolejkaTranskrypcji."""
+    chat_data = context.chat_data
+    glos = update.message.voice
+
+    if not chat_data.get('odbiur_aktywny'):
+        await update.message.reply_text("Notatki głosowe przyjmuję tylko w trakcie odbioru.",
+                                        reply_markup=START_KEYBOARD)
+        return
+
+    if glos.duration and glos.duration > MAKS_DLUGOSC_NOTATKI:
+        await update.message.reply_text(f"❌ Notatka jest za długa ({glos.duration} s, limit {MAKS_DLUGOSC_NOTATKI} s). "
+                                        f"Jedna notatka = jedna usterka.",
                                         reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+        return
+
+    prefix_lokalu = chat_data.get('biezacy_lokal_w_szeregu')
+    usterka_id = str(uuid.uuid4())
+    nowy_wpis = {
+        'id': usterka_id,
+        'typ': 'glos',
+        'opis': f"{prefix_lokalu or '?'} - 🎤 (transkrypcja w toku)",
+        'lokal': prefix_lokalu,
+        'telegram_file_id': glos.file_id,
+        'mime': glos.mime_type or 'audio/ogg',
+        'oczekuje_transkrypcji': True
+    }
+    chat_data['odbiur_wpisy'].append(nowy_wpis)
+    kolejka_transkrypcji.zglos(update.effective_chat.id, chat_data, nowy_wpis)
+
+    gdzie = (f"lokal <b>{prefix_lokalu}</b>" if prefix_lokalu else
+             "<b>nie wybrano lokalu</b> - podaj go na początku nagrania (np. 'czterdzieści dziewięć przez jeden ...')")
+    await update.message.reply_text(f"🎤 Przyjęto notatkę głosową ({gdzie}). Tekst pojawi się za chwilę.\n"
+                                    f"(Łącznie: {len(chat_data['odbiur_wpisy'])}).",
+                                    reply_markup=get_inline_keyboard(usterka_id=usterka_id, context=context),
+                                    parse_mode='HTML')
 
 
 # --- 7c. HANDLER: Obsługa przycisków Inline ---
@@ -825,7 +4199,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 parse_mode='HTML'
             )
         except Exception as e:
-             logger.warning(f"Nie można edytować wiadomości po setlokal: {e}")
+             logger.warning("Nie można edytować wiadomości po setlokal: %s", e)
              await query.message.reply_text(f"Aktywny lokal dla usterek zmieniony na: <b>{lokal_name}</b>", 
                                             parse_mode='HTML',
                                             reply_markup=get_inline_keyboard(usterka_id=None, context=context))
@@ -841,7 +4215,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         try:
             id_to_delete = data.split('_', 1)[1]
         except Exception as e:
-            logger.error(f"Nie można sparsować ID z callback: {data} - {e}")
+            logger.error("Nie można sparsować ID z callback: %s - %s", data, e)
             await query.answer("Błąd: Nieprawidłowy format ID.", show_alert=True)
             return
 
@@ -854,7 +4228,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 break
 
         if not wpis_to_delete:
-            logger.warning(f"Próbowano usunąć usterkę {id_to_delete}, ale już nie istnieje.")
+            logger.warning("Próbowano usunąć usterkę %s, ale już nie istnieje.", id_to_delete)
             await query.answer("Ta usterka została już usunięta.", show_alert=True)
             try:
                 await query.edit_message_text(f"--- TA USTERKA ZOSTAŁA JUŻ USUNIĘTA ---", reply_markup=None)
@@ -866,17 +4240,23 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             opis_usunietego = wpis_to_delete.get('opis', 'NIEZNANY WPIS')
             wpisy_lista.remove(wpis_to_delete)
             chat_data['odbiur_wpisy'] = wpisy_lista
+            indeks_duplikatow.usun(id_to_delete)
             
             delete_feedback = f"↩️ Usunięto: <b>{opis_usunietego}</b>"
 
-            if wpis_to_delete.get('typ') == 'zdjecie':
+            if wpis_to_delete.get('typ') in ('zdjecie', 'wideo'):
                 file_id_to_delete = wpis_to_delete.get('file_id')
                 if file_id_to_delete:
-                    delete_success, delete_error = delete_file_from_drive(file_id_to_delete)
+                    wynik = await menedzer_cyklu.wykonaj({'typ': 'usun', 'file_id': file_id_to_delete},
+                                                          magazyn.usun_plik, file_id_to_delete)
+                    if wynik is ODLOZONO:
+                        delete_success, delete_error = False, "usunięcie odłożone do restartu bota"
+                    else:
+                        delete_success, delete_error = wynik
                     if delete_success:
-                        delete_feedback += "\n(Pomyślnie usunięto z Google Drive)."
+                        delete_feedback += "\n(Pomyślnie usunięto plik z magazynu)."
                     else:
-                        delete_feedback += f"\n(BŁĄD usuwania z Drive: {delete_error})."
+                        delete_feedback += f"\n(BŁĄD usuwania pliku: {delete_error})."
             
             try:
                 await query.edit_message_text(f"--- USUNIĘTO: <b>{opis_usunietego}</b> ---", reply_markup=None, parse_mode='HTML')
@@ -888,7 +4268,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                                            parse_mode='HTML')
         
         except Exception as e:
-            logger.error(f"Błąd podczas usuwania wpisu: {e}")
+            logger.error("Błąd podczas usuwania wpisu: %s", e)
             await query.answer(f"Błąd: {e}", show_alert=True)
 
     # --- Logika dla 'koniec_odbioru' ---
@@ -899,7 +4279,6 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             return
         
         identyfikator_odbioru = chat_data.get('odbiur_identyfikator', 'Brak ID Odbioru')
-        podmiot = chat_data.get('odbiur_podmiot')
         wpisy_lista = chat_data.get('odbiur_wpisy', [])
         message_time = datetime.now() 
         
@@ -907,36 +4286,18 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             await query.message.reply_text(f"Zakończono odbiór dla {identyfikator_odbioru}. Nie dodano żadnych usterek.",
                                            reply_markup=START_KEYBOARD)
         else:
-            logger.info(f"Zapisywanie {len(wpisy_lista)} usterek dla {identyfikator_odbioru}...")
-            licznik_zapisanych = 0
-            
-            for wpis in wpisy_lista:
-                opis_caly = wpis.get('opis', 'BŁĄD WPISU')
-                
-                lokal_dla_wpisu = identyfikator_odbioru
-                usterka_dla_wpisu = opis_caly
-
-                if ' - ' in opis_caly:
-                    parts = opis_caly.split(' - ', 1)
-                    if len(parts) == 2:
-                        lokal_dla_wpisu = parts[0]
-                        usterka_dla_wpisu = parts[1]
-                
-                dane_json = {
-                    "numer_lokalu_budynku": lokal_dla_wpisu,
-                    "rodzaj_usterki": usterka_dla_wpisu,
-                    "podmiot_odpowiedzialny": podmiot,
-                    "link_do_zdjecia": ""
-                }
-                file_id_ze_zdjecia = wpis.get('file_id')
-                if file_id_ze_zdjecia:
-                    link_zdjecia = f"https://drive.google.com/file/d/{file_id_ze_zdjecia}/view"
-                    dane_json['link_do_zdjecia'] = link_zdjecia
-                
-                if zapisz_w_arkuszu(dane_json, message_time):
-                    licznik_zapisanych += 1
-            
-            await query.message.reply_text(f"✅ Zakończono odbiór.\nZapisano {licznik_zapisanych} z {len(wpisy_lista)} usterek dla {identyfikator_odbioru}.",
+            wynik = await zapisz_odbior(chat_data, message_time)
+            if wynik is None:
+                await query.message.reply_text(KOMUNIKAT_TRANSKRYPCJE_W_TOKU,
+                                               reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+                return
+            if sum(wynik) < len(wpisy_lista):
+                # Zapis hurtowy jest wszystko-albo-nic: sesja zostaje, żeby usterki nie przepadły
+                logger.error("Zakończenie %s nie zapisało usterek - sesja zostaje", identyfikator_odbioru)
+                await query.message.reply_text(KOMUNIKAT_ZAPIS_NIEUDANY,
+                                               reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+                return
+            await query.message.reply_text(komunikat_zakonczenia(chat_data, *wynik),
                                            reply_markup=START_KEYBOARD)
         
         chat_data.clear()
@@ -944,8 +4305,48 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         try:
             await query.edit_message_reply_markup(reply_markup=None)
         except Exception as e:
-            logger.warning(f"Nie można edytować starej wiadomości: {e}")
+            logger.warning("Nie można edytować starej wiadomości: %s", e)
             
+    # --- Logika dla potwierdzenia podejrzanego duplikatu ---
+    elif data.startswith(('duplikat_tak_', 'duplikat_nie_')):
+        decyzja, id_oczekujacego = data.rsplit('_', 1)
+        oczekujacy = chat_data.get('oczekujace_duplikaty', {}).pop(id_oczekujacego, None)
+        try:
+            await query.edit_message_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+
+        if (not chat_data.get('odbiur_aktywny') or not oczekujacy
+                or oczekujacy.get('odbior_id') != chat_data.get('odbiur_id')):
+            await query.message.reply_text("Ten wpis jest już nieaktualny.",
+                                           reply_markup=get_inline_keyboard(usterka_id=None, context=context))
+            return
+
+        if decyzja == 'duplikat_nie':
+            await query.message.reply_text(f"Pominięto duplikat: <b>{oczekujacy['opis_raw']}</b>",
+                                           reply_markup=get_inline_keyboard(usterka_id=None, context=context),
+                                           parse_mode='HTML')
+        elif oczekujacy['typ'] == 'zdjecie':
+            await dodaj_zdjecie(query.message, context, oczekujacy['telegram_file_id'],
+                                oczekujacy['lokal'], oczekujacy['opis_raw'])
+        elif oczekujacy['typ'] == 'duzy_plik':
+            await dodaj_duzy_plik(query.message, context, oczekujacy['media'], oczekujacy['lokal'], oczekujacy['opis_raw'])
+        else:
+            await dodaj_wpis_tekstowy(query.message, context, oczekujacy['lokal'], oczekujacy['opis_raw'])
+        return
+
+    # --- Galeria: przewijanie stron (lista z lokalnej kopii, bez zapytań do Drive) ---
+    elif data.startswith('galeria_'):
+        lokal, strona = data[len('galeria_'):].rsplit('_', 1)
+        try:
+            pliki = await asyncio.to_thread(magazyn.lista_plikow, lokal.replace('/', '.'))
+            tekst, klawiatura = strona_galerii(lokal, pliki, int(strona))
+            await query.edit_message_text(tekst, reply_markup=klawiatura, parse_mode='HTML',
+                                          disable_web_page_preview=True)
+        except Exception as e:
+            logger.warning("Nie można pokazać strony %s galerii lokalu %s: %s", strona, lokal, e)
+        return
+
     # --- Logika dla pustego przycisku (np. separator) ---
     elif data == "noop":
         await query.answer() 
@@ -953,6 +4354,41 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 # --- 8. Uruchomienie Bota ---
+async def po_uruchomieniu(application: Application):
+    """Po inicjalizacji: odtwarza zaległe zapisy, uruchamia pilnowanie sesji i podpina bezpieczne zamykanie pod SIGTERM/SIGINT."""
+    menedzer_sesji.wczytaj()
+    await menedzer_cyklu.odtworz(application)
+    with w_tle():
+        await asyncio.to_thread(zaladuj_indeks_duplikatow, application)
+    kolejka_transkrypcji.uruchom(application)
+
+    if application.job_queue:
+        application.job_queue.run_repeating(menedzer_sesji.sprawdz, interval=INTERWAL_SPRAWDZANIA_SESJI,
+                                            first=INTERWAL_SPRAWDZANIA_SESJI, name='sprawdzanie_sesji')
+        application.job_queue.run_repeating(menedzer_sesji.raportuj, interval=INTERWAL_RAPORTU_SESJI,
+                                            first=INTERWAL_RAPORTU_SESJI, name='raport_sesji')
+        if shardy_arkusza:
+            application.job_queue.run_repeating(archiwizuj_shardy, interval=INTERWAL_ARCHIWIZACJI_SHARDOW,
+                                                first=600, name='archiwizacja_shardow')
+        if cache_galerii:
+            application.job_queue.run_repeating(synchronizuj_galerie, interval=INTERWAL_SYNCHRONIZACJI_GALERII,
+                                                first=INTERWAL_SYNCHRONIZACJI_GALERII, name='synchronizacja_galerii')
+    else:
+        logger.warning("Brak job_queue (python-telegram-bot[job-queue]) - sesje nie będą wygasać automatycznie.")
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: asyncio.ensure_future(menedzer_cyklu.zamknij(application)))
+
+    # SIGUSR1 (np. `kill -USR1 <pid>`): włącza profilowanie na 60 s albo kończy trwające
+    def przelacz_profilowanie():
+        if profiler.aktywny:
+            profiler.koniec.set()
+        else:
+            asyncio.ensure_future(profiluj(application.bot, sorted(ADMIN_IDS), 60.0))
+    loop.add_signal_handler(signal.SIGUSR1, przelacz_profilowanie)
+
+
 def main():
     """Główna funkcja uruchamiająca bota dla hostingu."""
     
@@ -963,29 +4399,53 @@ def main():
     
     if domain:
         WEBHOOK_URL = f"https://{domain}"
-        logger.info(f"Wykryto domenę Railway: {WEBHOOK_URL}")
+        logger.info("Wykryto domenę Railway: %s", WEBHOOK_URL)
     else:
         WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
         if not WEBHOOK_URL:
             logger.critical("BŁĄD: Nie znaleziono zmiennej RAILWAY_PUBLIC_DOMAIN ani WEBHOOK_URL!")
             exit()
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    persistence = PicklePersistence(
+        filepath=PLIK_SESJI,
+        store_data=PersistenceInput(bot_data=False, user_data=False, callback_data=False)
+    )
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .persistence(persistence)
+        .post_init(po_uruchomieniu)
+        .concurrent_updates(KolejkaPerCzat(
+            MAKS_ROWNOLEGLYCH_AKTUALIZACJI,
+            OknoDeduplikacji(PLIK_PRZETWORZONYCH_AKTUALIZACJI, ROZMIAR_OKNA_DEDUPLIKACJI)
+        ))
+        .build()
+    )
 
+    # Grupa -1: przed właściwymi handlerami (przywrócenie uśpionej sesji + znacznik aktywności)
+    application.add_handler(TypeHandler(Update, menedzer_sesji.przy_aktywnosci), group=-1)
     application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("raport", raport_command))
+    application.add_handler(CommandHandler("profil", profil_command))
+    application.add_handler(CommandHandler("limity", limity_command))
+    application.add_handler(CommandHandler("zdjecia", zdjecia_command))
 
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(CallbackQueryHandler(handle_callback_query))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, profilowane(handle_message, aktualizacja=True)))
+    application.add_handler(MessageHandler(filters.PHOTO, profilowane(handle_photo, aktualizacja=True)))
+    application.add_handler(MessageHandler(filters.VOICE, profilowane(handle_voice, aktualizacja=True)))
+    application.add_handler(MessageHandler(filters.VIDEO | filters.VIDEO_NOTE | filters.Document.IMAGE,
+                                           profilowane(handle_media, aktualizacja=True)))
+    application.add_handler(CallbackQueryHandler(profilowane(handle_callback_query, aktualizacja=True)))
 
-    logger.info(f"Ustawianie webhooka na: {WEBHOOK_URL}")
+    logger.info("Ustawianie webhooka na: %s", WEBHOOK_URL)
     application.run_webhook(
         listen="0.0.0.0",
         port=PORT,
         url_path=TELEGRAM_TOKEN,
-        webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}"
+        webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
+        stop_signals=None  # SIGTERM/SIGINT obsługuje menedzer_cyklu (patrz po_uruchomieniu)
     )
-    logger.info(f"Bot nasłuchuje na porcie {PORT}")
+    logger.info("Bot nasłuchuje na porcie %s", PORT)
 
 if __name__ == '__main__':
     main()